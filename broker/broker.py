@@ -3,6 +3,7 @@ The broker is the heart of the Optimal Framework. It is the messaging and API hu
 It can also present a UI for administration and a custom UI if needed.
 """
 
+import datetime
 import os
 import sys
 import time
@@ -27,11 +28,13 @@ sys.path.append(os.path.join(script_dir, "../../"))
 # IMPORTANT: ALL OPTIMAL FRAMEWORK IMPORTS MUST BE AFTER ADDING THE PATH
 import of.common.logging
 import logging
-from of.broker.lib.access import DatabaseAccess
+from of.broker.lib.access import DatabaseAccess, COPY_NONE
 from of.broker.lib.auth_backend import MongoDBAuthBackend
+from of.broker.lib.indexes import ensure_indexes
 from of.common.cumulative_dict import CumulativeDict
 from of.common.logging import write_to_log, SEV_FATAL, EC_SERVICE, SEV_DEBUG, \
-    EC_UNCATEGORIZED, SEV_ERROR, SEV_INFO, EC_INVALID, make_sparse_log_message, make_textual_log_message, make_event
+    EC_UNCATEGORIZED, SEV_ERROR, SEV_INFO, EC_INVALID, make_sparse_log_message, make_textual_log_message, make_event, \
+    QueuedCallback
 from of.common.security.authentication import init_authentication
 from of.common.settings import JSONXPath
 from of.schemas.schema import SchemaTools
@@ -44,9 +47,14 @@ from of.schemas.validation import of_uri_handler
 from of.broker.cherrypy_api.broker import CherryPyBroker
 from of.common.plugins import CherryPyPlugins
 
-from of.broker.lib.messaging.handler import BrokerWebSocketHandler
+from of.broker.lib.messaging.handler import BrokerWebSocketHandler, VALIDATE_FULL
 from of.common.queue.monitor import Monitor
+from of.common.queue.async_monitor import AsyncMonitor
+from of.common.messaging.send_loop import SendLoop, POLICY_CLOSE
 import of.common.messaging.websocket
+from of.common.messaging.codec import use_codec, CODEC_JSON
+from of.common.messaging.compression import MAX_DECOMPRESSED_SIZE
+from of.broker.cherrypy_api.json_tools import json_processor, json_handler
 
 if os.name == "nt":
     from of.common.logging import write_to_event_log
@@ -154,6 +162,16 @@ def log_to_database(_data, _category, _severity, _process_id_param, _user_id, _o
                     _pid)
 
 
+def log_write_error(_events, _error):
+    """
+    Called by the background log writer when events could not be written to the database, logs them locally instead.
+    """
+    global process_id
+    log_locally("Failed to write " + str(len(_events)) + " events to database, error: " + str(_error) +
+                "\nEvents:\n" + str(_events), EC_UNCATEGORIZED, SEV_ERROR, process_id, None,
+                str(datetime.datetime.utcnow()), None, None, None, os.getpid())
+
+
 def error_message_default(status, message, traceback, version):
     _json_message = {
         'status': status,
@@ -249,11 +267,20 @@ def start_broker(_cfg_filename=None):
 
     _database = _client[_database_name]
     database_access = DatabaseAccess(_database=_database, _schema_tools=schema_tools)
-    of.common.logging.callback = log_to_database
+    write_srvc_dbg("===Ensuring the indexes declared by the schemas===")
+    ensure_indexes(_database, schema_tools, _process_id=process_id)
+    if settings.get("broker/logging/backgroundWriter", _default=True):
+        write_srvc_dbg("===Starting the background log writer===")
+        database_access.logging.start_writer(
+            _max_batch_size=settings.get("broker/logging/maxBatchSize", _default=500),
+            _max_delay=settings.get("broker/logging/maxDelay", _default=0.5),
+            _max_buffer_size=settings.get("broker/logging/maxBufferSize", _default=10000),
+            _on_write_error=log_write_error)
+    of.common.logging.callback = QueuedCallback(log_to_database)
     database_access.save(store_process_system_document(_process_id=process_id,
                                                        _name="Broker instance(" + address + ")"),
                          _user=None,
-                         _allow_save_id=True)
+                         _allow_save_id=True, _copy_mode=COPY_NONE)
     plugins.call_hook("after_db_connect", _broker_scope=globals())
     # TODO: It is possible that one would like to initialize, or at least read the plugins *before* trying to connect to the database
 
@@ -283,7 +310,10 @@ def start_broker(_cfg_filename=None):
         'server.socket_host': '0.0.0.0',
         "server.ssl_certificate": os.path.join(ssl_path(), "optimalframework_test_cert.pem"),
         "server.ssl_private_key": os.path.join(ssl_path(), "optimalframework_test_privkey.pem"),
-        "error_page.default": error_message_default
+        "error_page.default": error_message_default,
+        # Decode and encode JSON using the codec of the messaging
+        "tools.json_in.processor": json_processor,
+        "tools.json_out.handler": json_handler
     })
     write_srvc_dbg("Starting CherryPy, ssl at " + os.path.join(ssl_path(), "optimalframework_test_privkey.pem"))
 
@@ -312,15 +342,39 @@ def start_broker(_cfg_filename=None):
     cherrypy.engine.signals.bus.signal_handler.handlers = {'SIGUSR1': cherrypy.engine.signals.bus.graceful}
 
     # Initialize the decorator-based authentication framework
-    init_authentication(MongoDBAuthBackend(database_access))
+    init_authentication(MongoDBAuthBackend(database_access),
+                        _cache_ttl=settings.get("broker/authentication/sessionCacheTTL"),
+                        _cache_max_size=settings.get("broker/authentication/sessionCacheMaxSize"))
 
     # Initialize root UI
-    web_root = CherryPyBroker(_process_id=process_id, _address=address, _database_access=database_access)
+    web_root = CherryPyBroker(_process_id=process_id, _address=address, _database_access=database_access,
+                              _allow_batching=settings.get("broker/messaging/batching", _default=True),
+                              _allow_compression=settings.get("broker/messaging/compression", _default=True),
+                              _compression_threshold=settings.get("broker/messaging/compressionThreshold",
+                                                                  _default=1024),
+                              _compression_level=settings.get("broker/messaging/compressionLevel", _default=-1),
+                              _max_decompressed_size=settings.get("broker/messaging/maxDecompressedSize",
+                                                                  _default=MAX_DECOMPRESSED_SIZE))
     # Initialize messaging
-    of.common.messaging.websocket.monitor = Monitor(_handler=BrokerWebSocketHandler(process_id, _peers=web_root.peers,
-                                                                                    _database_access=database_access,
-                                                                                    _schema_tools=database_access.schema_tools,
-                                                                                    _address=address))
+    write_srvc_dbg("Using the " + use_codec(settings.get("broker/codec", _default=CODEC_JSON)) + " JSON codec")
+    of.common.messaging.websocket.send_loop = SendLoop(
+        _threads=settings.get("broker/messaging/senderThreads", _default=1),
+        _max_queue_size=settings.get("broker/messaging/maxQueueSize", _default=1000),
+        _policy=settings.get("broker/messaging/slowConsumerPolicy", _default=POLICY_CLOSE),
+        _batch_delay=settings.get("broker/messaging/batchDelay", _default=0))
+    _handler = BrokerWebSocketHandler(process_id, _peers=web_root.peers, _database_access=database_access,
+                                      _schema_tools=database_access.schema_tools, _address=address,
+                                      _validation_levels=settings.get("broker/messaging/validationLevels", _default={}),
+                                      _default_validation_level=settings.get("broker/messaging/validationLevel",
+                                                                             _default=VALIDATE_FULL))
+    if settings.get("broker/messaging/engine", _default="threads") == "asyncio":
+        write_srvc_dbg("Using the asyncio messaging engine")
+        of.common.messaging.websocket.monitor = AsyncMonitor(_handler=_handler,
+                                                             _workers=settings.get("broker/messaging/workers",
+                                                                                   _default=4))
+    else:
+        of.common.messaging.websocket.monitor = Monitor(_handler=_handler,
+                                                        _workers=settings.get("broker/messaging/workers", _default=1))
 
     web_root.plugins = plugins
     # Generate the static content, initialisation
@@ -361,6 +415,12 @@ def stop_broker(_reason, _restart=None):
     except Exception as e:
         write_to_log("Exception trying to stop monitor:", _category=EC_INVALID)
         _exit_status += 1
+    write_srvc_dbg("Stop the send loop")
+    try:
+        of.common.messaging.websocket.send_loop.stop(_timeout=1)
+    except Exception as e:
+        write_to_log("Exception trying to stop the send loop:" + str(e), _category=EC_SERVICE, _severity=SEV_ERROR)
+        _exit_status += 1
     time.sleep(1)
 
     # TODO: Terminate all child processes.(PROD-146)
@@ -371,13 +431,24 @@ def stop_broker(_reason, _restart=None):
                                                        _process_id=process_id,
                                                        _reason="Broker was terminated, reason: \"" +
                                                                _reason + "\", shutting down gracefully"),
-                             _user=None)
+                             _user=None, _copy_mode=COPY_NONE)
 
     except Exception as e:
         write_to_log("Exception trying to write log item to Mongo DB backend:" + str(e), _category=EC_SERVICE,
                      _severity=SEV_ERROR)
         _exit_status += 1
 
+    write_srvc_dbg("Handling the remaining log messages")
+    if isinstance(of.common.logging.callback, QueuedCallback) and not of.common.logging.callback.stop(_timeout=10):
+        write_to_log("Timed out handling the remaining log messages", _category=EC_SERVICE, _severity=SEV_ERROR)
+        _exit_status += 16
+
+    write_srvc_dbg("Writing the remaining log events to the database")
+    if not database_access.logging.stop_writer(_timeout=10):
+        write_to_log("Timed out writing the remaining log events to the database", _category=EC_SERVICE,
+                     _severity=SEV_ERROR)
+        _exit_status += 8
+
     try:
 
         write_srvc_dbg("Unsubscribing the web socket plugin...")
@@ -9,7 +9,6 @@ Created on Jan 22, 2016
 
 import copy
 import time
-from multiprocessing import Queue
 
 import cherrypy
 
@@ -21,6 +20,11 @@ from of.broker.cherrypy_api.authentication import aop_login_json, aop_check_sess
 from of.schemas.constants import id_right_admin_everything
 from of.common.security.groups import has_right, aop_has_right
 from of.broker.lib.node import sanitize_node
+from of.broker.lib.indexes import index_report
+from of.common.security.authentication import session_cache_metrics
+import of.common.messaging.websocket
+from of.common.messaging.send_loop import SendQueue
+from of.common.messaging.compression import Compressor, COMPRESSION_ZLIB, MAX_DECOMPRESSED_SIZE, sum_metrics
 
 from of.schemas.constants import peer_type_to_schema_id
 
@@ -46,12 +50,34 @@ class CherryPyBroker(object):
     #: A reference to a Nodes instance
     node = None
 
-    def __init__(self, _process_id, _address, _database_access):
+    #: A DatabaseAccess instance
+    database_access = None
+
+    #: If true, peers can negotiate to be sent their messages in batches when registering
+    allow_batching = None
+
+    #: If true, peers can negotiate to be sent their messages compressed when registering
+    allow_compression = None
+    #: Messages smaller than this, in bytes, are not compressed
+    compression_threshold = None
+    #: The zlib compression level
+    compression_level = None
+    #: The maximum size, in bytes, of a decompressed message from a peer
+    max_decompressed_size = None
+
+    def __init__(self, _process_id, _address, _database_access, _allow_batching=True, _allow_compression=True,
+                 _compression_threshold=1024, _compression_level=-1, _max_decompressed_size=MAX_DECOMPRESSED_SIZE):
         """
         Initializes the broker web service and includes and initiates the other parts of the API as well
         :param _database_access: A DatabaseAccess instance for database connectivity
         :param _process_id: The system process id of the broker
         :param _address: The peer address of the broker
+        :param _allow_batching: If true, peers can negotiate to be sent their messages in batches when registering
+        :param _allow_compression: If true, peers can negotiate to be sent their messages compressed when registering
+        :param _compression_threshold: Messages smaller than this, in bytes, are not compressed
+        :param _compression_level: The zlib compression level, 1-9, -1 is the zlib default
+        :param _max_decompressed_size: The maximum size, in bytes, of a decompressed message from a peer, the web
+            socket of a peer sending a larger message is closed
         :param _stop_broker: A callback to a function that shuts down the broker
         """
         write_to_log(_process_id=_process_id, _category=EC_SERVICE, _severity=SEV_DEBUG,
@@ -59,7 +85,14 @@ class CherryPyBroker(object):
         self.peers = {}
         self.process_id = _process_id
         self.address = _address
+        self.allow_batching = _allow_batching
+        self.allow_compression = _allow_compression
+        self.compression_threshold = _compression_threshold
+        self.compression_level = _compression_level
+        self.max_decompressed_size = _max_decompressed_size
+
 
+        self.database_access = _database_access
 
         self.node = CherryPyNode(_database_access=_database_access)
 
@@ -76,7 +109,8 @@ class CherryPyBroker(object):
         """
         Register a peer with the web service.
         :param kwargs: A structure containing credentials, environment data, peer type and peer address.
-        :return: A structure containing the sessionId and settings of the peer.
+        :return: A structure containing the sessionId and settings of the peer, whether it is sent its messages in
+            batches, and the compression of its messages, if any.
         """
         # Note: The input to this function is not validated by against the register.json schema and should not be,
         # as it is both a simple structure and would be a potential DOS-voulnerability. All other calls require a valid
@@ -112,6 +146,11 @@ class CherryPyBroker(object):
             _settings = sanitize_node(self.node._node.find(_condition, kwargs["_user"]))[0]
             _session_id = kwargs["_session_id"]
             self.write_debug_info("New _session_id : " + str(_session_id))
+            # Send messages in batches if the peer asks for it and the broker allows it
+            _batching = bool(_data.get("batching")) and self.allow_batching
+            # Compress messages if the peer asks for it and the broker allows it
+            _compression = COMPRESSION_ZLIB if _data.get("compression") == COMPRESSION_ZLIB and \
+                self.allow_compression else None
 
             # Log out any old sessions
             for _curr_session_id, _curr_peer in dict(self.peers).items():
@@ -124,6 +163,7 @@ class CherryPyBroker(object):
                             _curr_peer["websocket"].close(code=UNEXPECTED_CONDITION, reason='Peer logging in again')
                         except Exception as e:
                             self.write_debug_info("Exception doing so, ignoring error: " + str(e))
+                    of.common.messaging.websocket.send_loop.remove_queue(_curr_peer["queue"])
                     del self.peers[_curr_session_id]
 
             self.peers[_session_id] = {
@@ -132,12 +172,15 @@ class CherryPyBroker(object):
                 "address": _address,
                 "environment": _data["environment"],
                 "type": _peer_type,
-                "queue": Queue()
+                "queue": SendQueue(of.common.messaging.websocket.send_loop, _batching=_batching),
+                "compressor": Compressor(_threshold=self.compression_threshold, _level=self.compression_level,
+                                         _max_decompressed_size=self.max_decompressed_size) if _compression else None
             }
 
             self.write_debug_info("Register: A peer at " + str(
                 cherrypy.request.remote.ip) + " registered with this data:" + str(_data))
-            return {"session_id": _session_id, "settings": _settings}
+            return {"session_id": _session_id, "settings": _settings, "batching": _batching,
+                    "compression": _compression}
 
         except Exception as e:
             # Wait to take edge off attacks
@@ -171,6 +214,7 @@ class CherryPyBroker(object):
                 write_to_log(_data="Unregister: Failed closing websocket for address " + _peer["address"] + ".",
                              _category=EC_COMMUNICATION, _severity=SEV_ERROR)
 
+        of.common.messaging.websocket.send_loop.remove_queue(_peer["queue"])
         del self.peers[_session_id]
         return {}
 
@@ -181,6 +225,49 @@ class CherryPyBroker(object):
         """
         self.write_debug_info("Broker: Got a /socket upgrade web socket request.")
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out(content_type='application/json')
+    @aop_check_session
+    @aop_has_right([id_right_admin_everything])
+    def indexes(self, **kwargs):
+        """
+        Diagnostics; compares the indexes declared by the schemas with those in the database.
+        Requires the administer everything right.
+
+        :return: Missing, unused and undeclared indexes, see of.broker.lib.indexes.index_report
+        """
+        return index_report(self.database_access.database, self.database_access.schema_tools)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out(content_type='application/json')
+    @aop_check_session
+    @aop_has_right([id_right_admin_everything])
+    def session_cache(self, **kwargs):
+        """
+        Diagnostics; the session cache metrics. Requires the administer everything right.
+
+        :return: Hits, misses, hit rate and size of the session cache
+        """
+        return session_cache_metrics()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out(content_type='application/json')
+    @aop_check_session
+    @aop_has_right([id_right_admin_everything])
+    def message_monitor(self, **kwargs):
+        """
+        Diagnostics; the message monitor metrics. Requires the administer everything right.
+
+        :return: Queue depths, handled messages, errors and handling times, see of.common.queue.monitor.Monitor.metrics,
+            under "sending", the send loop metrics, see of.common.messaging.send_loop.SendLoop.metrics, and under
+            "compression", the summed compression metrics of the peers, see of.common.messaging.compression.sum_metrics
+        """
+        _result = of.common.messaging.websocket.monitor.metrics()
+        _result["sending"] = of.common.messaging.websocket.send_loop.metrics()
+        _result["compression"] = sum_metrics([_curr_peer["compressor"] for _curr_peer in list(self.peers.values())
+                                              if _curr_peer.get("compressor") is not None])
+        return _result
+
     @cherrypy.expose
     def status(self):
         """
@@ -0,0 +1,38 @@
+"""
+The json_tools module has the request body processor and response handler of CherryPy's json_in and json_out tools,
+that decode and encode using the codec of the messaging, see of.common.messaging.codec.
+They are set in the global CherryPy configuration, so the tools are used just as before.
+
+Created on Oct 18, 2026
+
+@author: Nicklas Boerjesson
+"""
+
+import cherrypy
+
+from of.common.messaging import codec
+
+__author__ = 'Nicklas Borjesson'
+
+
+def json_processor(_entity):
+    """
+    Decode a JSON request body into cherrypy.request.json, replaces the default processor of the json_in tool.
+
+    :param _entity: The request entity
+    """
+    if not _entity.headers.get("Content-Length", ""):
+        raise cherrypy.HTTPError(411)
+
+    _body = _entity.fp.read()
+    try:
+        cherrypy.serving.request.json = codec.decode(_body)
+    except ValueError:
+        raise cherrypy.HTTPError(400, "Invalid JSON document")
+
+
+def json_handler(*args, **kwargs):
+    """
+    Encode the result of a page handler as JSON, replaces the default handler of the json_out tool.
+    """
+    return codec.encode(cherrypy.serving.request._json_inner_handler(*args, **kwargs))
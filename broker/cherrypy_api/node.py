@@ -6,14 +6,98 @@ Created on Mar 18, 2016
 @author: Nicklas Boerjesson
 """
 
+import itertools
+
 import cherrypy
 
 from of.broker.cherrypy_api.authentication import aop_check_session
-from of.broker.lib.node import Node
+from of.broker.lib.access import COPY_NONE
+from of.broker.lib.node import Node, decode_continuation
+from of.common.messaging import codec
 
 
 __author__ = 'Nicklas Borjesson'
 
+
+def stream_json_array(_items):
+    """
+    Serializes an iterable into a JSON array, one item at a time, for streamed CherryPy responses.
+
+    :param _items: An iterable of JSON-serializable items, they may contain ObjectId and datetime instances
+    :return: A generator of encoded chunks
+    """
+    yield b"["
+    _first = True
+    for _curr_item in _items:
+        if _first:
+            _first = False
+            yield codec.encode(_curr_item)
+        else:
+            yield b"," + codec.encode(_curr_item)
+    yield b"]"
+
+
+def start_iteration(_items):
+    """
+    Reads the first item of an iterable, so that errors in the query, or when checking permissions, are raised in the
+    page handler, before the status of a streamed response has been sent, and become proper error responses.
+
+    :param _items: An iterable
+    :return: An iterator over all the items, including the first
+    """
+    _iterator = iter(_items)
+    try:
+        _first = next(_iterator)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([_first], _iterator)
+
+
+def stream_json(_data):
+    """
+    Serializes data into JSON as a single chunk, for streamed CherryPy responses.
+
+    :param _data: JSON-serializable data, it may contain ObjectId and datetime instances
+    :return: A generator of encoded chunks
+    """
+    yield codec.encode(_data)
+
+
+def page_options(_kwargs):
+    """
+    Parse the paging options from the query string parameters, see Node._find_page.
+    Example: /node/find?limit=100&fields=name,parent_id&count=true
+
+    :param _kwargs: The query string parameters
+    :return: The paging options, or None if the request isn't paged
+    """
+    _page = {}
+    if "limit" in _kwargs:
+        try:
+            _limit = int(_kwargs["limit"])
+        except ValueError:
+            _limit = None
+        if _limit is None or _limit < 1:
+            raise cherrypy.HTTPError(400, "page_options: The limit must be a positive integer, got: " +
+                                     str(_kwargs["limit"]))
+        _page["limit"] = _limit
+    if "continuation" in _kwargs:
+        try:
+            decode_continuation(_kwargs["continuation"])
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, "page_options: " + str(e))
+        _page["continuation"] = _kwargs["continuation"]
+    if "fields" in _kwargs:
+        _page["fields"] = [_curr_field for _curr_field in _kwargs["fields"].split(",") if _curr_field != ""]
+    if "count" in _kwargs:
+        _page["count"] = _kwargs["count"].lower() in ["true", "1"]
+
+    if len(_page) > 0:
+        return _page
+    else:
+        return None
+
+
 class CherryPyNode(object):
     """
     The CherryPyNode class is a plugin for CherryPy to expose the Optimal Framework Node API.
@@ -31,21 +115,29 @@ class CherryPyNode(object):
     @cherrypy.tools.json_out(content_type='application/json')
     @aop_check_session
     def save(self, **kwargs):
-        return self._node.save(cherrypy.request.json, kwargs["_user"])
+        # The request data is not used after this, so it doesn't need to be copied
+        return self._node.save(cherrypy.request.json, kwargs["_user"], _copy_mode=COPY_NONE)
 
     @cherrypy.expose
+    @cherrypy.config(**{"response.stream": True})
     @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out(content_type='application/json')
     @aop_check_session
     def find(self, **kwargs):
-        return self._node.find(cherrypy.request.json, kwargs["_user"])
+        _page = page_options(kwargs)
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        if _page is not None:
+            return stream_json(self._node.find(cherrypy.request.json, kwargs["_user"], _page=_page))
+        # Streamed, the result is never held in memory as a whole. The codec encodes the ObjectIds.
+        # The first item is read here, so that errors are not raised after the response has started.
+        return stream_json_array(start_iteration(self._node.find_iter(cherrypy.request.json, kwargs["_user"],
+                                                                      _do_not_fix_object_ids=True)))
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out(content_type='application/json')
     @aop_check_session
     def lookup(self, **kwargs):
-        return self._node.lookup(cherrypy.request.json, kwargs["_user"])
+        return self._node.lookup(cherrypy.request.json, kwargs["_user"], _page=page_options(kwargs))
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -66,14 +158,20 @@ class CherryPyNode(object):
     @cherrypy.tools.json_out(content_type='application/json')
     @aop_check_session
     def load_children(self, **kwargs):
-        return self._node.load_children(cherrypy.request.json, kwargs["_user"])
+        return self._node.load_children(cherrypy.request.json, kwargs["_user"], _page=page_options(kwargs))
 
     @cherrypy.expose
+    @cherrypy.config(**{"response.stream": True})
     @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out(content_type='application/json')
     @aop_check_session
     def history(self, **kwargs):
-        return self._node.history(cherrypy.request.json, kwargs["_user"])
+        _page = page_options(kwargs)
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        if _page is not None:
+            return stream_json(self._node.history(cherrypy.request.json, kwargs["_user"], _page=_page))
+        # Streamed, the result is never held in memory as a whole. The codec encodes the ObjectIds.
+        return stream_json_array(start_iteration(self._node.history_iter(cherrypy.request.json, kwargs["_user"],
+                                                                         _do_not_fix_object_ids=True)))
 
 
     @cherrypy.expose
@@ -11,12 +11,90 @@ import copy
 
 from bson import ObjectId
 from jsonschema.exceptions import ValidationError
+from pymongo import InsertOne, ReplaceOne
 
+from of.common.security.authentication import invalidate_user_sessions, clear_session_cache
 from of.schemas.schema import SchemaTools
 from of.broker.lib.logging import Logging
 
 __author__ = 'nibo'
 
+# How manage_input copies its input
+
+#: Convert the input in place and then deep copy it, the default.
+COPY_DEEP = "deep"
+#: Copy on write, leave the input unchanged and only copy what is changed, the rest is shared with the input.
+COPY_ON_WRITE = "copy_on_write"
+#: Ownership transfer, the caller no longer needs the input, convert it in place and use it without copying.
+COPY_NONE = "none"
+
+
+def object_ids_to_strings(_data):
+    """
+    Returns a copy of the data where all ObjectId instances are replaced by their string representation.
+
+    :param _data: A document, or any part of one
+    :return: The converted copy
+    """
+
+    if isinstance(_data, list):
+        _destination = []
+        for _curr_row in _data:
+            _destination.append(object_ids_to_strings(_curr_row))
+
+        return _destination
+    elif isinstance(_data, dict):
+        _destination = {}
+        for _curr_key, _curr_value in _data.items():
+            _destination[_curr_key] = object_ids_to_strings(_curr_value)
+        return _destination
+
+    elif isinstance(_data, ObjectId):
+        return str(_data)
+    else:
+        return _data
+
+
+def invalidate_cached_sessions(_documents):
+    """
+    Invalidate the cached sessions affected by changes to nodes; those of changed users, and all if a group is changed.
+    Changes made by others, for example another broker, are only seen when the cached sessions expire, see
+    of.common.security.authentication.Authentication.
+
+    :param _documents: The changed documents, of any collection
+    """
+    for _curr_document in _documents:
+        if _curr_document.get("schemaRef") == "ref://of.node.group":
+            clear_session_cache()
+            return
+        if _curr_document.get("schemaRef") == "ref://of.node.user" and "_id" in _curr_document:
+            invalidate_user_sessions(_curr_document["_id"])
+
+
+def object_ids_to_strings_in_place(_data):
+    """
+    Replaces all ObjectId instances in the data by their string representation, without copying anything.
+    Only use this for data that is not shared, like the documents read from a database cursor.
+
+    :param _data: A document, or any part of one
+    :return: The data, converted
+    """
+    if isinstance(_data, dict):
+        for _curr_key, _curr_value in _data.items():
+            if isinstance(_curr_value, ObjectId):
+                _data[_curr_key] = str(_curr_value)
+            elif isinstance(_curr_value, (dict, list)):
+                object_ids_to_strings_in_place(_curr_value)
+    elif isinstance(_data, list):
+        for _curr_index, _curr_value in enumerate(_data):
+            if isinstance(_curr_value, ObjectId):
+                _data[_curr_index] = str(_curr_value)
+            elif isinstance(_curr_value, (dict, list)):
+                object_ids_to_strings_in_place(_curr_value)
+    elif isinstance(_data, ObjectId):
+        return str(_data)
+    return _data
+
 
 class DatabaseAccess():
     """
@@ -91,7 +169,7 @@ class DatabaseAccess():
             raise Exception(_caller_name + ": Error - collection omitted or wrong, only queries against"
                                            " the " + _collection_name + " collection is permitted.")
 
-    def manage_input(self, _input, _schema_ref=None):
+    def manage_input(self, _input, _schema_ref=None, _copy_mode=COPY_DEEP):
         """
         Validate, convert _id to objectId instances and parse collection from input, whether it is data to save or a\
         condition.
@@ -99,12 +177,18 @@ class DatabaseAccess():
 
         :param _input: Data to handle
         :param _schema_ref: If set the schema to validate against
+        :param _copy_mode: How the input is copied:
+            COPY_DEEP(default): The input is converted in place and a deep copy is returned.
+            COPY_ON_WRITE: The input is unchanged, the result shares everything but what is converted with it, so the
+            caller must not change the input until the result is no longer used.
+            COPY_NONE: The input is converted in place and returned, use when the caller no longer needs the input.
         :return: A tuple with the data and the database collection specified in the schema.
 
         """
         try:
             # Apply(if _schema_ref is set, validate against that schema instead)
-            _input, _schema_obj = self.schema_tools.apply(_input, _schema_ref)
+            _input, _schema_obj = self.schema_tools.apply(_input, _schema_ref, _use_plan=True,
+                                                          _copy=_copy_mode == COPY_ON_WRITE)
         except ValidationError as e:
             raise ValidationError("handle_input: Validation error:" + str(e) + ". Data: \n" + str(_input))
         except Exception as e:
@@ -114,11 +198,14 @@ class DatabaseAccess():
 
         # In a condition, the input data is under the conditions-field
         if _schema_ref == "ref://of.conditions":
-            _data = copy.deepcopy(_input["conditions"])
+            _data = _input["conditions"]
             _collection = _input["collection"]
         else:
             _collection = _schema_obj["collection"]
-            _data = copy.deepcopy(_input)
+            _data = _input
+
+        if _copy_mode == COPY_DEEP:
+            _data = copy.deepcopy(_data)
 
         return _data, self.database[_collection]
 
@@ -134,24 +221,25 @@ class DatabaseAccess():
         :return: The document
         """
 
-        _document_cursor = _collection.find({"_id": _id})
-        if _document_cursor.count() == 0:
+        # Two documents are enough to tell a duplicate, this way everything is resolved in one round trip.
+        _documents = list(_collection.find({"_id": _id}, limit=2))
+        if len(_documents) == 0:
             if _zero_error is not None:
                 raise Exception(_zero_error + "_id: " + str(
                     _id) + " could not be found.")
             else:
                 return None
-        elif _document_cursor.count() > 1:
+        elif len(_documents) > 1:
             if _duplicate_error is not None:
                 raise Exception(
                     "Access.save: Tried saving existing, but found duplicate documents with(try to remove either) _id: "
                     + str(_id) + ".")
             else:
                 return None
-        elif _document_cursor.count() == 1:
-            return _document_cursor[0]
+        else:
+            return _documents[0]
 
-    def save(self, _document, _user, _old_document=None, _allow_save_id=False):
+    def save(self, _document, _user, _old_document=None, _allow_save_id=False, _copy_mode=COPY_DEEP):
         """
         Save a document to a collection
 
@@ -159,6 +247,7 @@ class DatabaseAccess():
         :param _user: A user object
         :param _old_document: If available, the existing data, used to avoid an extra read when logging changes.
         :param _allow_save_id: If set, to not assume that _id being set means updating an existing document.
+        :param _copy_mode: How _document is copied, see manage_input
         :return: The object id of the saved document
 
         """
@@ -167,8 +256,10 @@ class DatabaseAccess():
         else:
             _user_id = None
 
-        _document, _collection = self.manage_input(_document)
+        _document, _collection = self.manage_input(_document, _copy_mode=_copy_mode)
 
+        # If supplied by the caller, leave it as it is
+        _old_document_copy_mode = COPY_ON_WRITE
         if _old_document is None and "_id" in _document:
             # Load the existing data
             if not _allow_save_id:
@@ -179,6 +270,8 @@ class DatabaseAccess():
             _old_document = self.load_exactly_one_document(_collection, _document["_id"], _zero_error=_zero_error,
                                                            _duplicate_error="Access.save: Tried to save data over "
                                                                             "existing but found duplicate nodes")
+            # Loaded here, so no one else has it
+            _old_document_copy_mode = COPY_NONE
             if (_old_document is not None) and (str(_old_document["schemaRef"]) != str(_document["schemaRef"])):
                 raise Exception(
                     "Access.save: Cannot change schema of an existing node, remove and add. _id: " + str(
@@ -186,92 +279,197 @@ class DatabaseAccess():
                         _old_document["schemaRef"]))
 
         if _old_document is not None:
-            _old_document, _dummy_collection = self.manage_input(_old_document)
+            _old_document, _dummy_collection = self.manage_input(_old_document, _copy_mode=_old_document_copy_mode)
 
         _result = str(_collection.save(_document))
         if _collection.name != "log":
             self.logging.log_save(_document, _user_id, _old_document)
+        if _collection.name == "node":
+            invalidate_cached_sessions([_document])
         return _result
 
+    def save_many(self, _documents, _user, _allow_save_id=False, _copy_mode=COPY_DEEP):
+        """
+        Save a list of documents. All documents are validated, and checked against the existing documents, before
+        anything is written.
+        Existing documents are loaded in one query per collection, written in one bulk write per collection and
+        the change events are written to the log in one operation.
+
+        :param _documents: A list of documents to save, they can belong to different collections
+        :param _user: A user object
+        :param _allow_save_id: If set, to not assume that _id being set means updating an existing document.
+        :param _copy_mode: How the documents are copied, see manage_input
+        :return: A list of the object ids of the saved documents, in the same order as _documents
+
+        """
+        if _user is not None:
+            _user_id = _user["_id"]
+        else:
+            _user_id = None
+
+        # Validate all documents and group them by collection, keep the indexes to be able to return ordered results
+        _groups = {}
+        for _curr_idx, _curr_document in enumerate(_documents):
+            _document, _collection = self.manage_input(_curr_document, _copy_mode=_copy_mode)
+            if _collection.name not in _groups:
+                _groups[_collection.name] = (_collection, [])
+            _groups[_collection.name][1].append((_curr_idx, _document))
+
+        # Check all documents of all collections before anything is written
+        _writes = []
+        for _collection, _indexed_documents in _groups.values():
+            # Load all the existing documents at once
+            _ids = [_document["_id"] for _curr_idx, _document in _indexed_documents if "_id" in _document]
+            _old_documents = {}
+            if _ids:
+                for _old_document in _collection.find({"_id": {"$in": _ids}}):
+                    # Loaded here, so no one else has it
+                    _old_documents[_old_document["_id"]] = self.manage_input(_old_document, _copy_mode=COPY_NONE)[0]
+
+            _requests = []
+            _changes = []
+            for _curr_idx, _document in _indexed_documents:
+                if "_id" in _document:
+                    _old_document = _old_documents.get(_document["_id"])
+                    if _old_document is None and not _allow_save_id:
+                        raise Exception("Access.save_many: Tried to save data over existing but didn't find an "
+                                        "existing node. _id: " + str(_document["_id"]) + " could not be found.")
+                    if _old_document is not None and str(_old_document["schemaRef"]) != str(_document["schemaRef"]):
+                        raise Exception(
+                            "Access.save_many: Cannot change schema of an existing node, remove and add. _id: " + str(
+                                _document["_id"]) + ", new:" + str(_document["schemaRef"]) + ", old:" + str(
+                                _old_document["schemaRef"]))
+                    _requests.append(ReplaceOne({"_id": _document["_id"]}, _document, upsert=True))
+                    # A later document with the same _id in the same batch changes this one
+                    _old_documents[_document["_id"]] = _document
+                else:
+                    _old_document = None
+                    # InsertOne sets the _id of the document
+                    _requests.append(InsertOne(_document))
+                _changes.append((_curr_idx, _document, _old_document))
+            _writes.append((_collection, _requests, _changes))
+
+        _results = [None] * len(_documents)
+        for _collection, _requests, _changes in _writes:
+            _collection.bulk_write(_requests, ordered=True)
+
+            for _curr_idx, _document, _old_document in _changes:
+                _results[_curr_idx] = str(_document["_id"])
+
+            if _collection.name != "log":
+                self.logging.write_logs([self.logging.make_save_event(_document, _user_id, _old_document)
+                                         for _curr_idx, _document, _old_document in _changes])
+            if _collection.name == "node":
+                invalidate_cached_sessions([_document for _curr_idx, _document, _old_document in _changes])
+        return _results
+
     def remove_documents(self, _documents, _user, _collection_name=None):
         """
         Remove the documents in the documents list
 
+        Note: The documents are matched on their _id, so they should be as loaded from the database (with ObjectIds).
+
         :param _documents: The list of documents
         :param _user: A user object
         :param _collection_name: The collection from where to remove them.
-        :return: Nothing
+        :return: A structure with the number of removed documents, {"deletedCount": n}
         """
         if _user is not None:
             _user_id = _user["_id"]
         else:
             _user_id = None
-        _result = []
-        # Loop through documents and remove them
-        _collection = self.database[_collection_name]
-        for _document in _documents:
-            # noinspection PyUnusedLocal
-            _result.append(_collection.remove(_document))
 
-            self.logging.log_remove(_document, _user_id)
+        if len(_documents) == 0:
+            return {"deletedCount": 0}
 
-        return _result
+        # Remove all documents at once, and then log them in one go
+        _collection = self.database[_collection_name]
+        _result = _collection.delete_many({"_id": {"$in": [_document["_id"] for _document in _documents]}})
+        self.logging.log_remove_many(_documents, _user_id)
+        if _collection_name == "node":
+            invalidate_cached_sessions(_documents)
+
+        return {"deletedCount": _result.deleted_count}
 
     def remove_condition(self, _condition, _user):
         """
         Remove documents that match the supplied MBE condition
 
         :param _condition: A MongoDB search criteria
-        :return:
+        :param _user: A user object
+        :return: A structure with the number of removed documents, {"deletedCount": n}
         """
-        if _user is not None:
-            _user_id = _user["_id"]
-        else:
-            _user_id = None
-        _raw_condition, _collection = self.manage_input(_condition, "ref://of.conditions")
-        _removed_documents_cursor = _collection.find(_raw_condition)
+        _raw_condition, _collection = self.manage_input(_condition, "ref://of.conditions", _copy_mode=COPY_ON_WRITE)
 
-        _documents = [x for x in _removed_documents_cursor]
-        _result = []
-        for _document in _documents:
-            # noinspection PyUnusedLocal
-            _result.append(_collection.remove(_raw_condition))
-            self.logging.log_remove(_document, _user_id)
+        # The documents are needed for logging. Only those are then removed, by _id, so that documents matching the
+        # condition that are added in the mean time are neither removed nor left out of the log.
+        _documents = list(_collection.find(_raw_condition))
+        return self.remove_documents(_documents, _user, _collection.name)
 
-        return _result
+    def manage_conditions(self, _conditions, _trusted=False):
+        """
+        Parse the raw condition and the collection from an MBE condition.
+
+        :param _conditions: An MBE condition
+        :param _trusted: If set, the condition is built internally by the broker, and is used as is. It is neither
+            validated nor copied, so it must already have ObjectId instances where needed, and must not be changed
+            until the query is done. Never set this for conditions that come from the outside.
+        :return: A tuple with the raw condition and the database collection
+        """
+        if _trusted:
+            return _conditions["conditions"], self.database[_conditions["collection"]]
+        else:
+            # Conditions have no ObjectIds to convert, so only the top level of the MBE condition is copied, the
+            # raw condition is shared with the input, which isn't changed
+            return self.manage_input(_conditions, "ref://of.conditions", _copy_mode=COPY_ON_WRITE)
 
-    def find(self, _conditions, _do_not_fix_object_ids=False):
+    def find(self, _conditions, _do_not_fix_object_ids=False, _trusted=False):
         """
         Return a list of documents that match the supplied MBE condition.
         :param _conditions: An MBE condition
+        :param _do_not_fix_object_ids: If set, do not convert ObjectId instances to strings
+        :param _trusted: If set, the condition is not validated, see manage_conditions
         :return: A list of matching documents
         """
+        return list(self.find_iter(_conditions, _do_not_fix_object_ids, _trusted=_trusted))
 
-        def _recurse_object_ids(_data):
-
-            if isinstance(_data, list):
-                _destination = []
-                for _curr_row in _data:
-                    _destination.append(_recurse_object_ids(_curr_row))
+    def find_iter(self, _conditions, _do_not_fix_object_ids=False, _projection=None, _sort=None, _skip=0,
+                  _limit=0, _batch_size=0, _trusted=False):
+        """
+        Return an iterator over the documents that match the supplied MBE condition.
+        The documents are read from the database cursor and have their ObjectIds converted one at a time, so the result
+        is never held in memory as a whole. As the documents are not shared, they are converted in place, not copied.
+        To encode the documents as JSON, of.common.messaging.codec can encode ObjectIds, so they need no conversion.
+        Note: The condition is validated immediately, not when iteration starts.
 
-                return _destination
-            elif isinstance(_data, dict):
-                _destination = {}
-                for _curr_key, _curr_value in _data.items():
-                    _destination[_curr_key] = _recurse_object_ids(_curr_value)
-                return _destination
+        :param _conditions: An MBE condition
+        :param _do_not_fix_object_ids: If set, do not convert ObjectId instances to strings
+        :param _projection: If set, a MongoDB projection, a list of field names or a dict, limiting the returned fields
+        :param _sort: If set, a list of (field name, direction) tuples to sort on
+        :param _skip: The number of documents to skip
+        :param _limit: The maximum number of documents to return, 0 means no limit
+        :param _batch_size: The number of documents per batch read from the server, 0 means the server default
+        :param _trusted: If set, the condition is not validated, see manage_conditions
+        :return: An iterator over the matching documents
+        """
+        _raw_conditions, _collection = self.manage_conditions(_conditions, _trusted)
+        _cursor = _collection.find(_raw_conditions, projection=_projection, sort=_sort, skip=_skip, limit=_limit,
+                                   batch_size=_batch_size)
+        if _do_not_fix_object_ids:
+            return iter(_cursor)
+        else:
+            return (object_ids_to_strings_in_place(_document) for _document in _cursor)
 
-            elif isinstance(_data, ObjectId):
-                return str(_data)
-            else:
-                return _data
+    def count(self, _conditions, _trusted=False):
+        """
+        Return the number of documents that match the supplied MBE condition.
 
-        _raw_conditions, _collection = self.manage_input(_conditions, "ref://of.conditions")
-        _result = list(_collection.find(_raw_conditions))
-        if not _do_not_fix_object_ids:
-            return _recurse_object_ids(_result)
-        else:
-            return _result
+        :param _conditions: An MBE condition
+        :param _trusted: If set, the condition is not validated, see manage_conditions
+        :return: The number of matching documents
+        """
+        _raw_conditions, _collection = self.manage_conditions(_conditions, _trusted)
+        return _collection.count_documents(_raw_conditions)
 
     # noinspection PyMethodMayBeStatic
     def transform_collection(self, _destination_schema, _map, _row_callback):
@@ -10,6 +10,7 @@ Created on Jan 22, 2016
 import datetime
 import hashlib
 
+from of.broker.lib.access import COPY_NONE
 from of.broker.lib.schema_mongodb import of_object_id
 from of.common.security.authentication import AuthenticationBackend
 
@@ -33,7 +34,7 @@ class MongoDBAuthBackend(AuthenticationBackend):
             "collection": "session"
         }
 
-        _sessions = self.db_access.find(_session_cond)
+        _sessions = self.db_access.find(_session_cond, _trusted=True)
         if len(_sessions) > 0:
             if len(_sessions) > 1:
                 raise Exception("session check: Multiple users returned by user query for " + _session_id)
@@ -46,7 +47,7 @@ class MongoDBAuthBackend(AuthenticationBackend):
             "conditions": {"_id": of_object_id(_user_id), "schemaRef": "ref://of.node.user"},
             "collection": "node"
         }
-        _users = list(self.db_access.find(_user_condition))
+        _users = self.db_access.find(_user_condition, _trusted=True)
         if len(_users) > 0:
             if len(_users) > 1:
                 raise Exception("get user: Multiple users returned by user query for " + _user_id)
@@ -82,7 +83,7 @@ class MongoDBAuthBackend(AuthenticationBackend):
                 "schemaRef": "ref://of.session"
             }
 
-            _session_id = self.db_access.save(_session_data, _user)
+            _session_id = self.db_access.save(_session_data, _user, _copy_mode=COPY_NONE)
 
             return _session_id, _user
         else:
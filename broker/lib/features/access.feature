@@ -8,8 +8,82 @@ Feature: Database access layer and logging
     Then test node should be in the database
     And a add test node log item should have been created
 
+  Scenario: the user needs to save many documents at once
+    Given the user logs in with username tester and password test
+    And 100 bulk test nodes are saved to the database
+    Then 100 bulk test nodes should be in the database
+    And 100 add bulk test node log items should have been created
+
+  Scenario: Saving many documents should write nothing if a document in any collection is invalid
+    Given the user logs in with username tester and password test
+    When a new node and a process that does not exist are saved together
+    Then saving should have failed before the node was written
+
+  Scenario: Saving an existing document should only need one round trip to load the existing document
+    Given the user logs in with username tester and password test
+    Then saving an existing node should use fewer round trips than when counting the existing documents
+
   Scenario: The user want to remove data
     Given the user logs in with username tester and password test
     And the test node is removed from the database
     Then the test node should not be present
     And a remove test node log item should have been created
+
+  Scenario: Removing many documents by condition should be done in one operation
+    Given the user logs in with username tester and password test
+    And 10000 bulk remove test documents are inserted into the database
+    When the bulk remove test documents are removed by condition
+    Then 10000 documents should have been reported as deleted using at most 1 delete command
+    And no bulk remove test documents should be in the database
+    And 10000 remove log items for the bulk remove test documents should have been created
+
+  Scenario: Trusted internal queries should skip the validation of the condition
+    Given the user logs in with username tester and password test
+    When the same query is run 500 times validated and 500 times trusted
+    Then both should have returned the same documents
+    And only the validated queries should have validated their condition
+
+  Scenario: Managing input by copy on write should not need a deep copy
+    Given the user logs in with username tester and password test
+    When the test node is managed 1000 times with each copy mode
+    Then all copy modes should have given the same result
+    And the copy on write mode should have left the input unchanged
+    And only the deep copy mode should have made a deep copy
+
+  Scenario: Found documents should have their ObjectIds converted without being copied
+    Given the user logs in with username tester and password test
+    When all nodes are found
+    Then the documents found should have no ObjectIds
+    And converting a document in place should give the same result as copying it
+
+  Scenario: The background log writer should write events in batches
+    Given the background log writer is started with a batch size of 100 and a buffer size of 10
+    When 1000 background test events are logged, one at a time
+    And a security event is logged while the background log writer is running
+    Then the security event should already be in the database
+    And after stopping the background log writer 1000 background test events should be in the database
+    And the background test events should have been written in fewer than 1000 batches
+    And stopping the background log writer a second time should also succeed
+
+  Scenario: The indexes declared by the schemas should exist in the database
+    Given the indexes declared by the schemas are ensured again
+    Then no declared indexes should be missing
+    And the node collection should have a parent_id_1_canRead_1 index
+
+  Scenario: A user changed using the database access should be seen on the next session check
+    Given the user logs in with username tester and password test
+    And the session has been checked and cached
+    When the name of the user is changed using the database access
+    Then the next session check should return the changed name
+
+  Scenario: A changed group membership should be seen on the next session check
+    Given the user logs in with username tester and password test
+    And the session has been checked and cached
+    When the groups of the user are changed using save_many
+    Then the next session check should return the changed groups
+
+  Scenario: Changing a group should invalidate all cached sessions
+    Given the user logs in with username tester and password test
+    And the session has been checked and cached
+    When a group is saved using the database access
+    Then no sessions should be cached
@@ -6,10 +6,90 @@ Feature: Message broker
     Given a peer sends a message to another
     Then then the message should be received
 
+  Scenario: A message is passed on in the frame it was received in
+    Given a peer sends a message to another
+    Then the receiver should be sent the frame the sender sent
+
+  Scenario: Messages validated at the envelope level are passed on without full validation
+    Given the broker validates "ref://of.message.message" messages at the envelope level
+    When a peer sends a message with an invalid sourceProcessId to another
+    Then the receiver should be sent the frame the sender sent
+    And a message with a messageId that is not a number should not be passed on
+    And the broker validates "ref://of.message.message" messages at the full level
+
   Scenario: A process instance message
     Given a peer sends a system process instance message to the broker
     Then then the system process instance must saved to the process collection
 
   Scenario: A log message is sent
     Given a peer sends a log message to the broker
-    Then then a matching log item must exist in the log collection
\ No newline at end of file
+    Then then a matching log item must exist in the log collection
+
+  Scenario: Messages are handled by several workers, in order per peer
+    Given a monitor with 4 workers handles 400 messages from 10 peers
+    Then the messages of each peer should have been handled in order
+    And more than one worker should have handled messages
+    And the monitor metrics should show 400 handled messages
+
+  Scenario: Idle monitors should not use any CPU and stop immediately
+    Given 200 idle monitors are started
+    Then the idle monitors should use almost no CPU time for 1 second
+    And stopping the idle monitors should take less than 0.1 seconds
+
+  Scenario: Messages to many peers are sent by a shared send loop
+    Given 1000 peers are connected to a send loop with 2 threads
+    When 10 messages are queued for each peer
+    Then every peer should have received its messages in order
+    And no more than 2 threads should have sent the messages
+
+  Scenario: Messages to batching peers are coalesced into batches
+    Given 10 batching peers are connected to a send loop with a batch delay of 0.2 seconds
+    When 20 messages are queued for each peer
+    Then every peer should have received its messages in order
+    And each peer should have been sent a single frame
+
+  Scenario: A batch received from a peer is unpacked into its messages
+    Given a peer sends a batch of 3 messages to another
+    Then all messages of the batch should be received in order
+
+  Scenario: Messages to a peer that has negotiated compression are compressed above a threshold
+    Given a web socket that compresses messages of 1000 bytes or more
+    When a small and a large message are sent using the web socket
+    Then the small message should have been sent as text and the large compressed as binary
+    And the compression metrics should show the bytes saved
+
+  Scenario: A compressed message received from a peer is decompressed
+    Given a peer sends a compressed message to another
+    Then then the message should be received
+
+  Scenario: Binary frames are only accepted from peers that have negotiated compression, up to a maximum size
+    Then a binary frame from a web socket without compression negotiated, that decompresses to 100 bytes, should close it as unacceptable data, with a maximum size of 1000 bytes
+    And a binary frame from a web socket with compression negotiated, that decompresses to 2000 bytes, should close it as unacceptable data, with a maximum size of 1000 bytes
+    And a compressed payload that decompresses to at most 1000 bytes should be decompressed
+
+  Scenario: A peer that does not keep up with its messages is disconnected
+    Given a peer that is not receiving has a send queue of 10 messages with the close policy
+    When 11 messages are queued for the peer
+    Then the web socket of the peer should have been closed as a slow consumer
+    And 11 messages should have been dropped
+
+  Scenario: A message left by a closed web socket is sent first by the next web socket of the session
+    Given a web socket of a session with the messages first and second queued
+    When the web socket is closed just after it has taken the first message from the queue
+    Then the messages should still be queued in the order first and second
+
+  Scenario: Messages are handled by the asyncio engine, in order per peer
+    Given an asyncio monitor with 4 workers handles 400 messages from 10 peers
+    Then the messages of each peer should have been handled in order
+    And more than one worker should have handled messages
+
+  Scenario: Messages put on a stopped asyncio monitor are dropped
+    Given an asyncio monitor that has been stopped
+    When 3 messages are put on the queue of the stopped monitor
+    Then the monitor metrics should show 3 dropped messages
+
+  Scenario: A peer sends a message to another using the asyncio engine
+    Given the broker uses the asyncio engine
+    When a peer sends a message to another
+    Then then the message should be received
+    And the broker goes back to the threaded engine
@@ -5,17 +5,19 @@
 import time
 
 import cherrypy
-from multiprocessing import Queue
+from pymongo import monitoring
 
 
 from of.broker.lib.messaging.handler import BrokerWebSocketHandler
 from of.common.messaging.constants import GOING_AWAY
 from of.common.queue.monitor import Monitor
+from of.common.messaging.send_loop import SendLoop, SendQueue
 import of.common.messaging.websocket
 
 from of.broker.lib.messaging.websocket import MockupWebSocket
 from of.broker.lib.node import Node
 from of.broker.testing.init_env import init_env
+from of.broker.lib.features.test_resources import command_counter
 
 __author__ = 'nibo'
 
@@ -26,24 +28,28 @@ id_user_test = "000000010000010001e64c31"
 id_right_admin_nodes = "000000010000010001e64d01"
 
 def before_all(context):
+    # Count round trips to the database, must be registered before the client is created
+    monitoring.register(command_counter)
     init_env("test_db", context)
 
 
 def init_low_level(context, feature):
 
+    of.common.messaging.websocket.send_loop = SendLoop()
+
     # Fake session registration
     _peers = {
         "sender":
             {
                 "address": "source_peer",
                 "user": context.user,
-                "queue": Queue()
+                "queue": SendQueue(of.common.messaging.websocket.send_loop)
             },
         "receiver":
             {
                 "address": "destination_peer",
                 "user": context.user,
-                "queue": Queue()
+                "queue": SendQueue(of.common.messaging.websocket.send_loop)
             }
     }
 
@@ -88,4 +94,5 @@ def after_feature(context, feature):
         context.receiver.close(code=GOING_AWAY, reason="Close receiver")
     if feature.name in ["Process Management", "Process definition management API", "Message broker"]:
         context.monitor.stop()
+        of.common.messaging.websocket.send_loop.stop()
         time.sleep(.1)
@@ -27,6 +27,13 @@ Feature: Node management
     Then the node should not be in the database
     And a remove test node history item should be in the database
 
+  Scenario: A user removes a node with sub nodes
+    Given the user logs in with username tester and password test
+    And a test tree with 3 children having 2 children each is added
+    And the root of the test tree is removed
+    Then none of the nodes of the test tree should be in the database
+    And each node of the test tree should have a remove history item
+
   Scenario: A user without rights tries to access the node interface
     Given the user logs in with username none and password test
     Then trying to administrate nodes, a RightCheckError should be raised
@@ -51,6 +58,16 @@ Feature: Node management
     Then a user loads a list of children, the result must be longer than one and contain the administrators group
 
 
+  Scenario: The database filters nodes by permissions
+    Given the user logs in with username guest and password test
+    Then the children loaded must be the same as when filtering the children in python
+
+  Scenario: A user pages through a list of children
+    Given the user logs in with username root and password root
+    Then loading the children 2 at a time, the pages must together match the complete list
+    And paging a lookup of the children must only return values and texts
+
+
   Scenario: Load schemas
     Given the user logs in with username root and password root
     And a request to the API is made
@@ -60,3 +77,28 @@ Feature: Node management
     Given the user logs in with username root and password root
     And the user requests a list of templates
     Then it should return a list of templates
+
+  Scenario: Conditions are compiled in one pass that only copies what it changes
+    Given a condition with ObjectId strings in nested dicts and lists
+    When the condition is compiled
+    Then the ObjectId strings should have been replaced by ObjectId instances
+    And the parts of the condition without ObjectId strings should be shared with the input
+    And the input condition should be unchanged
+
+  Scenario: Streamed node results are read before the response starts
+    Given the user logs in with username guest and password test
+    Then starting to stream nodes the user may not read should raise a PermissionError at once
+    And the user logs in with username tester and password test
+    And the streamed children should be the same as the loaded children
+
+  Scenario: Finding nodes checks the rights of the user once
+    Given the user logs in with username tester and password test
+    Then finding and iterating nodes should each check the rights once
+
+  Scenario: The web service API only accepts a positive integer as page limit
+    Then paging options with the limits 0, -1, ten and an empty string should be rejected with a 400 status
+    And paging options with the limit 10 should be accepted
+
+  Scenario: The web service API rejects a malformed continuation token
+    Then paging options with a malformed continuation token should be rejected with a 400 status
+    And paging options with the continuation token of a page should be accepted
@@ -2,10 +2,19 @@
 Tests for the database access abstraction features of MBE
 """
 
+import copy
+import time
+
 from behave import *
+from bson.objectid import ObjectId
 from nose.tools.trivial import ok_
 
-from of.broker.lib.features.test_resources import test_node, test_find_node_query
+from of.broker.lib.access import DatabaseAccess, COPY_DEEP, COPY_ON_WRITE, COPY_NONE, object_ids_to_strings, \
+    object_ids_to_strings_in_place
+from of.broker.lib.logging import Logging
+from of.common.security.authentication import check_session
+from of.broker.lib.indexes import ensure_indexes, index_report
+from of.broker.lib.features.test_resources import test_node, test_find_node_query, command_counter
 
 use_step_matcher("re")
 
@@ -33,6 +42,63 @@ def step_impl(context):
     context.db_access.save(test_node, context.user)
 
 
+def _counting_load_exactly_one_document(_collection, _id, _zero_error=None, _duplicate_error=None):
+    """
+    The previous implementation of DatabaseAccess.load_exactly_one_document, used as a benchmark reference.
+    """
+    _document_cursor = _collection.find({"_id": _id})
+    if _document_cursor.count() == 0:
+        if _zero_error is not None:
+            raise Exception(_zero_error + "_id: " + str(_id) + " could not be found.")
+        else:
+            return None
+    elif _document_cursor.count() > 1:
+        if _duplicate_error is not None:
+            raise Exception("Duplicate documents with _id: " + str(_id) + ".")
+        else:
+            return None
+    elif _document_cursor.count() == 1:
+        return _document_cursor[0]
+
+
+@then("saving an existing node should use fewer round trips than when counting the existing documents")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _round_trip_node = copy.deepcopy(test_node)
+    _round_trip_node["name"] = "round_trip_test_node"
+    _id = context.db_access.save(_round_trip_node, context.user)
+
+    def _count_save_round_trips():
+        _node = context.db_access.find({"conditions": {"_id": ObjectId(_id)}, "collection": "node"})[0]
+        command_counter.reset()
+        context.db_access.save(_node, context.user)
+        return len(command_counter.commands), list(command_counter.commands)
+
+    # Get the staticmethod object itself to be able to restore it
+    _load_exactly_one_document = DatabaseAccess.__dict__["load_exactly_one_document"]
+    DatabaseAccess.load_exactly_one_document = staticmethod(_counting_load_exactly_one_document)
+    try:
+        _before, _before_commands = _count_save_round_trips()
+    finally:
+        DatabaseAccess.load_exactly_one_document = _load_exactly_one_document
+
+    _after, _after_commands = _count_save_round_trips()
+
+    print("Round trips per save of an existing document, before: " + str(_before) + " " + str(_before_commands) +
+          ", after: " + str(_after) + " " + str(_after_commands))
+    _saved = context.db_access.find({"conditions": {"_id": ObjectId(_id)}, "collection": "node"})[0]
+    ok_(_saved["name"] == "round_trip_test_node", "The node was not saved: " + str(_saved))
+    if _before == 0:
+        # Some backends, like mongomock, don't support command monitoring
+        print("No commands were recorded, command monitoring is not available, the round trips are not compared.")
+    else:
+        ok_(_after < _before, "Expected fewer round trips, before: " + str(_before) + ", after: " + str(_after))
+
+
 @then("test node should be in the database")
 def step_impl(context):
     """
@@ -86,3 +152,486 @@ def step_impl(context):
         ok_(True)
     else:
         ok_(False, "Test node was till found found, result:" + str(_result))
+
+
+@given("(?P<count>[0-9]+) bulk test nodes are saved to the database")
+def step_impl(context, count):
+    """
+
+    :type context behave.runner.Context
+    :param count The number of nodes
+
+    """
+    _documents = []
+    for _curr_idx in range(int(count)):
+        _document = copy.deepcopy(test_node)
+        _document["name"] = "bulk_test_node_" + str(_curr_idx)
+        _documents.append(_document)
+
+    context.bulk_ids = context.db_access.save_many(_documents, context.user)
+
+
+@when("a new node and a process that does not exist are saved together")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _node = copy.deepcopy(test_node)
+    _node["name"] = "save_many_not_written_node"
+    _process = {"_id": str(ObjectId()), "spawnedBy": context.user["_id"], "spawnedWhen": "2016-01-22 12:00:00",
+                "name": "save_many_missing_process", "systemPid": 10000, "schemaRef": "ref://of.process.system"}
+    try:
+        context.db_access.save_many([_node, _process], context.user)
+        context.save_many_error = None
+    except Exception as e:
+        context.save_many_error = str(e)
+
+
+@then("saving should have failed before the node was written")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.save_many_error is not None and "could not be found" in context.save_many_error,
+        "Unexpected error: " + str(context.save_many_error))
+    ok_(len(context.db_access.find({"conditions": {"name": "save_many_not_written_node"}, "collection": "node"})) == 0,
+        "The node was written")
+
+
+@then("(?P<count>[0-9]+) bulk test nodes should be in the database")
+def step_impl(context, count):
+    """
+
+    :type context behave.runner.Context
+    :param count The number of nodes
+
+    """
+    _result = context.db_access.find({"conditions": {"name": {"$regex": "^bulk_test_node_"}}, "collection": "node"})
+    ok_(len(_result) == int(count) and sorted([_curr_node["_id"] for _curr_node in _result]) == sorted(context.bulk_ids),
+        "Expected " + count + " bulk test nodes, found " + str(len(_result)))
+
+
+@step("(?P<count>[0-9]+) add bulk test node log items should have been created")
+def step_impl(context, count):
+    """
+
+    :type context behave.runner.Context
+    :param count The number of log items
+
+    """
+    _result = context.db_access.find(
+        {"conditions": {"category": "add", "add.name": {"$regex": "^bulk_test_node_"}}, "collection": "log"})
+    ok_(len(_result) == int(count), "Expected " + count + " log items, found " + str(len(_result)))
+
+
+@given("the indexes declared by the schemas are ensured again")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    # The indexes are created when the database is initialized, doing it again must not fail
+    context.ensured_indexes = ensure_indexes(context.db_access.database, context.db_access.schema_tools)
+
+
+@then("no declared indexes should be missing")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _report = index_report(context.db_access.database, context.db_access.schema_tools)
+    ok_(_report["missing"] == [], "Missing indexes: " + str(_report["missing"]))
+
+
+@then("the (?P<collection>.+) collection should have a (?P<name>.+) index")
+def step_impl(context, collection, name):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(name in context.db_access.database[collection].index_information(),
+        "The " + name + " index is missing from the " + collection + " collection")
+
+
+bulk_remove_condition = {"conditions": {"bulkRemoveTest": True}, "collection": "node"}
+
+
+@given("(?P<count>[0-9]+) bulk remove test documents are inserted into the database")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    # Insert directly, this is about the removal
+    _documents = []
+    for _curr_idx in range(int(count)):
+        _document = copy.deepcopy(test_node)
+        _document["name"] = "bulk_remove_test_node_" + str(_curr_idx)
+        _document["bulkRemoveTest"] = True
+        _documents.append(_document)
+    context.db_access.database["node"].insert_many(_documents)
+
+
+@when("the bulk remove test documents are removed by condition")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    command_counter.reset()
+    _started = time.perf_counter()
+    context.bulk_remove_result = context.db_access.remove_condition(bulk_remove_condition, context.user)
+    print("Removed " + str(context.bulk_remove_result["deletedCount"]) + " documents in " +
+          str(round(time.perf_counter() - _started, 3)) + " seconds.")
+
+
+@then("(?P<count>[0-9]+) documents should have been reported as deleted using at most (?P<commands>[0-9]+) "
+      "delete command")
+def step_impl(context, count, commands):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.bulk_remove_result == {"deletedCount": int(count)},
+        "Unexpected result: " + str(context.bulk_remove_result))
+    _delete_commands = [_curr_command for _curr_command in command_counter.commands if _curr_command == "delete"]
+    ok_(len(_delete_commands) <= int(commands), "Too many delete commands: " + str(len(_delete_commands)))
+
+
+@then("no bulk remove test documents should be in the database")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.db_access.count(bulk_remove_condition) == 0, "Bulk remove test documents remain")
+
+
+@then("(?P<count>[0-9]+) remove log items for the bulk remove test documents should have been created")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    _count = context.db_access.count({"conditions": {"category": "remove", "remove.bulkRemoveTest": True},
+                                      "collection": "log"})
+    ok_(_count == int(count), "Expected " + count + " remove log items, found " + str(_count))
+
+
+@when("the same query is run (?P<validated>[0-9]+) times validated and (?P<trusted>[0-9]+) times trusted")
+def step_impl(context, validated, trusted):
+    """
+    :type context behave.runner.Context
+    """
+    _condition = {"conditions": {"_id": ObjectId(context.user["_id"]), "schemaRef": "ref://of.node.user"},
+                  "collection": "node"}
+
+    context.validated_result = context.db_access.find(_condition)
+    context.trusted_result = context.db_access.find(_condition, _trusted=True)
+
+    # Count the validations, and time the handling of the condition, the query itself is the same
+    _schema_tools = context.db_access.schema_tools
+    _apply = _schema_tools.apply
+    _validations = []
+
+    def _counting_apply(*args, **kwargs):
+        _validations.append(args)
+        return _apply(*args, **kwargs)
+
+    _schema_tools.apply = _counting_apply
+    try:
+        _started = time.perf_counter()
+        for _curr_idx in range(int(validated)):
+            context.db_access.manage_conditions(_condition)
+        context.validated_time = time.perf_counter() - _started
+        context.validated_validations = len(_validations)
+
+        _validations.clear()
+        _started = time.perf_counter()
+        for _curr_idx in range(int(trusted)):
+            context.db_access.manage_conditions(_condition, _trusted=True)
+        context.trusted_time = time.perf_counter() - _started
+        context.trusted_validations = len(_validations)
+    finally:
+        del _schema_tools.apply
+    context.validated_count = int(validated)
+
+    print("Handling the conditions of " + validated + " validated queries took " +
+          str(round(context.validated_time, 4)) + " seconds, " + trusted + " trusted queries took " +
+          str(round(context.trusted_time, 4)) + " seconds.")
+
+
+@then("both should have returned the same documents")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(len(context.trusted_result) == 1 and context.trusted_result == context.validated_result,
+        "The results differ, validated: " + str(context.validated_result) + ", trusted: " +
+        str(context.trusted_result))
+
+
+@then("only the validated queries should have validated their condition")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.validated_validations == context.validated_count,
+        "Expected " + str(context.validated_count) + " validations, got " + str(context.validated_validations))
+    ok_(context.trusted_validations == 0, "Trusted conditions were validated " + str(context.trusted_validations) +
+        " times")
+
+
+@when("the test node is managed (?P<count>[0-9]+) times with each copy mode")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    # Earlier scenarios may have converted the shared test node in place
+    _test_node = object_ids_to_strings(test_node)
+    context.copy_mode_input = object_ids_to_strings(_test_node)
+    context.copy_mode_original = object_ids_to_strings(_test_node)
+    context.copy_mode_results = {}
+    context.copy_mode_times = {}
+    context.copy_mode_deep_copies = {}
+    _deepcopy = copy.deepcopy
+    for _curr_mode in [COPY_DEEP, COPY_ON_WRITE, COPY_NONE]:
+        # Only copy on write leaves the input unchanged, the other modes get their own inputs, made before timing
+        if _curr_mode == COPY_ON_WRITE:
+            _inputs = [context.copy_mode_input] * int(count)
+        else:
+            _inputs = [copy.deepcopy(_test_node) for _curr_idx in range(int(count))]
+        _started = time.perf_counter()
+        for _curr_input in _inputs:
+            _result, _collection = context.db_access.manage_input(_curr_input, _copy_mode=_curr_mode)
+        context.copy_mode_times[_curr_mode] = time.perf_counter() - _started
+        context.copy_mode_results[_curr_mode] = _result
+
+        # Count the deep copies of managing the input once, the recursive calls of deepcopy itself are not counted
+        _deep_copies = []
+
+        def _counting_deepcopy(_data, *args, **kwargs):
+            if not args:
+                _deep_copies.append(_data)
+            return _deepcopy(_data, *args, **kwargs)
+
+        _input = context.copy_mode_input if _curr_mode == COPY_ON_WRITE else _deepcopy(_test_node)
+        copy.deepcopy = _counting_deepcopy
+        try:
+            context.db_access.manage_input(_input, _copy_mode=_curr_mode)
+        finally:
+            copy.deepcopy = _deepcopy
+        context.copy_mode_deep_copies[_curr_mode] = len(_deep_copies)
+
+    print("Managing the test node " + count + " times took " +
+          ", ".join([_curr_mode + ": " + str(round(_curr_time, 4)) + " seconds"
+                     for _curr_mode, _curr_time in context.copy_mode_times.items()]) + ".")
+
+
+@then("all copy modes should have given the same result")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _results = context.copy_mode_results
+    ok_(_results[COPY_DEEP] == _results[COPY_ON_WRITE] == _results[COPY_NONE] and
+        isinstance(_results[COPY_ON_WRITE]["parent_id"], ObjectId),
+        "The results differ: " + str(_results))
+
+
+@then("the copy on write mode should have left the input unchanged")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.copy_mode_input == context.copy_mode_original and
+        isinstance(context.copy_mode_input["parent_id"], str),
+        "The input was changed: " + str(context.copy_mode_input))
+
+
+@then("only the deep copy mode should have made a deep copy")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.copy_mode_deep_copies[COPY_DEEP] > 0 and context.copy_mode_deep_copies[COPY_ON_WRITE] == 0 and
+        context.copy_mode_deep_copies[COPY_NONE] == 0, "Deep copies made: " + str(context.copy_mode_deep_copies))
+
+
+@given("the background log writer is started with a batch size of (?P<batch_size>[0-9]+) and a buffer size of "
+       "(?P<buffer_size>[0-9]+)")
+def step_impl(context, batch_size, buffer_size):
+    """
+    :type context behave.runner.Context
+    """
+    context.background_logging = Logging(context.db_access.database)
+    context.background_logging.start_writer(_max_batch_size=int(batch_size), _max_buffer_size=int(buffer_size))
+
+
+@when("(?P<count>[0-9]+) background test events are logged, one at a time")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    for _curr_idx in range(int(count)):
+        context.background_logging.write_log({"category": "backgroundTest", "data": str(_curr_idx)})
+
+
+@step("a security event is logged while the background log writer is running")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.background_logging.log_security("backgroundSecurityTest", "Test security event",
+                                            context.user["_id"], None)
+
+
+@then("the security event should already be in the database")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.db_access.database["log"].count_documents({"category": "backgroundSecurityTest"}) == 1,
+        "The security event was not written synchronously")
+
+
+@step("after stopping the background log writer (?P<count>[0-9]+) background test events should be in the database")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    _writer = context.background_logging.writer
+    ok_(context.background_logging.stop_writer(_timeout=30), "The background log writer did not stop")
+    context.background_writer = _writer
+    context.background_metrics = _writer.metrics()
+    _count = context.db_access.database["log"].count_documents({"category": "backgroundTest"})
+    ok_(_count == int(count), "Expected " + count + " background test events, found " + str(_count))
+
+
+@then("the background test events should have been written in fewer than (?P<count>[0-9]+) batches")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    print("Background log writer metrics: " + str(context.background_metrics))
+    ok_(context.background_metrics["batches"] < int(count), "Too many batches: " + str(context.background_metrics))
+
+
+@step("stopping the background log writer a second time should also succeed")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    # The writer has already stopped, the None that would wake it up is left on the queue and must be skipped
+    ok_(context.background_writer.stop(_timeout=5), "The background log writer failed to stop a second time")
+
+
+def _contains_object_ids(_data):
+    if isinstance(_data, dict):
+        return any([_contains_object_ids(_curr_value) for _curr_value in _data.values()])
+    elif isinstance(_data, list):
+        return any([_contains_object_ids(_curr_value) for _curr_value in _data])
+    else:
+        return isinstance(_data, ObjectId)
+
+
+@when("all nodes are found")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.found_documents = context.db_access.find({"conditions": {}, "collection": "node"})
+
+
+@then("the documents found should have no ObjectIds")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(len(context.found_documents) > 0, "No documents found")
+    ok_(not _contains_object_ids(context.found_documents))
+
+
+@then("converting a document in place should give the same result as copying it")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _document = {"_id": ObjectId(), "groups": [ObjectId(), "a string"], "nested": {"parent_id": ObjectId(),
+                 "list": [{"node_id": ObjectId()}]}, "name": "test"}
+    _copied = object_ids_to_strings(_document)
+    _nested = _document["nested"]
+    _converted = object_ids_to_strings_in_place(_document)
+    ok_(_converted is _document and _converted["nested"] is _nested)
+    ok_(_converted == _copied and not _contains_object_ids(_converted))
+
+
+def _load_user_node(context):
+    return context.db_access.find({"conditions": {"_id": ObjectId(context.user["_id"])}, "collection": "node"},
+                                  _trusted=True)[0]
+
+
+@given("the session has been checked and cached")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    check_session(context.session_id)
+    ok_(context.session_id in context.auth.session_cache, "The session was not cached")
+    context.original_user_node = _load_user_node(context)
+
+
+@when("the name of the user is changed using the database access")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _user_node = copy.deepcopy(context.original_user_node)
+    _user_node["name"] = "Changed " + _user_node["name"]
+    context.db_access.save(_user_node, context.user)
+
+
+@then("the next session check should return the changed name")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    try:
+        _name = check_session(context.session_id)["name"]
+        ok_(_name == "Changed " + context.original_user_node["name"], "The session check returned: " + _name)
+    finally:
+        context.db_access.save(copy.deepcopy(context.original_user_node), context.user)
+
+
+@when("the groups of the user are changed using save_many")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _user_node = copy.deepcopy(context.original_user_node)
+    _user_node["groups"] = _user_node["groups"] + ["000000010000010001e64c29"]
+    context.db_access.save_many([_user_node], context.user)
+
+
+@then("the next session check should return the changed groups")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    try:
+        _groups = [str(_curr_group) for _curr_group in check_session(context.session_id)["groups"]]
+        ok_(_groups == context.original_user_node["groups"] + ["000000010000010001e64c29"],
+            "The session check returned the groups: " + str(_groups))
+    finally:
+        context.db_access.save(copy.deepcopy(context.original_user_node), context.user)
+
+
+@when("a group is saved using the database access")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _group_node = context.db_access.find({"conditions": {"schemaRef": "ref://of.node.group"}, "collection": "node"},
+                                         _trusted=True)[0]
+    context.db_access.save(_group_node, context.user)
+
+
+@then("no sessions should be cached")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(len(context.auth.session_cache) == 0, "Sessions are still cached: " + str(len(context.auth.session_cache)))
@@ -1,16 +1,30 @@
 import datetime
 import json
+import threading
 import time
+import zlib
+from queue import Queue
 
 from behave import *
 from bson.objectid import ObjectId
 from nose.tools.trivial import ok_
+from ws4py.messaging import BinaryMessage
+
+from of.common.messaging.compression import Compressor, decompress_frame
+from of.common.messaging.constants import SLOW_CONSUMER, UNACCEPTABLE_DATA
+from of.common.messaging.websocket import OptimalWebSocket
+from of.common.messaging.send_loop import SendLoop, SendQueue, POLICY_CLOSE
+from of.common.queue.handler import Handler
+from of.common.queue.monitor import Monitor
+from of.common.queue.async_monitor import AsyncMonitor
+import of.common.messaging.websocket
 
 
 
 use_step_matcher("re")
 
 
+@when("a peer sends a message to another")
 @given("a peer sends a message to another")
 def step_impl(context):
     """
@@ -19,6 +33,48 @@ def step_impl(context):
     context.message = {"destination": "destination_peer", "schemaRef": "ref://of.message.message", "sourceProcessId": str(ObjectId()), "source": "source_peer", "messageId": 1}
 
     context.sender.received_message(json.dumps(context.message))
+    context.frame = json.dumps(context.message).encode()
+
+
+@then("the receiver should be sent the frame the sender sent")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    time.sleep(0.1)
+    ok_(context.receiver.frame == context.frame, "The frame was changed: " + str(context.receiver.frame))
+
+
+@then("the broker validates \"(?P<schema_ref>.*)\" messages at the (?P<level>envelope|full) level")
+@given("the broker validates \"(?P<schema_ref>.*)\" messages at the (?P<level>envelope|full) level")
+def step_impl(context, schema_ref, level):
+    """
+    :type context behave.runner.Context
+    """
+    context.monitor.handler.validation_levels[schema_ref] = level
+
+
+@when("a peer sends a message with an invalid sourceProcessId to another")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.message = {"destination": "destination_peer", "schemaRef": "ref://of.message.message",
+                       "sourceProcessId": "not an objectId", "source": "source_peer", "messageId": 2}
+    context.frame = json.dumps(context.message).encode()
+    context.sender.received_message(json.dumps(context.message))
+
+
+@then("a message with a messageId that is not a number should not be passed on")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.receiver.message = None
+    context.sender.received_message(json.dumps({"destination": "destination_peer", "source": "source_peer",
+                                                "schemaRef": "ref://of.message.message", "messageId": "3"}))
+    time.sleep(0.1)
+    ok_(context.receiver.message is None, "The message was passed on: " + str(context.receiver.message))
 
 
 @then("then the message should be received")
@@ -93,3 +149,491 @@ def step_impl(context):
     context.db_access.find({"conditions": {"processId": context.process_instance["_id"]}, "collection": "log"},
                            context.user)[0]
     ok_(True)
+
+
+class ShardedTestHandler(Handler):
+    """
+    Records the order of the items it handles, by peer, and which threads handled them
+    """
+    def __init__(self):
+        super(ShardedTestHandler, self).__init__(_process_id=None)
+        self.handled = {}
+        self.threads = set()
+
+    def shard_key(self, _item):
+        return _item["peer"]
+
+    def handle(self, _item):
+        # Simulate some I/O, letting other workers run
+        time.sleep(0.001)
+        self.handled.setdefault(_item["peer"], []).append(_item["index"])
+        self.threads.add(threading.current_thread().name)
+
+
+@given("(?P<engine>a|an asyncio) monitor with (?P<workers>[0-9]+) workers handles (?P<count>[0-9]+) messages from "
+       "(?P<peers>[0-9]+) peers")
+def step_impl(context, engine, workers, count, peers):
+    """
+    :type context behave.runner.Context
+    """
+    context.sharded_handler = ShardedTestHandler()
+    if engine == "a":
+        _monitor = Monitor(_handler=context.sharded_handler, _workers=int(workers))
+    else:
+        _monitor = AsyncMonitor(_handler=context.sharded_handler, _workers=int(workers))
+    _started = time.perf_counter()
+    for _curr_index in range(int(count)):
+        _monitor.queue.put({"peer": "peer_" + str(_curr_index % int(peers)), "index": _curr_index})
+
+    while _monitor.metrics()["handled"] < int(count) and time.perf_counter() - _started < 30:
+        time.sleep(0.01)
+    print("Handling " + count + " messages with " + workers + " workers took " +
+          str(round(time.perf_counter() - _started, 4)) + " seconds.")
+    context.monitor_metrics = _monitor.metrics()
+    _monitor.stop()
+
+
+@given("an asyncio monitor that has been stopped")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.stopped_monitor = AsyncMonitor(_handler=ShardedTestHandler(), _workers=1)
+    context.stopped_monitor.stop()
+
+
+@when("(?P<count>[0-9]+) messages are put on the queue of the stopped monitor")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    for _curr_index in range(int(count)):
+        context.stopped_monitor.queue.put({"peer": "peer_0", "index": _curr_index})
+    context.monitor_metrics = context.stopped_monitor.metrics()
+
+
+@then("the monitor metrics should show (?P<count>[0-9]+) dropped messages")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.monitor_metrics["dropped"] == int(count), "Wrong metrics: " + str(context.monitor_metrics))
+    ok_(context.monitor_metrics["queued"] == 0, "Dropped messages are counted as queued: " +
+        str(context.monitor_metrics))
+
+
+@then("the messages of each peer should have been handled in order")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    for _curr_peer, _curr_indexes in context.sharded_handler.handled.items():
+        ok_(_curr_indexes == sorted(_curr_indexes), "The messages of " + _curr_peer + " were handled out of order")
+
+
+@then("more than one worker should have handled messages")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(len(context.sharded_handler.threads) > 1, "Only one worker was used: " + str(context.sharded_handler.threads))
+
+
+@then("the monitor metrics should show (?P<count>[0-9]+) handled messages")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    print("Monitor metrics: " + str(context.monitor_metrics))
+    ok_(context.monitor_metrics["handled"] == int(count) and context.monitor_metrics["errors"] == 0 and
+        len(context.monitor_metrics["workers"]) == 4, "Unexpected metrics: " + str(context.monitor_metrics))
+
+
+@given("(?P<count>[0-9]+) idle monitors are started")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    context.idle_monitors = [Monitor(_handler=ShardedTestHandler()) for _curr_index in range(int(count))]
+
+
+@then("the idle monitors should use almost no CPU time for (?P<seconds>[0-9]+) second")
+def step_impl(context, seconds):
+    """
+    :type context behave.runner.Context
+    """
+    _started = time.process_time()
+    time.sleep(int(seconds))
+    _cpu_time = time.process_time() - _started
+    print(str(len(context.idle_monitors)) + " idle monitors used " + str(round(_cpu_time, 4)) +
+          " seconds of CPU time in " + seconds + " second(s).")
+    ok_(_cpu_time < 0.05, "The idle monitors used " + str(_cpu_time) + " seconds of CPU time")
+
+
+@then("stopping the idle monitors should take less than (?P<seconds>[0-9.]+) seconds")
+def step_impl(context, seconds):
+    """
+    :type context behave.runner.Context
+    """
+    _started = time.perf_counter()
+    for _curr_monitor in context.idle_monitors:
+        _curr_monitor.stop()
+    for _curr_monitor in context.idle_monitors:
+        _curr_monitor.monitor_thread.join()
+    _stop_time = time.perf_counter() - _started
+    print("Stopping took " + str(round(_stop_time, 4)) + " seconds.")
+    ok_(_stop_time < float(seconds), "Stopping the idle monitors took " + str(_stop_time) + " seconds")
+
+
+class SendTestWebSocket(object):
+    """
+    Records the messages sent to it and the threads sending them, and how it was closed
+    """
+    def __init__(self, _address, _block=None):
+        self.address = _address
+        self.messages = []
+        self.threads = set()
+        self.closed_code = None
+        self.block = _block
+        self.frames = 0
+
+    def send_message(self, _message):
+        if self.block:
+            self.block.wait()
+        self.messages.append(_message)
+        self.threads.add(threading.current_thread().name)
+        self.frames += 1
+
+    def send_batch(self, _messages):
+        self.messages.extend(_messages)
+        self.threads.add(threading.current_thread().name)
+        self.frames += 1
+
+    def close(self, code=1000, reason=''):
+        self.closed_code = code
+
+
+@given("(?P<count>[0-9]+) peers are connected to a send loop with (?P<threads>[0-9]+) threads")
+def step_impl(context, count, threads):
+    """
+    :type context behave.runner.Context
+    """
+    context.test_send_loop = SendLoop(_threads=int(threads))
+    context.send_test_peers = []
+    for _curr_index in range(int(count)):
+        _web_socket = SendTestWebSocket("peer_" + str(_curr_index))
+        _web_socket.message_queue = SendQueue(context.test_send_loop)
+        _web_socket.message_queue.attach(_web_socket)
+        context.send_test_peers.append(_web_socket)
+
+
+class ClosingQueue(Queue):
+    """
+    Closes the web socket monitoring it just after a message has been taken, before it is sent
+    """
+    web_socket = None
+
+    def get(self, block=True, timeout=None):
+        _message = super(ClosingQueue, self).get(block, timeout)
+        self.web_socket.monitor_message_queue_thread.terminated = True
+        return _message
+
+
+class RequeueTestWebSocket(OptimalWebSocket):
+    """
+    Records the messages sent by it
+    """
+    def __init__(self):
+        self.address = "requeue_peer"
+        self.log_prefix = "RequeueTestWebSocket: "
+        self.messages = []
+
+    def send_message(self, message):
+        self.messages.append(message)
+
+
+@given("a web socket of a session with the messages first and second queued")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.requeue_web_socket = RequeueTestWebSocket()
+    context.requeue_web_socket.message_queue = ClosingQueue()
+    context.requeue_web_socket.message_queue.web_socket = context.requeue_web_socket
+    context.requeue_web_socket.message_queue.put({"name": "first"})
+    context.requeue_web_socket.message_queue.put({"name": "second"})
+
+
+@when("the web socket is closed just after it has taken the first message from the queue")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.requeue_web_socket.monitor_message_queue_thread = threading.Thread()
+    context.requeue_web_socket.monitor_message_queue_thread.terminated = False
+    context.requeue_web_socket.monitor_message_queue()
+
+
+@then("the messages should still be queued in the order first and second")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _queue = context.requeue_web_socket.message_queue
+    _names = [_queue.get_nowait()["name"] for _curr_index in range(_queue.qsize())]
+    ok_(_names == ["first", "second"], "Wrong order: " + str(_names))
+    ok_(context.requeue_web_socket.messages == [], "The closed web socket sent a message")
+
+
+class CompressTestWebSocket(OptimalWebSocket):
+    """
+    Records the frames sent by it, and how it was closed
+    """
+    def __init__(self, _compressor):
+        self.compressor = _compressor
+        self.log_prefix = "CompressTestWebSocket: "
+        self.frames = []
+        self.closed_code = None
+
+    def send(self, payload, binary=False):
+        self.frames.append((payload, binary))
+
+    def close(self, code=1000, reason=''):
+        self.closed_code = code
+
+
+@then("a binary frame from a web socket (?P<negotiated>with|without) compression negotiated, that decompresses to "
+      "(?P<size>[0-9]+) bytes, should close it as unacceptable data, with a maximum size of (?P<max_size>[0-9]+) bytes")
+def step_impl(context, negotiated, size, max_size):
+    """
+    :type context behave.runner.Context
+    """
+    _web_socket = CompressTestWebSocket(Compressor(_max_decompressed_size=int(max_size))
+                                        if negotiated == "with" else None)
+    _web_socket.received_message(BinaryMessage(zlib.compress(json.dumps({"data": "x" * int(size)}).encode())))
+    ok_(_web_socket.closed_code == UNACCEPTABLE_DATA, "The web socket was not closed as unacceptable data, code: " +
+        str(_web_socket.closed_code))
+
+
+@then("a compressed payload that decompresses to at most (?P<max_size>[0-9]+) bytes should be decompressed")
+def step_impl(context, max_size):
+    """
+    :type context behave.runner.Context
+    """
+    _payload = json.dumps({"data": "x" * (int(max_size) - 20)}).encode()
+    ok_(len(_payload) <= int(max_size))
+    ok_(Compressor(_max_decompressed_size=int(max_size)).decompress(zlib.compress(_payload)) == _payload)
+
+
+@given("a web socket that compresses messages of (?P<threshold>[0-9]+) bytes or more")
+def step_impl(context, threshold):
+    """
+    :type context behave.runner.Context
+    """
+    context.compress_web_socket = CompressTestWebSocket(Compressor(_threshold=int(threshold)))
+
+
+@when("a small and a large message are sent using the web socket")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.compress_messages = [
+        {"schemaRef": "ref://of.message.message", "destination": "destination_peer", "messageId": 1},
+        {"schemaRef": "ref://of.log.process_state", "state": "running",
+         "items": [{"name": "Item " + str(_curr_index), "state": "running"} for _curr_index in range(100)]}
+    ]
+    for _curr_message in context.compress_messages:
+        context.compress_web_socket.send_message(_curr_message)
+
+
+@then("the small message should have been sent as text and the large compressed as binary")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _small, _large = context.compress_web_socket.frames
+    ok_(not _small[1] and json.loads(_small[0].decode()) == context.compress_messages[0])
+    ok_(_large[1] and json.loads(decompress_frame(_large[0]).decode()) == context.compress_messages[1])
+
+
+@then("the compression metrics should show the bytes saved")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _metrics = context.compress_web_socket.compressor.metrics()
+    print("Compression metrics: " + str(_metrics))
+    ok_(_metrics["compressed"] == 1 and _metrics["uncompressed"] == 1)
+    ok_(_metrics["bytesSaved"] > 0 and _metrics["bytesSaved"] == _metrics["bytesIn"] - _metrics["bytesOut"])
+    ok_(_metrics["bytesOut"] == len(context.compress_web_socket.frames[1][0]))
+
+
+@given("a peer sends a compressed message to another")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.message = {"destination": "destination_peer", "schemaRef": "ref://of.message.message",
+                       "sourceProcessId": str(ObjectId()), "source": "source_peer", "messageId": 4}
+    # Binary frames are only accepted from peers that have negotiated compression
+    context.sender.compressor = Compressor()
+    try:
+        context.sender.received_message(BinaryMessage(zlib.compress(json.dumps(context.message).encode())))
+    finally:
+        context.sender.compressor = None
+
+
+@given("(?P<count>[0-9]+) batching peers are connected to a send loop with a batch delay of (?P<delay>[0-9.]+) seconds")
+def step_impl(context, count, delay):
+    """
+    :type context behave.runner.Context
+    """
+    context.test_send_loop = SendLoop(_batch_delay=float(delay))
+    context.send_test_peers = []
+    for _curr_index in range(int(count)):
+        _web_socket = SendTestWebSocket("peer_" + str(_curr_index))
+        _web_socket.message_queue = SendQueue(context.test_send_loop, _batching=True)
+        _web_socket.message_queue.attach(_web_socket)
+        context.send_test_peers.append(_web_socket)
+
+
+@then("each peer should have been sent a single frame")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    for _curr_peer in context.send_test_peers:
+        ok_(_curr_peer.frames == 1, _curr_peer.address + " was sent " + str(_curr_peer.frames) + " frames")
+
+
+@given("a peer sends a batch of (?P<count>[0-9]+) messages to another")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    context.batch_messages = [{"destination": "destination_peer", "schemaRef": "ref://of.message.message",
+                               "sourceProcessId": str(ObjectId()), "source": "source_peer", "messageId": _curr_index}
+                              for _curr_index in range(int(count))]
+    context.batch_received = []
+    context.receiver.on_message = lambda _web_socket, _message: context.batch_received.append(_message)
+    context.sender.received_message(json.dumps(context.batch_messages))
+
+
+@then("all messages of the batch should be received in order")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    time.sleep(0.1)
+    context.receiver.on_message = None
+    ok_(context.batch_received == context.batch_messages, "Received: " + str(context.batch_received))
+
+
+@when("(?P<count>[0-9]+) messages are queued for each peer")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    context.send_test_count = int(count)
+    _threads_before = threading.active_count()
+    _started = time.perf_counter()
+    for _curr_index in range(int(count)):
+        for _curr_peer in context.send_test_peers:
+            _curr_peer.message_queue.put({"index": _curr_index})
+
+    _expected = int(count) * len(context.send_test_peers)
+    while context.test_send_loop.metrics()["sent"] < _expected and time.perf_counter() - _started < 30:
+        time.sleep(0.01)
+    print("Sending " + str(_expected) + " messages took " + str(round(time.perf_counter() - _started, 4)) +
+          " seconds. Metrics: " + str(context.test_send_loop.metrics()))
+    ok_(threading.active_count() == _threads_before, "Threads were started to send the messages")
+    context.test_send_loop.stop()
+
+
+@then("every peer should have received its messages in order")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    for _curr_peer in context.send_test_peers:
+        ok_(_curr_peer.messages == [{"index": _curr_index} for _curr_index in range(context.send_test_count)],
+            _curr_peer.address + " did not receive its messages in order: " + str(_curr_peer.messages))
+
+
+@then("no more than (?P<threads>[0-9]+) threads should have sent the messages")
+def step_impl(context, threads):
+    """
+    :type context behave.runner.Context
+    """
+    _threads = set()
+    for _curr_peer in context.send_test_peers:
+        _threads.update(_curr_peer.threads)
+    ok_(len(_threads) <= int(threads), "Messages were sent by " + str(_threads))
+
+
+@given("a peer that is not receiving has a send queue of (?P<count>[0-9]+) messages with the close policy")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    context.test_send_loop = SendLoop()
+    context.send_test_block = threading.Event()
+    context.slow_peer = SendTestWebSocket("slow_peer", _block=context.send_test_block)
+    context.slow_peer.message_queue = SendQueue(context.test_send_loop, _max_size=int(count), _policy=POLICY_CLOSE)
+    context.slow_peer.message_queue.attach(context.slow_peer)
+
+
+@when("(?P<count>[0-9]+) messages are queued for the peer")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    # The first message is taken by the send loop, which is then blocked sending it
+    context.slow_peer.message_queue.put({"index": -1})
+    while context.slow_peer.message_queue.messages:
+        time.sleep(0.001)
+    for _curr_index in range(int(count)):
+        context.slow_peer.message_queue.put({"index": _curr_index})
+
+
+@then("the web socket of the peer should have been closed as a slow consumer")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.send_test_block.set()
+    context.test_send_loop.stop()
+    ok_(context.slow_peer.closed_code == SLOW_CONSUMER, "The slow peer was not closed: " +
+        str(context.slow_peer.closed_code))
+
+
+@then("(?P<count>[0-9]+) messages should have been dropped")
+def step_impl(context, count):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.slow_peer.message_queue.dropped == int(count),
+        "Expected " + count + " dropped messages, got " + str(context.slow_peer.message_queue.dropped))
+
+
+@given("the broker uses the asyncio engine")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.threaded_monitor = of.common.messaging.websocket.monitor
+    of.common.messaging.websocket.monitor = AsyncMonitor(_handler=context.threaded_monitor.handler)
+
+
+@then("the broker goes back to the threaded engine")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _async_monitor = of.common.messaging.websocket.monitor
+    # Only stop the event loop, the handler and its web sockets are shared with the threaded monitor
+    _async_monitor.stop_loop()
+    of.common.messaging.websocket.monitor = context.threaded_monitor
+    ok_(_async_monitor.metrics()["handled"] == 1 and _async_monitor.metrics()["errors"] == 0,
+        "Unexpected metrics: " + str(_async_monitor.metrics()))
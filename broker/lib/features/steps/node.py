@@ -1,15 +1,24 @@
 """
 Tests for The MBE Node feature
 """
+import copy
 import os
 
+import cherrypy
+
+from bson.objectid import ObjectId
+
 from behave import *
 import json
 from nose.tools.trivial import ok_
 
 from of.broker.lib.features.test_resources import test_node
 from of.common.security.groups import RightCheckError
+import of.common.security.groups
+from of.common.security.permission import filter_by_group
 from of.broker.lib.schema_mongodb import of_object_id
+from of.broker.lib.node import compile_conditions, encode_continuation
+from of.broker.cherrypy_api.node import page_options, start_iteration, stream_json_array
 
 script_location = os.path.dirname(__file__)
 
@@ -88,6 +97,67 @@ def step_impl(context):
     context.node.remove({"_id": context.curr_id}, context.user)
 
 
+@given("a test tree with (?P<children>[0-9]+) children having (?P<grandchildren>[0-9]+) children each is added")
+def step_impl(context, children, grandchildren):
+    """
+
+    :type context behave.runner.Context
+
+    """
+
+    def _add_node(_name, _parent_id):
+        _node = copy.deepcopy(test_node)
+        _node["name"] = _name
+        _node["parent_id"] = _parent_id
+        _id = context.node.save(_node, context.user)
+        context.test_tree_ids.append(_id)
+        return _id
+
+    context.test_tree_ids = []
+    _root_id = _add_node("test_tree_root", test_node["parent_id"])
+    for _curr_child in range(int(children)):
+        _child_id = _add_node("test_tree_child_" + str(_curr_child), _root_id)
+        for _curr_grandchild in range(int(grandchildren)):
+            _add_node("test_tree_grandchild_" + str(_curr_child) + "_" + str(_curr_grandchild), _child_id)
+
+
+@given("the root of the test tree is removed")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    context.node.remove({"_id": context.test_tree_ids[0]}, context.user)
+
+
+@then("none of the nodes of the test tree should be in the database")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _result = context.node.find({"_id": {"$in": [of_object_id(_curr_id) for _curr_id in context.test_tree_ids]}},
+                                context.user)
+    ok_(len(_result) == 0, "Nodes of the test tree remain: " + str(_result))
+
+
+@then("each node of the test tree should have a remove history item")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _removed_ids = [_curr_event["node_id"] for _curr_event in context.node.database_access.find(
+        {"conditions": {"category": "remove",
+                        "node_id": {"$in": [of_object_id(_curr_id) for _curr_id in context.test_tree_ids]}},
+         "collection": "log"})]
+    ok_(sorted(_removed_ids) == sorted(context.test_tree_ids), "Expected one remove event per node, got " +
+        str(_removed_ids))
+
+
 @then("the node should not be in the database")
 def step_impl(context):
     """
@@ -208,6 +278,63 @@ def step_impl(context):
     ok_(False)
 
 
+@then("the children loaded must be the same as when filtering the children in python")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _all_children = context.node.database_access.find(
+        {"conditions": {"parent_id": of_object_id("000000010000010001e64c24")}, "collection": "node"})
+    _expected = [_curr_node["_id"] for _curr_node in
+                 filter_by_group(_all_children, "canRead", context.user, context.node.database_access)]
+    _loaded = [_curr_node["_id"] for _curr_node in context.node.load_children("000000010000010001e64c24",
+                                                                               context.user)]
+    ok_(len(_expected) < len(_all_children), "The test user should not be able to read all children")
+    ok_(sorted(_loaded) == sorted(_expected), "The database and python filtering differ")
+
+
+@then("loading the children (?P<limit>[0-9]+) at a time, the pages must together match the complete list")
+def step_impl(context, limit):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _expected = [_curr_node["_id"] for _curr_node in context.node.load_children("000000010000010001e64c24",
+                                                                                 context.user)]
+    _loaded = []
+    _page = {"limit": int(limit), "count": True}
+    while True:
+        _result = context.node.load_children("000000010000010001e64c24", context.user, _page=_page)
+        ok_(len(_result["items"]) <= int(limit), "A page had more items than the limit")
+        ok_(_result["total"] == len(_expected), "The total didn't match the number of children")
+        _loaded += [_curr_node["_id"] for _curr_node in _result["items"]]
+        if _result["continuation"] is None:
+            break
+        _page = {"limit": int(limit), "continuation": _result["continuation"], "count": True}
+
+    ok_(sorted(_loaded) == sorted(_expected), "The pages didn't match the complete list of children")
+    ok_(len(_loaded) == len(set(_loaded)), "The pages overlapped")
+
+
+@then("paging a lookup of the children must only return values and texts")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _result = context.node.lookup(
+        {"conditions": {"parent_id": of_object_id("000000010000010001e64c24")}, "collection": "node"}, context.user,
+        _page={"limit": 1})
+    ok_(len(_result["items"]) == 1, "Expected exactly one item in the page")
+    ok_(set(_result["items"][0].keys()) == {"value", "text"}, "Expected only value and text")
+    ok_(_result["continuation"] is not None, "Expected a continuation token for the next page")
+    ok_("total" not in _result, "The total should only be returned when asked for")
+
+
 @then("trying to remove a node, a PermissionError should be raised")
 def step_impl(context):
     """
@@ -271,4 +398,181 @@ def step_impl(context):
     """
     :type context: behave.runner.Context
     """
-    ok_(context.loaded_templates[0]["description"] == "Broker template")
\ No newline at end of file
+    ok_(context.loaded_templates[0]["description"] == "Broker template")
+
+
+@given("a condition with ObjectId strings in nested dicts and lists")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.compile_input = {
+        "$and": [
+            {"parent_id": "ObjectId(000000010000010001e64c30)"},
+            {"name": {"$in": ["Root", "Test"]}, "systemPid": 10000, "active": True},
+            {"_id": {"$in": ["ObjectId(000000010000010001e64c31)", "000000010000010001e64c32"]}}
+        ],
+        "schemaRef": "ref://of.node.node"
+    }
+    context.compile_original = copy.deepcopy(context.compile_input)
+
+
+@when("the condition is compiled")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.compile_result = compile_conditions(context.compile_input)
+
+
+@then("the ObjectId strings should have been replaced by ObjectId instances")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.compile_result == {
+        "$and": [
+            {"parent_id": ObjectId("000000010000010001e64c30")},
+            {"name": {"$in": ["Root", "Test"]}, "systemPid": 10000, "active": True},
+            {"_id": {"$in": [ObjectId("000000010000010001e64c31"), "000000010000010001e64c32"]}}
+        ],
+        "schemaRef": "ref://of.node.node"
+    }, "Wrong result: " + str(context.compile_result))
+
+
+@then("the parts of the condition without ObjectId strings should be shared with the input")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.compile_result is not context.compile_input)
+    ok_(context.compile_result["$and"][1] is context.compile_input["$and"][1])
+    _unchanged = {"name": {"$in": ["Root"]}}
+    ok_(compile_conditions(_unchanged) is _unchanged)
+
+
+@then("the input condition should be unchanged")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(context.compile_input == context.compile_original)
+
+
+@then("starting to stream nodes the user may not read should raise a PermissionError at once")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _iterator = context.node.find_iter({"_id": of_object_id("000000010000010001e64d01")}, context.user,
+                                       _error_prefix_if_not_allowed="Test stream: ")
+    try:
+        start_iteration(_iterator)
+    except PermissionError:
+        ok_(True)
+        return
+
+    ok_(False, "start_iteration did not raise the error of the first node")
+
+
+@step("the streamed children should be the same as the loaded children")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _expected = context.node.load_children("000000010000010001e64c24", context.user)
+    _streamed = json.loads(b"".join(stream_json_array(start_iteration(context.node.find_iter(
+        {"parent_id": of_object_id("000000010000010001e64c24")}, context.user)))).decode())
+    ok_(len(_expected) > 0, "There should be children to stream")
+    ok_(sorted([_curr_node["_id"] for _curr_node in _streamed]) ==
+        sorted([_curr_node["_id"] for _curr_node in _expected]), "The streamed children differ")
+    _empty = b"".join(stream_json_array(start_iteration(context.node.find_iter(
+        {"parent_id": of_object_id("000000000000000000000000")}, context.user))))
+    ok_(_empty == b"[]", "An empty result should be streamed as an empty array, got " + str(_empty))
+
+
+@then("finding and iterating nodes should each check the rights once")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _has_right = of.common.security.groups.has_right
+    _checks = []
+
+    def _counting_has_right(*args, **kwargs):
+        _checks.append(args)
+        return _has_right(*args, **kwargs)
+
+    of.common.security.groups.has_right = _counting_has_right
+    try:
+        _found = context.node.find({"parent_id": of_object_id("000000010000010001e64c24")}, context.user)
+        _find_checks = len(_checks)
+        _checks.clear()
+        _iterated = list(context.node.find_iter({"parent_id": of_object_id("000000010000010001e64c24")},
+                                                context.user))
+        _find_iter_checks = len(_checks)
+    finally:
+        of.common.security.groups.has_right = _has_right
+
+    ok_(len(_found) > 0 and _found == _iterated, "find and find_iter returned different nodes")
+    ok_(_find_checks == 1, "find checked the rights " + str(_find_checks) + " times")
+    ok_(_find_iter_checks == 1, "find_iter checked the rights " + str(_find_iter_checks) + " times")
+
+
+@then("paging options with the limits 0, -1, ten and an empty string should be rejected with a 400 status")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    for _curr_limit in ["0", "-1", "ten", ""]:
+        try:
+            page_options({"limit": _curr_limit})
+        except cherrypy.HTTPError as e:
+            ok_(e.status == 400, "Wrong status for limit " + repr(_curr_limit) + ": " + str(e.status))
+            continue
+        ok_(False, "The limit " + repr(_curr_limit) + " was accepted")
+
+
+@step("paging options with the limit 10 should be accepted")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    ok_(page_options({"limit": "10"}) == {"limit": 10})
+
+
+@then("paging options with a malformed continuation token should be rejected with a 400 status")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    for _curr_continuation in ["not a token", encode_continuation("not an ObjectId"), "%%%"]:
+        try:
+            page_options({"continuation": _curr_continuation})
+        except cherrypy.HTTPError as e:
+            ok_(e.status == 400, "Wrong status for the token " + repr(_curr_continuation) + ": " + str(e.status))
+            continue
+        ok_(False, "The token " + repr(_curr_continuation) + " was accepted")
+
+
+@step("paging options with the continuation token of a page should be accepted")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _continuation = encode_continuation(ObjectId())
+    ok_(page_options({"continuation": _continuation}) == {"continuation": _continuation})
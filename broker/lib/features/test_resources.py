@@ -1,4 +1,5 @@
 import hashlib
+from pymongo import monitoring
 from pymongo.mongo_client import MongoClient
 from of.broker.lib.access import DatabaseAccess
 
@@ -66,4 +67,29 @@ def get_empty_db_da(_database_name, _json_schema_folder):
     if _database_name in _client.database_names():
         _client.drop_database(_client[_database_name])
     _database = _client[_database_name]
-    return DatabaseAccess(_json_schema_folder=None,  _database=_database)
\ No newline at end of file
+    return DatabaseAccess(_json_schema_folder=None,  _database=_database)
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the commands sent to the database server, each command is one round trip.
+    Must be registered using pymongo.monitoring.register before the client is created.
+    """
+    commands = None
+
+    def __init__(self):
+        self.commands = []
+
+    def reset(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+command_counter = CommandCounter()
@@ -0,0 +1,140 @@
+"""
+The indexes module manages the MongoDB indexes of the broker.
+
+Schemas declare the indexes of their collection using the "indexes" key, a list of index declarations:
+    "indexes": [
+        {"keys": [["parent_id", 1], ["canRead", 1]]},
+        {"keys": [["address", 1]], "unique": false, "name": "address_lookup"}
+    ]
+"keys" is a list of field name and direction pairs, all other properties are passed as options to MongoDB.
+
+Created on Oct 18, 2026
+
+@author: Nicklas Boerjesson
+"""
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from of.common.logging import write_to_log, EC_SERVICE, SEV_DEBUG, SEV_WARNING
+
+__author__ = 'Nicklas Borjesson'
+
+
+def index_name(_keys):
+    """
+    Generate an index name from its keys, the same way as MongoDB does.
+
+    :param _keys: A list of field name and direction pairs
+    :return: The index name
+    """
+    return "_".join([str(_curr_field) + "_" + str(_curr_direction) for _curr_field, _curr_direction in _keys])
+
+
+def schema_indexes(_schema_tools):
+    """
+    Gather the index declarations of all loaded schemas, by collection. Declarations with the same name are only
+    included once.
+
+    :param _schema_tools: A SchemaTools instance
+    :return: A dict of collection names and their lists of index declarations, with names and keys as tuples
+    """
+    _result = {}
+    for _curr_schema_ref, _curr_schema in _schema_tools.json_schema_objects.items():
+        if "indexes" not in _curr_schema:
+            continue
+        _collection = _curr_schema.get("collection")
+        if not _collection or _collection == "*":
+            raise Exception("schema_indexes: The " + _curr_schema_ref +
+                            " schema declares indexes, but does not specify a collection")
+
+        _collection_indexes = _result.setdefault(_collection, [])
+        for _curr_declaration in _curr_schema["indexes"]:
+            if "keys" not in _curr_declaration or len(_curr_declaration["keys"]) == 0:
+                raise Exception("schema_indexes: An index in the " + _curr_schema_ref + " schema has no keys")
+            _declaration = dict(_curr_declaration)
+            _declaration["keys"] = [(_curr_field, _curr_direction) for _curr_field, _curr_direction in
+                                    _curr_declaration["keys"]]
+            if "name" not in _declaration:
+                _declaration["name"] = index_name(_declaration["keys"])
+
+            if _declaration["name"] not in [_curr_index["name"] for _curr_index in _collection_indexes]:
+                _collection_indexes.append(_declaration)
+
+    return _result
+
+
+def ensure_indexes(_database, _schema_tools, _process_id=None):
+    """
+    Create the indexes declared by the schemas, if they do not exist. Existing indexes are left as they are, so this
+    can be called at every start up.
+
+    :param _database: A MongoDB database
+    :param _schema_tools: A SchemaTools instance
+    :param _process_id: The process id used when logging
+    :return: A dict of collection names and the names of their declared indexes
+    """
+    _result = {}
+    for _curr_collection, _curr_declarations in schema_indexes(_schema_tools).items():
+        _models = []
+        for _curr_declaration in _curr_declarations:
+            _options = dict(_curr_declaration)
+            _keys = _options.pop("keys")
+            _models.append(IndexModel(_keys, **_options))
+        try:
+            _result[_curr_collection] = _database[_curr_collection].create_indexes(_models)
+        except OperationFailure as e:
+            # Most likely an existing index with the same name but other keys or options
+            write_to_log("ensure_indexes: Failed to create the indexes of the " + _curr_collection +
+                         " collection, error: " + str(e), _category=EC_SERVICE, _severity=SEV_WARNING,
+                         _process_id=_process_id)
+            continue
+
+        write_to_log("ensure_indexes: Ensured indexes for the " + _curr_collection + " collection: " +
+                     ", ".join(_result[_curr_collection]), _category=EC_SERVICE, _severity=SEV_DEBUG,
+                     _process_id=_process_id)
+
+    return _result
+
+
+def index_report(_database, _schema_tools):
+    """
+    Compare the declared indexes with those in the database.
+
+    :param _database: A MongoDB database
+    :param _schema_tools: A SchemaTools instance
+    :return: A dict with:
+        missing: The declared indexes that do not exist in the database
+        unused: The indexes that have not been used since the database server started, according to $indexStats.
+            For collections where the statistics are not available, an item with an error is added instead.
+        undeclared: The indexes in the database that no schema declares, except for the _id index
+    """
+    _missing = []
+    _unused = []
+    _undeclared = []
+    _declared_indexes = schema_indexes(_schema_tools)
+    _collections = _database.list_collection_names(filter={"name": {"$regex": r"^(?!system\.)"}})
+    for _curr_collection in sorted(set(_collections) | set(_declared_indexes.keys())):
+        _existing = _database[_curr_collection].index_information()
+        _declared_names = []
+        for _curr_declaration in _declared_indexes.get(_curr_collection, []):
+            _declared_names.append(_curr_declaration["name"])
+            if _curr_declaration["name"] not in _existing:
+                _missing.append({"collection": _curr_collection, "name": _curr_declaration["name"],
+                                 "keys": _curr_declaration["keys"]})
+
+        for _curr_name in _existing.keys():
+            if _curr_name != "_id_" and _curr_name not in _declared_names:
+                _undeclared.append({"collection": _curr_collection, "name": _curr_name})
+
+        try:
+            for _curr_stats in _database[_curr_collection].aggregate([{"$indexStats": {}}]):
+                if _curr_stats["name"] != "_id_" and _curr_stats["accesses"]["ops"] == 0:
+                    _unused.append({"collection": _curr_collection, "name": _curr_stats["name"],
+                                    "since": str(_curr_stats["accesses"]["since"])})
+        except Exception as e:
+            # $indexStats is only available from MongoDB 3.2
+            _unused.append({"collection": _curr_collection, "name": None,
+                            "error": "Index statistics not available: " + str(e)})
+
+    return {"missing": _missing, "unused": _unused, "undeclared": _undeclared}
@@ -5,6 +5,11 @@ Created on Mar 18, 2016
 @author: Nicklas Boerjesson
 """
 import datetime
+import threading
+import time
+from queue import Queue, Empty, Full
+
+from bson import BSON
 
 from of.broker.lib.schema_mongodb import of_object_id
 
@@ -75,12 +80,164 @@ class DictDiffer(object):
                    if self.past_dict[o] == self.current_dict[o])
 
 
+class LogWriterThread(threading.Thread):
+    def __init__(self, _log_writer):
+        super(LogWriterThread, self).__init__(target=_log_writer.run, name="Log writer thread", daemon=True)
+
+
+class LogWriter(object):
+    """
+    The log writer writes events to the "log" collection in the background, in batches.
+    Events are queued in a bounded buffer and written using insert_many when either max_batch_size events have been
+    queued or max_delay seconds has passed since the first event in the batch was queued.
+    If the buffer is full, the caller waits for at most put_timeout seconds, and then writes the events itself, so that
+    events are never dropped.
+    """
+
+    #: The collection to write to
+    collection = None
+    #: The buffer of events waiting to be written, holds lists of BSON-encoded events
+    queue = None
+    #: The maximum number of events written in one insert_many
+    max_batch_size = None
+    #: The longest time, in seconds, an event is kept in the buffer before it is written
+    max_delay = None
+    #: The longest time, in seconds, a caller waits for room in a full buffer before writing the events itself
+    put_timeout = None
+    #: Called with the events and the exception if a batch could not be written
+    on_write_error = None
+    #: The thread that writes the events
+    writer_thread = None
+    #: Metrics, the number of events and batches written, of failed events and of times the buffer was full
+    written = None
+    batches = None
+    failed = None
+    full = None
+
+    def __init__(self, _collection, _max_batch_size=500, _max_delay=0.5, _max_buffer_size=10000, _put_timeout=1,
+                 _on_write_error=None):
+        """
+        Initialize and start the log writer
+
+        :param _collection: The collection to write to
+        :param _max_batch_size: The maximum number of events written in one insert_many
+        :param _max_delay: The longest time, in seconds, an event is kept in the buffer before it is written
+        :param _max_buffer_size: The maximum number of writes waiting in the buffer
+        :param _put_timeout: How long, in seconds, a caller waits for room in a full buffer
+        :param _on_write_error: Called with the events and the exception if a batch could not be written
+
+        """
+        self.collection = _collection
+        self.queue = Queue(maxsize=_max_buffer_size)
+        self.max_batch_size = _max_batch_size
+        self.max_delay = _max_delay
+        self.put_timeout = _put_timeout
+        self.on_write_error = _on_write_error
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.full = 0
+        self.writer_thread = LogWriterThread(_log_writer=self)
+        self.writer_thread.start()
+
+    def put(self, _events):
+        """
+        Queue events for writing. The events are encoded immediately, so the caller is free to change them afterwards.
+
+        :param _events: A list of events
+
+        """
+        _encoded = [BSON.encode(_curr_event) for _curr_event in _events]
+        try:
+            self.queue.put(_encoded, True, self.put_timeout)
+        except Full:
+            # The writer cannot keep up, write on the callers' thread instead, which slows the caller down
+            self.full += 1
+            self._write(_encoded)
+
+    def _write(self, _encoded):
+        """
+        Write encoded events to the database
+        """
+        _events = [BSON(_curr_event).decode() for _curr_event in _encoded]
+        try:
+            self.collection.insert_many(_events, ordered=False)
+            self.written += len(_events)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(_events)
+            if self.on_write_error:
+                self.on_write_error(_events, e)
+
+    def run(self):
+        """
+        Writes queued events until woken up by the None that stop() puts on the queue. Events are never None.
+        """
+        _stopping = False
+        while not _stopping:
+            _batch = self.queue.get()
+            if _batch is None:
+                # Woken up to stop by stop()
+                break
+
+            _deadline = time.monotonic() + self.max_delay
+            while len(_batch) < self.max_batch_size:
+                try:
+                    _events = self.queue.get(True, max(_deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+                if _events is None:
+                    _stopping = True
+                    break
+                _batch.extend(_events)
+
+            self._write(_batch)
+
+    def stop(self, _timeout=None):
+        """
+        Stop the writer after all queued events have been written
+
+        :param _timeout: The longest time, in seconds, to wait for the events to be written, including waiting for
+            room on a full queue to wake the writer up
+        :return: True if all events were written before the writer stopped
+
+        """
+        _deadline = None if _timeout is None else time.monotonic() + _timeout
+        # Wake the writer up, it blocks while waiting for events. Wait for room, so that this is never lost.
+        try:
+            self.queue.put(None, True, _timeout)
+        except Full:
+            return False
+        self.writer_thread.join(None if _deadline is None else max(_deadline - time.monotonic(), 0))
+        if self.writer_thread.is_alive():
+            return False
+
+        # Events queued while the writer was stopping, a None is left by an earlier call to stop
+        _batch = []
+        while not self.queue.empty():
+            _events = self.queue.get_nowait()
+            if _events is not None:
+                _batch.extend(_events)
+        if _batch:
+            self._write(_batch)
+        return True
+
+    def metrics(self):
+        """
+        Returns the metrics of the writer
+        """
+        return {"written": self.written, "batches": self.batches, "failed": self.failed, "full": self.full,
+                "queued": self.queue.qsize()}
+
+
 class Logging():
     """
     The logging class provides functionality to properly write to the "log" collection
     """
     database = None
     _log_collection = None
+    #: If set, the background writer that events are queued to, see start_writer
+    writer = None
 
     def __init__(self, _database):
         """
@@ -134,17 +291,66 @@ class Logging():
 
 
 
-    def write_log(self, _event):
+    def start_writer(self, _max_batch_size=500, _max_delay=0.5, _max_buffer_size=10000, _put_timeout=1,
+                     _on_write_error=None):
+        """
+        Start writing events in the background, see LogWriter for the parameters.
+        Security events are still written directly, unless explicitly queued.
+
+        """
+        if self.writer:
+            raise Exception("Logging.start_writer: The log writer is already running")
+        self.writer = LogWriter(_collection=self._log_collection, _max_batch_size=_max_batch_size,
+                                _max_delay=_max_delay, _max_buffer_size=_max_buffer_size, _put_timeout=_put_timeout,
+                                _on_write_error=_on_write_error)
+
+    def stop_writer(self, _timeout=None):
+        """
+        Write all queued events and stop writing in the background. Subsequent events are written directly.
+
+        :param _timeout: The longest time, in seconds, to wait for the queued events to be written
+        :return: True if all queued events were written
+
+        """
+        if not self.writer:
+            return True
+        _writer = self.writer
+        self.writer = None
+        return _writer.stop(_timeout)
+
+    def write_log(self, _event, _synchronous=False):
         """
         Writes an event to the database
 
         :param _event: The event data
+        :param _synchronous: If set, the event is written before returning even if the background writer is running
 
         """
         _event["writtenWhen"] = str(datetime.datetime.utcnow())
-        self._log_collection.insert_one(_event)
+        if self.writer and not _synchronous:
+            self.writer.put([_event])
+        else:
+            self._log_collection.insert_one(_event)
+
+    def write_logs(self, _events, _synchronous=False):
+        """
+        Writes a list of events to the database in one operation
+
+        :param _events: A list of events
+        :param _synchronous: If set, the events are written before returning even if the background writer is running
+
+        """
+        if not _events:
+            return
+        _written_when = str(datetime.datetime.utcnow())
+        for _event in _events:
+            _event["writtenWhen"] = _written_when
+        if self.writer and not _synchronous:
+            self.writer.put(_events)
+        else:
+            self._log_collection.insert_many(_events)
 
-    def log_security(self, _category, _message, _user_id, _node_id):
+    def log_security(self, _category, _message, _user_id, _node_id, _synchronous=True):
         """
         Creates an security event log item
 
@@ -152,6 +358,7 @@ class Logging():
         :param _message: Error message
         :param _user_id: The _id of the user. A string(not the ObjectId)
         :param _node_id: If applicable, the concerned node document
+        :param _synchronous: Write the event before returning, even if the background writer is running (default)
         :return:
 
         """
@@ -159,7 +366,7 @@ class Logging():
         _event["category"] = _category
         _event["severity"] = "user"
         _event["data"] = _message
-        self.write_log(_event)
+        self.write_log(_event, _synchronous=_synchronous)
 
     def log_save(self, _document, _user_id, _old_document=None):
         """
@@ -169,6 +376,18 @@ class Logging():
         :param _user_id: The _id of the user. A string(not the ObjectId)
         :param _old_document: The previous version
 
+        """
+        self.write_log(self.make_save_event(_document, _user_id, _old_document))
+
+    def make_save_event(self, _document, _user_id, _old_document=None):
+        """
+        Creates, but does not write, an event item based on the differences between the provided documents
+
+        :param _document: The new version of the document
+        :param _user_id: The _id of the user. A string(not the ObjectId)
+        :param _old_document: The previous version
+        :return: An "add" or a "change" event
+
         """
 
         # Overwrite existing value?
@@ -184,7 +403,7 @@ class Logging():
             _event["add"] = _document
             _event["category"] = "add"
 
-        self.write_log(_event)
+        return _event
 
     def log_remove(self, _removed_document, _user_id):
         """
@@ -195,10 +414,31 @@ class Logging():
 
         """
 
+        self.write_log(self.make_remove_event(_removed_document, _user_id))
+
+    def log_remove_many(self, _removed_documents, _user_id):
+        """
+        Writes "remove" events for several removed documents at once.
+
+        :param _removed_documents: A list of the removed documents.
+        :param _user_id: The _id of the user. A string(not the ObjectId)
+
+        """
+        self.write_logs([self.make_remove_event(_curr_document, _user_id) for _curr_document in _removed_documents])
+
+    def make_remove_event(self, _removed_document, _user_id):
+        """
+        Creates a "remove" event, without writing it.
+
+        :param _removed_document: The removed document.
+        :param _user_id: The _id of the user. A string(not the ObjectId)
+        :return: A "remove" event
+
+        """
         _event = self._generate_node_event_skeleton(_user_id, str(datetime.datetime.utcnow()),
-                                               _removed_document["_id"])
+                                                    _removed_document["_id"])
         _event["remove"] = _removed_document
         _event["category"] = "remove"
-        self.write_log(_event)
+        return _event
 
 
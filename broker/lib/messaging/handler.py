@@ -8,11 +8,31 @@ Created on Jan 22, 2016
 from of.common.logging import write_to_log, EC_COMMUNICATION, SEV_INFO, SEV_DEBUG, EC_NOTIFICATION, SEV_ERROR
 from of.common.messaging.constants import UNACCEPTABLE_DATA, BROKER_SHUTTING_DOWN
 from of.common.messaging.handler import WebSocketHandler
-from of.schemas.constants import intercept_schema_ids
+from of.schemas.constants import intercept_schema_ids, schema_categories
 from of.broker.globals import states, states_lookup
+from of.broker.lib.access import COPY_NONE
 
 __author__ = 'Nicklas Borjesson'
 
+#: Validate messages against their full schema
+VALIDATE_FULL = "full"
+#: Only validate the routing envelope of messages, that is, schemaRef, destination, source and messageId
+VALIDATE_ENVELOPE = "envelope"
+
+
+def validate_envelope(_message_data):
+    """
+    Validate the routing envelope of a message, the properties the broker needs to pass it on.
+
+    :param _message_data: The message
+    """
+    for _curr_property in ["schemaRef", "destination", "source"]:
+        if not isinstance(_message_data.get(_curr_property), str):
+            raise Exception("validate_envelope: The " + _curr_property + " property is missing or not a string")
+    if isinstance(_message_data.get("messageId"), bool) or \
+            not isinstance(_message_data.get("messageId"), (int, float)):
+        raise Exception("validate_envelope: The messageId property is missing or not a number")
+
 
 class BrokerWebSocketHandler(WebSocketHandler):
     """
@@ -24,17 +44,26 @@ class BrokerWebSocketHandler(WebSocketHandler):
 
     #: A DatabaseAccess instance for database connectivity
     database_access = None
+    #: The validation level of incoming messages per schemaRef, VALIDATE_FULL or VALIDATE_ENVELOPE
+    validation_levels = None
+    #: The validation level of incoming messages with schemaRefs not in validation_levels
+    default_validation_level = None
 
-    def __init__(self, _process_id, _peers, _schema_tools, _address, _database_access):
+    def __init__(self, _process_id, _peers, _schema_tools, _address, _database_access, _validation_levels=None,
+                 _default_validation_level=VALIDATE_FULL):
         """
         :param _process_id: The processId of the broker
         :param _peers: A dictionary of logged in peers
         :param _schema_tools: A SchemaTools instance for validation
         :param _address: The peer address of the broker
         :param _database_access: A DatabaseAccess instance
+        :param _validation_levels: A dict of schemaRefs and the validation level of incoming messages with them
+        :param _default_validation_level: The validation level of other incoming messages
         """
         super(BrokerWebSocketHandler, self).__init__(_process_id, _peers, _schema_tools, _address)
         self.database_access = _database_access
+        self.validation_levels = _validation_levels if _validation_levels is not None else {}
+        self.default_validation_level = _default_validation_level
         # Create a handler function map based on schema categories. See of.schemas.constants
         self.category_shortcut.update({
             "process": self.handle_process,
@@ -42,22 +71,49 @@ class BrokerWebSocketHandler(WebSocketHandler):
             "message": self.handle_message,
             "control": self.handle_message
         })
+        # Plain messages are passed on in the frame they were received in
+        self.frame_shortcut.update({
+            "message": self.handle_message,
+            "control": self.handle_message
+        })
 
-    def handle_message(self, _source_web_socket, _message_data):
+    def is_blocking(self, _schema_id, _message_data):
+        """
+        Process and log messages, and intercepted messages, are written to the database.
+        """
+        return schema_categories.get(_schema_id) in ["process", "log"] or _schema_id in intercept_schema_ids
+
+    def validate_message(self, _message_data):
+        """
+        Validate an incoming message at the validation level of its schemaRef
+
+        :param _message_data: The message
+        """
+        if self.validation_levels.get(_message_data.get("schemaRef"), self.default_validation_level) == \
+                VALIDATE_ENVELOPE:
+            validate_envelope(_message_data)
+        else:
+            self.schema_tools.validate(_message_data)
+
+    def handle_message(self, _source_web_socket, _message_data, _frame=None):
         """
         Handle a message
         :param _source_web_socket: The source web socket if external
         :param _message_data: The data in the message
+        :param _frame: If set, the frame the message was received in. It is passed on as it is, instead of encoding
+            the message again.
         """
         if _source_web_socket is None:
             # Message came from internally, no need to validate.
             _message_data["source"] = self.address
         else:
-            self.schema_tools.validate(_message_data)
+            self.validate_message(_message_data)
 
         # Special case: A process result message should be intercepted and saved to the log.
         if _message_data["schemaRef"] in intercept_schema_ids:
             self.handle_logging(_source_web_socket, _message_data)
+            # Logging may have changed the message, so it has to be encoded again
+            _frame = None
 
         _destination = _message_data["destination"]
         if _destination == self.address:
@@ -75,7 +131,7 @@ class BrokerWebSocketHandler(WebSocketHandler):
             else:
                 raise KeyError("Missing or invalid destination = " + _destination)
         else:
-            _destination_session["web_socket"].queue_message(_message_data)
+            _destination_session["web_socket"].queue_message(_message_data if _frame is None else _frame)
 
     def handle_process(self, _web_socket, _process_data):
         """
@@ -85,10 +141,11 @@ class BrokerWebSocketHandler(WebSocketHandler):
         :param _process_data: The data to write.
         """
         # Handle messages that writes to the backend, like process instances
-        write_to_log("before saving process information, session: " + str(self.peers[_web_socket.session_id]),
+        write_to_log("before saving process information, session: %s", _args=(self.peers[_web_socket.session_id],),
                      _category=EC_NOTIFICATION, _severity=SEV_DEBUG, _process_id=self.process_id)
 
-        self.database_access.save(_process_data, self.peers[_web_socket.session_id]["user"], _allow_save_id=True)
+        self.database_access.save(_process_data, self.peers[_web_socket.session_id]["user"], _allow_save_id=True,
+                                  _copy_mode=COPY_NONE)
 
         write_to_log("handle_process succeeded", _category=EC_NOTIFICATION, _severity=SEV_DEBUG,
                      _process_id=self.process_id)
@@ -10,6 +10,7 @@ import time
 import cherrypy
 from ws4py.websocket import WebSocket
 
+from of.common.messaging import codec
 from of.common.messaging.websocket import OptimalWebSocket
 import of.common.messaging.websocket
 __author__ = 'Nicklas Borjesson'
@@ -36,8 +37,7 @@ class BrokerWebSocket(OptimalWebSocket, WebSocket):
         :param reason: A string describing the reason for closing the connection
         """
         self.write_dbg_info(self.log_prefix + "Told to close (session_id:" + str(self.session_id) + ") , code: " + str(code) + ", reason: " + str(reason))
-        if self.monitor_message_queue_thread:
-            self.monitor_message_queue_thread.terminated = True
+        self.stop_monitoring_message_queue()
 
         of.common.messaging.websocket.monitor.handler.unregister_web_socket(self)
 
@@ -60,6 +60,8 @@ class MockupWebSocket(BrokerWebSocket):
 
     on_message = None
     context = None
+    #: The frame of the last message, if it was forwarded as it was received
+    frame = None
 
     def __init__(self, session_id=None, context=None):
         """
@@ -97,6 +99,12 @@ class MockupWebSocket(BrokerWebSocket):
         """
             Replaces the BrokerWebSocket.send_message
         """
+        if isinstance(message, bytes):
+            # A forwarded frame, see OptimalWebSocket.send_message
+            self.frame = message
+            message = codec.decode(message)
+        else:
+            self.frame = None
         self.message = message
         self.sent_last_message_at = time.perf_counter()
         if self.on_message:
@@ -9,14 +9,19 @@ Created on Mar 18, 2016
 @author: Nicklas Boerjesson
 """
 
+import base64
+import binascii
+
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 
+from of.broker.lib.access import COPY_DEEP
 from of.broker.lib.auth_backend import MongoDBAuthBackend
 from of.common.security.authentication import init_authentication
 from of.common.security.groups import aop_has_right, init_groups
 
 from of.broker.lib.schema_mongodb import of_object_id
-from of.common.security.permission import filter_by_group
+from of.common.security.permission import filter_by_group, iter_filter_by_group, add_permission_condition
 from of.forms import load_forms_from_directory, of_form_folder, cache as form_cache
 
 
@@ -47,6 +52,65 @@ def sanitize_node(_node):
 
     return _node
 
+def compile_conditions(_conditions):
+    """
+    Compile a condition from JSON, which has no ObjectId type, into a MongoDB condition. Values using the
+    ObjectId(000000010000010001ee3214)-syntax are replaced by ObjectId instances.
+    This is done in a single pass, copy on write; only the dicts and lists where values are replaced are copied, the
+    rest is shared with the input, which is left unchanged.
+
+    :param _conditions: A condition, or any part of one
+    :return: The compiled condition
+    """
+    if isinstance(_conditions, str):
+        if _conditions[:9] == "ObjectId(":
+            return ObjectId(_conditions[9:-1])
+    elif isinstance(_conditions, dict):
+        _result = _conditions
+        for _curr_key, _curr_value in _conditions.items():
+            _compiled = compile_conditions(_curr_value)
+            if _compiled is not _curr_value:
+                if _result is _conditions:
+                    _result = dict(_conditions)
+                _result[_curr_key] = _compiled
+        return _result
+    elif isinstance(_conditions, list):
+        _result = _conditions
+        for _curr_index, _curr_value in enumerate(_conditions):
+            _compiled = compile_conditions(_curr_value)
+            if _compiled is not _curr_value:
+                if _result is _conditions:
+                    _result = list(_conditions)
+                _result[_curr_index] = _compiled
+        return _result
+
+    return _conditions
+
+
+def encode_continuation(_id):
+    """
+    Encode an _id into an opaque continuation token, used when paging through results
+
+    :param _id: The _id of the last item of a page
+    :return: A continuation token
+    """
+    return base64.urlsafe_b64encode(str(_id).encode("ascii")).decode("ascii")
+
+
+def decode_continuation(_continuation):
+    """
+    Decode a continuation token into the _id of the last item of the previous page
+
+    :param _continuation: A continuation token
+    :return: An ObjectId
+    :raises ValueError: If the token is invalid
+    """
+    try:
+        return ObjectId(base64.urlsafe_b64decode(_continuation.encode("ascii")).decode("ascii"))
+    except (binascii.Error, InvalidId, TypeError, UnicodeError, ValueError):
+        raise ValueError("decode_continuation: Invalid continuation token: " + str(_continuation))
+
+
 def get_node_rights():
     """
     This function is necessary to hand runtime data to the decorators
@@ -87,33 +151,15 @@ class Node():
         load_forms_from_directory(of_form_folder())
 
 
-    def _string_to_object_ids(self, _data):
-
-        if isinstance(_data, list):
-            _destination = []
-            for _curr_row in _data:
-                _destination.append(self._string_to_object_ids(_curr_row))
-
-            return _destination
-        elif isinstance(_data, dict):
-            _destination = {}
-            for _curr_key, _curr_value in _data.items():
-                _destination[_curr_key] = self._string_to_object_ids(_curr_value)
-            return _destination
-
-        elif _data is not None and type(_data) != ObjectId and _data[:9] == "ObjectId(":
-            return ObjectId(_data[9:-1])
-        else:
-            return _data
-
     @aop_has_right(get_node_rights)
-    def save(self, _document, _user):
+    def save(self, _document, _user, _copy_mode=COPY_DEEP):
         """save(self, _document, _user)
 
         Saves an of-node descendant to the database.
 
         :param _document: The node document to save.
         :param _user: The current user
+        :param _copy_mode: How _document is copied, see DatabaseAccess.manage_input
         :return: A structure detailing the save result
 
         """
@@ -124,7 +170,7 @@ class Node():
         if "_id" in _document:  # It is an existing node, check if user can write to it.
             _old_document_result = filter_by_group(
                 self.database_access.find(
-                    {"conditions": {"_id": of_object_id(_document["_id"])}, "collection": "node"}),
+                    {"conditions": {"_id": of_object_id(_document["_id"])}, "collection": "node"}, _trusted=True),
                 "canWrite", _user, "Node.save(existing node)")
             if len(_old_document_result) == 1:
                 _old_document = _old_document_result[0]
@@ -135,17 +181,95 @@ class Node():
         elif "parent_id" in _document:  # It is a new node, check if the parent allows user to create it
             filter_by_group(
                 self.database_access.find(
-                    {"conditions": {"_id": of_object_id(_document["parent_id"])}, "collection": "node"}),
+                    {"conditions": {"_id": of_object_id(_document["parent_id"])}, "collection": "node"},
+                    _trusted=True),
                 "canWrite", _user, "Node.save(new node)")
             _old_document = None
         else:
             raise Exception("Node.save: Data must have a parentId or an _id.")
 
         # TODO: Specify how the result actually looks
-        return self.database_access.save(_document, _user, _old_document)
+        return self.database_access.save(_document, _user, _old_document, _copy_mode=_copy_mode)
+
+    def _find_page(self, _conditions, _page, _user=None, _projection=None, _error_prefix_if_not_allowed=None,
+                   _trusted=False):
+        """
+        Returns one page of the documents matching the condition, in _id order.
+
+        :param _conditions: An MBE condition
+        :param _page: The paging options, a dict with:
+            limit: The maximum number of items in the page, 0 or missing means no limit
+            continuation: The continuation token returned with the previous page
+            fields: A list with the names of the fields to return, the _id is always returned
+            count: If true, also return the total number of matching items
+        :param _user: If set, only return documents the user has canRead permissions for
+        :param _projection: If set, a list of field names, overrides the fields of the paging options
+        :param _error_prefix_if_not_allowed: If set, the documents are checked in python instead of by the database,
+            and an error is raised for those the user lacks permissions for, see filter_by_group
+        :param _trusted: If set, the condition is built by the broker and isn't validated, see
+            DatabaseAccess.manage_conditions
+        :return: A dict with the items, the continuation token of the next page(None on the last page) and
+            if counted, the total number of items.
+
+        """
+        _limit = int(_page.get("limit", 0) or 0)
+        if _limit < 0:
+            raise Exception("Node._find_page: The limit cannot be negative, it is " + str(_limit))
+
+        # Unless errors are to be raised for unpermissioned documents, let the database filter by canRead
+        _filter_in_python = _user is not None and _error_prefix_if_not_allowed is not None
+        if _user is not None and not _filter_in_python:
+            _conditions = {"conditions": add_permission_condition(_conditions["conditions"], "canRead", _user),
+                           "collection": _conditions["collection"]}
+
+        _fields = _projection if _projection is not None else _page.get("fields")
+        _query_projection = None
+        _remove_permission_field = False
+        if _fields:
+            _query_projection = list(_fields)
+            # The canRead field is needed for the permission check
+            if _filter_in_python and "canRead" not in _query_projection:
+                _query_projection.append("canRead")
+                _remove_permission_field = True
+
+        _page_conditions = _conditions["conditions"]
+        if _page.get("continuation"):
+            _after = {"_id": {"$gt": decode_continuation(_page["continuation"])}}
+            _page_conditions = {"$and": [_page_conditions, _after]} if _page_conditions else _after
+
+        _documents = self.database_access.find_iter(
+            {"conditions": _page_conditions, "collection": _conditions["collection"]},
+            _projection=_query_projection, _sort=[("_id", 1)],
+            # Unless filtering in python, the database can limit the result, read one more to know if there is more
+            _limit=_limit + 1 if _limit and not _filter_in_python else 0, _trusted=_trusted)
+        if _filter_in_python:
+            _documents = iter_filter_by_group(_documents, "canRead", _user, self.database_access,
+                                              _error_prefix_if_not_allowed=_error_prefix_if_not_allowed)
+
+        _items = []
+        _continuation = None
+        for _curr_document in _documents:
+            if _limit and len(_items) == _limit:
+                _continuation = encode_continuation(_items[-1]["_id"])
+                break
+            if _remove_permission_field:
+                _curr_document.pop("canRead", None)
+            _items.append(_curr_document)
+
+        _result = {"items": _items, "continuation": _continuation}
+        if _page.get("count"):
+            if _filter_in_python:
+                _result["total"] = sum(1 for _curr_document in iter_filter_by_group(
+                    self.database_access.find_iter(_conditions, _projection=["canRead"], _trusted=_trusted), "canRead",
+                    _user,
+                    self.database_access, _error_prefix_if_not_allowed=_error_prefix_if_not_allowed))
+            else:
+                _result["total"] = self.database_access.count(_conditions, _trusted=_trusted)
+
+        return _result
 
     @aop_has_right(get_node_rights)
-    def find(self, _conditions, _user, _error_prefix_if_not_allowed=None):
+    def find(self, _conditions, _user, _error_prefix_if_not_allowed=None, _page=None):
         """find(_conditions,_user)
         Returns a list of nodes matching the condition.
         Note: This method is literate, it takes ObjectId instances when comparing to ObjectId instances.
@@ -154,33 +278,71 @@ class Node():
 
         :param _conditions: A condition
         :param _user: A user object
+        :param _page: If set, paging options, and a page is returned instead of a list, see _find_page
         :return: A list of nodes
 
 
         """
 
+        if _page is not None:
+            return self._find_page({"conditions": compile_conditions(_conditions), "collection": "node"},
+                                   _page, _user, _error_prefix_if_not_allowed=_error_prefix_if_not_allowed)
 
-        # Filter result by canRead groups
-        return filter_by_group(self.database_access.find(
-            {"conditions": self._string_to_object_ids(_conditions), "collection": "node"}),
-            "canRead", _user, self.database_access, _error_prefix_if_not_allowed=_error_prefix_if_not_allowed)
+
+        return list(self._find_iter(_conditions, _user, _error_prefix_if_not_allowed))
 
     @aop_has_right(get_node_rights)
-    def load_children(self, _parent_id, _user):
+    def find_iter(self, _conditions, _user, _error_prefix_if_not_allowed=None, _do_not_fix_object_ids=False):
+        """find_iter(_conditions,_user)
+        Like find, but returns an iterator that reads and filters the nodes one at a time.
+
+        :param _conditions: A condition
+        :param _user: A user object
+        :param _do_not_fix_object_ids: If set, do not convert ObjectId instances to strings, for example when the
+            nodes are encoded by of.common.messaging.codec
+        :return: An iterator over the nodes
+
+        """
+        return self._find_iter(_conditions, _user, _error_prefix_if_not_allowed, _do_not_fix_object_ids)
+
+    def _find_iter(self, _conditions, _user, _error_prefix_if_not_allowed=None, _do_not_fix_object_ids=False):
+        """
+        The body of find and find_iter, without the rights check, which the public methods do once.
+        """
+
+        if _error_prefix_if_not_allowed is not None:
+            # Filter result by canRead groups, raising an error for any node the user isn't permissioned for
+            return iter_filter_by_group(self.database_access.find_iter(
+                {"conditions": compile_conditions(_conditions), "collection": "node"},
+                _do_not_fix_object_ids=_do_not_fix_object_ids),
+                "canRead", _user, self.database_access, _error_prefix_if_not_allowed=_error_prefix_if_not_allowed,
+                _use_object_id=_do_not_fix_object_ids)
+
+        # Let the database filter by canRead groups
+        return self.database_access.find_iter(
+            {"conditions": add_permission_condition(compile_conditions(_conditions), "canRead", _user),
+             "collection": "node"}, _do_not_fix_object_ids=_do_not_fix_object_ids)
+
+    @aop_has_right(get_node_rights)
+    def load_children(self, _parent_id, _user, _page=None):
         """
         Returns a list of child nodes whose _parent_ids match _parent_id
 
         :param _parent_id: A parent Id
         :param _user: A user object
+        :param _page: If set, paging options, and a page is returned instead of a list, see _find_page
         :return: A list of nodes
 
         """
 
-        # Filter result by canRead groups
-        return filter_by_group(
-            self.database_access.find(
-                {"conditions": {"parent_id": of_object_id(_parent_id)}, "collection": "node"}),
-            "canRead", _user, self.database_access)
+        if _page is not None:
+            return self._find_page({"conditions": {"parent_id": of_object_id(_parent_id)}, "collection": "node"},
+                                   _page, _user, _trusted=True)
+
+        # Let the database filter by canRead groups
+        return self.database_access.find(
+            {"conditions": add_permission_condition({"parent_id": of_object_id(_parent_id)}, "canRead", _user),
+             "collection": "node"}, _trusted=True)
 
     @aop_has_right(get_node_rights)
     def load_node(self, _id, _user):
@@ -195,7 +357,7 @@ class Node():
 
         # Filter result by canRead groups
         return filter_by_group(self.database_access.find(
-            {"conditions": {"_id": of_object_id(_id["_id"])}, "collection": "node"}),
+            {"conditions": {"_id": of_object_id(_id["_id"])}, "collection": "node"}, _trusted=True),
             "canRead", _user, self.database_access,
             _error_prefix_if_not_allowed="Node.load_node: Not permissioned to load this node. _id: " + _id["_id"])[0]
 
@@ -209,20 +371,23 @@ class Node():
 
         """
 
-        # Filter result by canRead groups
-        return filter_by_group(self.database_access.find(
-            {"conditions": {"parent_id": of_object_id(id_templates), "schemaRef": _schema_ref}, "collection": "node"}),
-            "canRead", _user, self.database_access)
+        # Let the database filter by canRead groups
+        return self.database_access.find(
+            {"conditions": add_permission_condition({"parent_id": of_object_id(id_templates),
+                                                     "schemaRef": _schema_ref}, "canRead", _user),
+             "collection": "node"})
 
 
     @aop_has_right(get_node_rights)
-    def lookup(self, _conditions, _user):
+    def lookup(self, _conditions, _user, _page=None):
         """
         Returns a list of value-name objects for use in drop downs.
         As find, handles the ObjectId(000000010000010001ee3214) string format. (no quotes)
 
         :param _conditions: An MBE condition
         :param _user: A user object
+        :param _page: If set, paging options, and a page of lookup objects is returned instead of a list,
+            see _find_page
         :return: A list of lookup objects.
 
         """
@@ -230,11 +395,20 @@ class Node():
         # Only allow node collection, but allow not specifying schema in conditions.
         self.database_access.verify_condition(_conditions, "node", "Node.find")
 
-        print(str(_conditions))
-        # Filter result by canRead groups
+        _node_conditions = compile_conditions(_conditions["conditions"])
+
+        # Only the _id and name are used
+        if _page is not None:
+            _result = self._find_page({"conditions": _node_conditions, "collection": "node"}, _page, _user,
+                                      _projection=["_id", "name"])
+            _result["items"] = [{"value": _row["_id"], "text": _row["name"]} for _row in _result["items"]]
+            return _result
+
+        # Let the database filter by canRead groups
         return [{"value": _row["_id"], "text": _row["name"]} for _row in
-                filter_by_group(self.database_access.find(self._string_to_object_ids(_conditions)), "canRead", _user,
-                                self.database_access)]
+                self.database_access.find_iter(
+                    {"conditions": add_permission_condition(_node_conditions, "canRead", _user), "collection": "node"},
+                    _projection=["_id", "name"])]
 
     @aop_has_right(get_node_rights)
     def remove(self, _id, _user):
@@ -247,23 +421,25 @@ class Node():
 
         """
 
-        # Recurse and gather all children
-
-        def _recurse_children(_parent_node):
-            _result = [_parent_node]
-            _child_nodes = self.database_access.find(
-                {"conditions": {"parent_id": _parent_node["_id"]}, "collection": "node"},
-                _do_not_fix_object_ids=True)
-            for _curr_child in _child_nodes:
-                _result += _recurse_children(_curr_child)
-
-            return _result
-
         # Load the current node
         _node = self.database_access.find({"conditions": {"_id": of_object_id(_id["_id"])}, "collection": "node"},
-                                          _do_not_fix_object_ids=True)[0]
+                                          _do_not_fix_object_ids=True, _trusted=True)[0]
 
-        _all_nodes = _recurse_children(_node)
+        # Gather all children breadth first, one query for each level of the tree
+        _all_nodes = [_node]
+        _gathered_ids = {_node["_id"]}
+        _parent_ids = [_node["_id"]]
+        while len(_parent_ids) > 0:
+            _child_nodes = self.database_access.find(
+                {"conditions": {"parent_id": {"$in": _parent_ids}}, "collection": "node"},
+                _do_not_fix_object_ids=True, _trusted=True)
+            _parent_ids = []
+            for _curr_child in _child_nodes:
+                # Guard against cycles in the tree
+                if _curr_child["_id"] not in _gathered_ids:
+                    _gathered_ids.add(_curr_child["_id"])
+                    _parent_ids.append(_curr_child["_id"])
+                    _all_nodes.append(_curr_child)
 
         # Check permissions, as the remove_documents function works with documents directly the from database,
         # use objectIds.
@@ -277,25 +453,53 @@ class Node():
         return self.database_access.remove_documents(_documents, _user, "node", )
 
     @aop_has_right(get_node_rights)
-    def history(self, _id, _user):
+    def history(self, _id, _user, _page=None):
         """
 
         Return the change history for the specified node.
 
         :param _id: An object with a node _id field
         :param _user: A user object
+        :param _page: If set, paging options, and a page is returned instead of a list, see Node._find_page
         :return:
 
         """
-        object_id = of_object_id(_id["_id"])
-        # Filter result by canRead
+        if _page is not None:
+            object_id = of_object_id(_id["_id"])
+            self._check_history_permission(object_id, _id, _user)
+            return self._find_page({"conditions": {"node_id": object_id}, "collection": "log"}, _page, _trusted=True)
+
+        return list(self.history_iter(_id, _user))
+
+    def _check_history_permission(self, _object_id, _id, _user):
+        """
+        Raises a PermissionError if the user cannot read the node whose history is requested.
+        """
         filter_by_group(self.database_access.find(
-            {"conditions": {"_id": object_id}, "collection": "node"}), "canRead",
+            {"conditions": {"_id": _object_id}, "collection": "node"}, _trusted=True), "canRead",
             _user, self.database_access,
             _error_prefix_if_not_allowed="Node.history: No permissions to view details of this node. _id: " +
             _id["_id"])
 
-        return self.database_access.find({"conditions": {"node_id": object_id}, "collection": "log"})
+    @aop_has_right(get_node_rights)
+    def history_iter(self, _id, _user, _do_not_fix_object_ids=False):
+        """
+
+        Like history, but returns an iterator that reads the change history from the database one item at a time.
+        Note: The permissions are checked immediately, not when iteration starts.
+
+        :param _id: An object with a node _id field
+        :param _user: A user object
+        :param _do_not_fix_object_ids: If set, do not convert ObjectId instances to strings, see find_iter
+        :return: An iterator over the log items
+
+        """
+        object_id = of_object_id(_id["_id"])
+        # Filter result by canRead
+        self._check_history_permission(object_id, _id, _user)
+
+        return self.database_access.find_iter({"conditions": {"node_id": object_id}, "collection": "log"},
+                                              _do_not_fix_object_ids=_do_not_fix_object_ids, _trusted=True)
 
 
     def get_schemas(self, _user):
@@ -8,6 +8,8 @@ Created on Mar 18, 2016
 
 """
 
+import copy
+
 from bson.objectid import ObjectId
 # noinspection PyProtectedMember
 from jsonschema import _utils
@@ -30,6 +32,232 @@ def of_object_id(value):
         return None
 
 
+#: In an ObjectId conversion plan path, this step means "every item of the array"
+PLAN_ITEMS = None
+
+
+#: Keywords whose subschemas apply to properties that are not known in advance, these cannot be planned
+UNPLANNABLE_KEYWORDS = ["additionalProperties", "patternProperties", "dependencies"]
+
+
+def _has_object_id_marker(_schema):
+    """
+    Returns True if the objectId marker is anywhere in the (sub)schema
+    """
+    if isinstance(_schema, dict):
+        return "objectId" in _schema or any(_has_object_id_marker(_curr_value) for _curr_value in _schema.values())
+    elif isinstance(_schema, list):
+        return any(_has_object_id_marker(_curr_item) for _curr_item in _schema)
+    return False
+
+
+def _plan_schema(_schema, _path, _plan):
+    """
+    Recurse a resolved schema and add the paths of all properties that carry the objectId marker to _plan.
+    Follows the same keywords as the validator does when it reaches "properties"; properties, items and the
+    allOf, anyOf and oneOf combinations.
+
+    :param _schema: The (sub)schema
+    :param _path: The path of the (sub)schema in the data
+    :param _plan: The list of paths, appended to
+    :return: False if the schema has objectId markers under any of the UNPLANNABLE_KEYWORDS, otherwise True
+
+    """
+    if not isinstance(_schema, dict):
+        return True
+
+    for _curr_keyword in UNPLANNABLE_KEYWORDS:
+        if _curr_keyword in _schema and _has_object_id_marker(_schema[_curr_keyword]):
+            return False
+
+    for _curr_keyword in ["allOf", "anyOf", "oneOf"]:
+        if isinstance(_schema.get(_curr_keyword), list):
+            for _curr_subschema in _schema[_curr_keyword]:
+                if not _plan_schema(_curr_subschema, _path, _plan):
+                    return False
+
+    _properties = _schema.get("properties")
+    if isinstance(_properties, dict):
+        for _property, _subschema in _properties.items():
+            if not isinstance(_subschema, dict):
+                continue
+            if "objectId" in _subschema:
+                _plan.append(_path + (_property,))
+            elif _subschema.get("type") == "array" and isinstance(_subschema.get("items"), dict) and \
+                    "objectId" in _subschema["items"]:
+                _plan.append(_path + (_property, PLAN_ITEMS))
+            if not _plan_schema(_subschema, _path + (_property,), _plan):
+                return False
+
+    _items = _schema.get("items")
+    if isinstance(_items, dict):
+        return _plan_schema(_items, _path + (PLAN_ITEMS,), _plan)
+    elif isinstance(_items, list):
+        for _curr_idx, _curr_item_schema in enumerate(_items):
+            if not _plan_schema(_curr_item_schema, _path + (_curr_idx,), _plan):
+                return False
+    return True
+
+
+def make_object_id_plan(mongodb_schema):
+    """
+    Make an ObjectId conversion plan for a resolved schema; a flat list of the paths in the data that should be
+    converted by of_object_id. A path is a tuple of property names, array indexes and PLAN_ITEMS.
+    A path ending with PLAN_ITEMS converts each string item of an array.
+    Schemas with objectId markers under any of the UNPLANNABLE_KEYWORDS have no plan, the paths of those depend on
+    the data, their ObjectIds are converted by the validator instead.
+
+    :param mongodb_schema: A resolved mongodb_schema (JSON Schema with Seep properties)
+    :return: A list of paths, or None if the schema cannot be planned
+
+    """
+    _plan = []
+    if not _plan_schema(mongodb_schema, (), _plan):
+        return None
+    # Remove duplicates, for example from combined schemas, but keep the order
+    _result = []
+    for _curr_path in _plan:
+        if _curr_path not in _result:
+            _result.append(_curr_path)
+    return _result
+
+
+def _apply_plan_path(_instance, _path, _depth):
+    """
+    Convert the values at a path in the data, see make_object_id_plan.
+    Values are converted under the same conditions as when the validator applies the schema.
+    """
+    _step = _path[_depth]
+    _last = _depth == len(_path) - 1
+    if _step is PLAN_ITEMS:
+        if not isinstance(_instance, list):
+            return
+        if _last:
+            for _curr_idx, _curr_item in enumerate(_instance):
+                if type(_curr_item) is str and _curr_item != "":
+                    _instance[_curr_idx] = of_object_id(_curr_item)
+        else:
+            for _curr_item in _instance:
+                _apply_plan_path(_curr_item, _path, _depth + 1)
+    elif isinstance(_step, int):
+        if isinstance(_instance, list) and _step < len(_instance):
+            _apply_plan_path(_instance[_step], _path, _depth + 1)
+    elif isinstance(_instance, dict) and _step in _instance:
+        if _last:
+            _curr_value = _instance[_step]
+            if _curr_value is not None and _curr_value != "":
+                _instance[_step] = of_object_id(_curr_value)
+        else:
+            _apply_plan_path(_instance[_step], _path, _depth + 1)
+
+
+def apply_object_id_plan(data, plan):
+    """
+    Run an ObjectId conversion plan on the data, see make_object_id_plan.
+
+    :param data: The data, it is changed in place
+    :param plan: A list of paths
+    :return: the affected data
+
+    """
+    for _curr_path in plan:
+        if len(_curr_path) == 1:
+            # Fast path for the usual top level objectId properties
+            _property = _curr_path[0]
+            if _property in data:
+                _curr_value = data[_property]
+                if _curr_value is not None and _curr_value != "":
+                    data[_property] = of_object_id(_curr_value)
+        else:
+            _apply_plan_path(data, _curr_path, 0)
+    return data
+
+
+def make_object_id_plan_tree(plan):
+    """
+    Make a tree out of an ObjectId conversion plan, merging the common beginnings of the paths, see
+    copy_object_id_plan. Each step maps to a list of its child steps and whether the value at the step is converted.
+
+    :param plan: A list of paths, see make_object_id_plan
+    :return: A dict of steps and [child steps, convert]-lists
+    """
+    _tree = {}
+    for _curr_path in plan:
+        _children = _tree
+        for _curr_idx, _curr_step in enumerate(_curr_path):
+            _entry = _children.setdefault(_curr_step, [{}, False])
+            if _curr_idx == len(_curr_path) - 1:
+                _entry[1] = True
+            _children = _entry[0]
+    return _tree
+
+
+def _copy_on_write(_instance, _tree):
+    """
+    Convert the values of a plan tree in the data, copying only the dicts and lists that has changes, see
+    copy_object_id_plan.
+    Values are converted under the same conditions as when the validator applies the schema.
+
+    :return: The instance, if unchanged, or a shallow copy with the changes
+    """
+    _copy = None
+    if isinstance(_instance, dict):
+        for _curr_step, (_children, _convert) in _tree.items():
+            if _curr_step is PLAN_ITEMS or isinstance(_curr_step, int) or _curr_step not in _instance:
+                continue
+            _curr_value = _instance[_curr_step]
+            if _convert:
+                if _curr_value is None or _curr_value == "":
+                    continue
+                _new_value = of_object_id(_curr_value)
+            else:
+                _new_value = _copy_on_write(_curr_value, _children)
+            if _new_value is not _curr_value:
+                if _copy is None:
+                    _copy = dict(_instance)
+                _copy[_curr_step] = _new_value
+
+    elif isinstance(_instance, list):
+        for _curr_step, (_children, _convert) in _tree.items():
+            if _curr_step is PLAN_ITEMS:
+                _indexes = range(len(_instance))
+            elif isinstance(_curr_step, int) and _curr_step < len(_instance):
+                _indexes = [_curr_step]
+            else:
+                continue
+            for _curr_idx in _indexes:
+                _curr_item = _instance[_curr_idx] if _copy is None else _copy[_curr_idx]
+                if _convert and _curr_step is PLAN_ITEMS:
+                    if type(_curr_item) is not str or _curr_item == "":
+                        continue
+                    _new_item = of_object_id(_curr_item)
+                else:
+                    _new_item = _copy_on_write(_curr_item, _children)
+                if _new_item is not _curr_item:
+                    if _copy is None:
+                        _copy = list(_instance)
+                    _copy[_curr_idx] = _new_item
+
+    return _instance if _copy is None else _copy
+
+
+def copy_object_id_plan(data, plan_tree):
+    """
+    Run an ObjectId conversion plan on a copy of the data, leaving the data unchanged.
+    The copy is shallow, only the dicts and lists that hold converted values are copied, and the rest is shared with
+    the data. The top level is always copied.
+
+    :param data: The data
+    :param plan_tree: An ObjectId conversion plan tree, see make_object_id_plan_tree
+    :return: The converted copy
+
+    """
+    _result = _copy_on_write(data, plan_tree)
+    if _result is data:
+        _result = copy.copy(data)
+    return _result
+
+
 class MongodbValidator():
     """
     The MongodbValidator class is a plug-in for JSON schema that converts objectId-formatted strings into
@@ -38,13 +266,18 @@ class MongodbValidator():
     """
     """The main validator class, a descendent of the jsonschema validator"""
     validator_class = None
+    """Validates without converting, but allows ObjectId instances, used with ObjectId conversion plans"""
+    planned_validator_class = None
     """The object setter is called to change the value"""
     object_setter = None
+    """Object setter instances, reused across documents, keyed by the id of their subschema"""
+    object_setters = None
 
     def __init__(self, resolver=None):
         """Initializes MongodbValidator by initializing  and setting the resolver"""
         self.init_classes()
         self.resolver = resolver
+        self.object_setters = {}
 
     def init_classes(self):
         """Initialize all dynamically defined classes"""
@@ -60,29 +293,86 @@ class MongodbValidator():
                 "type": self._type_except_objectid,
             }
         )
+        self.planned_validator_class = jsonschema.validators.extend(
+            self.base_validator, {
+                "type": self._type_except_objectid,
+            }
+        )
+
+    def make_validators(self, mongodb_schema):
+        """
+        Build the validator instances for a schema. These are stateless between documents and can be reused.
+
+        :param mongodb_schema: a mongodb_schema (JSON Schema with Seep properties)
+        :return: A tuple with the applying (ObjectId-converting), the plain and the planned validator
+
+        """
+        return self.validator_class(schema=mongodb_schema, resolver=self.resolver), \
+            self.base_validator(schema=mongodb_schema, resolver=self.resolver), \
+            self.planned_validator_class(schema=mongodb_schema, resolver=self.resolver)
 
-    def apply(self, data, mongodb_schema):
+    def apply(self, data, mongodb_schema, validator=None):
         """
         Apply the MBE schema to the data.
 
         :param data: A mongo schema
         :param mongodb_schema: mongodb_schema: a mongodb_schema (JSON Schema with Seep properties)
+        :param validator: If set, a prebuilt applying validator for mongodb_schema, see make_validators
         :return: the affected data
 
         """
-        self.validator_class(schema=mongodb_schema, resolver=self.resolver).validate(data)
+        if validator is None:
+            validator = self.validator_class(schema=mongodb_schema, resolver=self.resolver)
+        validator.validate(data)
         return data
 
-    def validate(self, data, mongodb_schema):
+    def apply_planned(self, data, mongodb_schema, plan, validator=None):
+        """
+        Apply the MBE schema to the data using a precomputed ObjectId conversion plan.
+        Validates once, and then converts the paths of the plan, instead of looking for objectIds while validating.
+
+        :param data: A mongo schema
+        :param mongodb_schema: mongodb_schema: a mongodb_schema (JSON Schema with Seep properties)
+        :param plan: An ObjectId conversion plan for mongodb_schema, see make_object_id_plan
+        :param validator: If set, a prebuilt planned validator for mongodb_schema, see make_validators
+        :return: the affected data
+
+        """
+        if validator is None:
+            validator = self.planned_validator_class(schema=mongodb_schema, resolver=self.resolver)
+        validator.validate(data)
+        return apply_object_id_plan(data, plan)
+
+    def apply_planned_copy(self, data, mongodb_schema, plan_tree, validator=None):
+        """
+        Apply the MBE schema to a copy of the data using a precomputed ObjectId conversion plan tree.
+        The data itself is left unchanged, see copy_object_id_plan.
+
+        :param data: A mongo schema
+        :param mongodb_schema: mongodb_schema: a mongodb_schema (JSON Schema with Seep properties)
+        :param plan_tree: An ObjectId conversion plan tree for mongodb_schema, see make_object_id_plan_tree
+        :param validator: If set, a prebuilt planned validator for mongodb_schema, see make_validators
+        :return: the converted copy of the data
+
+        """
+        if validator is None:
+            validator = self.planned_validator_class(schema=mongodb_schema, resolver=self.resolver)
+        validator.validate(data)
+        return copy_object_id_plan(data, plan_tree)
+
+    def validate(self, data, mongodb_schema, validator=None):
         """
         Validate the data with the MBE schema.
 
         :param data: A mongo schema
         :param mongodb_schema: mongodb_schema: a mongodb_schema (JSON Schema with Seep properties)
+        :param validator: If set, a prebuilt plain validator for mongodb_schema, see make_validators
         :return: the affected data
 
         """
-        self.base_validator(schema=mongodb_schema, resolver=self.resolver).validate(data)
+        if validator is None:
+            validator = self.base_validator(schema=mongodb_schema, resolver=self.resolver)
+        validator.validate(data)
 
 
     def check_schema(self, schema):
@@ -119,7 +409,29 @@ class MongodbValidator():
         subschemas = [(instance, schema)]
         while subschemas:
             subinstance, subschema = subschemas.pop()
-            self.object_setter(subschema).validate(subinstance)
+            self._get_object_setter(subschema).validate(subinstance)
+
+    def clear_object_setters(self):
+        """
+        Drop all cached object setters, and with them the references to their subschemas.
+        Called when the schemas are reloaded, so the old schemas can be garbage collected.
+        """
+        self.object_setters = {}
+
+    def _get_object_setter(self, subschema):
+        """
+        Returns a cached object setter for the subschema, creates it the first time a subschema is encountered.
+        The subschema is kept in the cache alongside the setter so that its id cannot be reused by another schema.
+        """
+        try:
+            _cached_schema, _setter = self.object_setters[id(subschema)]
+            if _cached_schema is subschema:
+                return _setter
+        except KeyError:
+            pass
+        _setter = self.object_setter(subschema)
+        self.object_setters[id(subschema)] = (subschema, _setter)
+        return _setter
 
     # noinspection PyMethodMayBeStatic,PyUnusedLocal
     def _set_object_ids(self, validator, properties, instance, schema):
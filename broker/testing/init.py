@@ -10,7 +10,8 @@ import json
 
 from pymongo.mongo_client import MongoClient
 
-from of.broker.lib.access import DatabaseAccess
+from of.broker.lib.access import DatabaseAccess, COPY_NONE
+from of.broker.lib.indexes import ensure_indexes
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -44,7 +45,8 @@ def _import_init_file(_filename, _da):
     _data = json.load(json_data)
     for _curr_data in _data:
         print("init - " + _curr_data["name"])
-        _da.save(_curr_data, _user=None, _allow_save_id=True)
+    # The data isn't used after this, so no need to copy it
+    _da.save_many(_data, _user=None, _allow_save_id=True, _copy_mode=COPY_NONE)
     json_data.close()
 
 
@@ -62,6 +64,8 @@ def init_database(_database_name="test_database", _data_files=None, _json_schema
         _data_files = []
 
     _da = get_empty_db_da(_database_name, _json_schema_folders = _json_schema_folders, _uri_handlers= _uri_handlers)
+    # Create the indexes declared by the schemas
+    ensure_indexes(_da.database, _da.schema_tools)
     # Init by loading the OF base structure
     _import_init_file(os.path.join(script_dir, 'init.json'), _da)
 
@@ -18,4 +18,23 @@ Feature: Authentication
     Given the user provides bad credentials an AuthenticationError should be raised
 
   Scenario: User tried to validate an invalid session
-    Given the user provides an invalid session AuthenticationError should be raised
\ No newline at end of file
+    Given the user provides an invalid session AuthenticationError should be raised
+
+  Scenario: Checking a session again should use the session cache
+    Given the session cache is empty
+    And the user logs in with username tester and password test
+    When the session is checked 3 times
+    Then the authentication backend should have been asked for the session once
+    And the session cache should have had 2 hits
+
+  Scenario: Logging out should remove the session from the session cache
+    Given the user logs in with username tester and password test
+    And the session is checked 1 times
+    When the the user logs out
+    Then the session should not be in the session cache
+
+  Scenario: A session logged out while it is being checked should not be cached
+    Given the session cache is empty
+    And the user logs in with username tester and password test
+    When the user logs out while the session is being checked
+    Then the session should not be in the session cache
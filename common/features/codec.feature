@@ -0,0 +1,13 @@
+# Created by nibo at 2026-10-18
+Feature: Codec
+  Encoding and decoding the JSON sent over web sockets and the web service API
+
+  Scenario: Documents are encoded the same way by all installed codecs
+    Given a document with an ObjectId, a datetime and non-ASCII text
+    When the document is encoded and decoded by each installed codec
+    Then every codec should give the document with the ObjectId and datetime as strings
+    And the standard library codec should be in use again
+
+  Scenario: The codec to use is chosen by name
+    Then choosing the "auto" codec should choose an installed codec
+    And choosing the "nonexistent" codec should raise an error
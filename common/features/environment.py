@@ -25,7 +25,11 @@ class MockupAuthenticationBackend(AuthenticationBackend):
     This class implements a mockup authentication backend, it has one user and one session
     """
 
+    #: The number of times get_session has been called
+    get_session_calls = 0
+
     def get_session(self, _session_id):
+        self.get_session_calls += 1
         if _session_id == "1":
             return {"user_id": "tester"}
         else:
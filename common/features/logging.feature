@@ -10,3 +10,27 @@ Feature: Logging
 
   Scenario: The callback is defined
     Then the logging should call it
+
+  Scenario: Messages of severities that are not logged should not be built
+    Then a lazy debug message should not be built when only warnings are logged
+    And a lazy warning message should be built and formatted when warnings are logged
+
+  Scenario: The callback is called from a worker thread
+    Then a queued callback should get all messages on another thread, in order, once stopped
+
+  Scenario: Stopping a queued callback should not wait forever for a full queue
+    Then stopping a queued callback that is stuck with a full queue should time out
+    And once unstuck, it should stop, also when stopped again, and have got all messages
+
+  Scenario: A failing queued callback should be reported and counted
+    Then a queued callback that fails should report the message to stderr and count the error
+
+  Scenario: Sparse log messages need to be created
+    Then sparse log messages are built for single and multirow data
+
+  Scenario: The process identity is only looked up once per process
+    Then the system uid and pid should be cached, and forgotten in a forked child process
+
+  Scenario: Log records should be fast to write at all severities
+    Then log records are written 10000 times at each severity, with only warnings logged
+    And the severities that are not logged should have been the fastest
@@ -96,4 +96,83 @@ def step_impl(context):
         ok_(True)
         return
 
-    ok_(False, "An error wasn't raised when trying to use an invalid session")
\ No newline at end of file
+    ok_(False, "An error wasn't raised when trying to use an invalid session")
+
+
+@given("the session cache is empty")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    context.auth.clear_session_cache()
+
+
+@given("the session is checked (?P<count>[0-9]+) times")
+@when("the session is checked (?P<count>[0-9]+) times")
+def step_impl(context, count):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    context.get_session_calls_before = context.auth.authentication_backend.get_session_calls
+    context.cache_hits_before = context.auth.session_cache_metrics()["hits"]
+    for _curr_check in range(int(count)):
+        check_session(context.session_id)
+
+
+@then("the authentication backend should have been asked for the session once")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _calls = context.auth.authentication_backend.get_session_calls - context.get_session_calls_before
+    ok_(_calls == 1, "Expected one call to get_session, got " + str(_calls))
+
+
+@then("the session cache should have had (?P<count>[0-9]+) hits")
+def step_impl(context, count):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _hits = context.auth.session_cache_metrics()["hits"] - context.cache_hits_before
+    ok_(_hits == int(count), "Expected " + count + " session cache hits, got " + str(_hits))
+
+
+@then("the session should not be in the session cache")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    ok_(context.session_id not in context.auth.session_cache, "The session is still cached")
+
+
+@when("the user logs out while the session is being checked")
+def step_impl(context):
+    """
+
+    :type context behave.runner.Context
+
+    """
+    _backend = context.auth.authentication_backend
+    _get_session = _backend.get_session
+
+    def _get_session_and_log_out(_session_id):
+        # The session is read before the logout is done, as by a check_session running at the same time
+        _session = _get_session(_session_id)
+        context.auth.logout(_session_id)
+        return _session
+
+    _backend.get_session = _get_session_and_log_out
+    try:
+        check_session(context.session_id)
+    finally:
+        del _backend.get_session
@@ -0,0 +1,85 @@
+import datetime
+
+from behave import *
+from bson.objectid import ObjectId
+from nose.tools.trivial import ok_
+
+from of.common.messaging import codec
+
+use_step_matcher("re")
+
+
+@given("a document with an ObjectId, a datetime and non-ASCII text")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.codec_object_id = ObjectId()
+    context.codec_datetime = datetime.datetime(2016, 1, 22, 12, 30, 15, 123456)
+    context.codec_document = {"_id": context.codec_object_id, "changedWhen": context.codec_datetime,
+                              "name": "Nicklas Börjesson", "schemaRef": "ref://of.node.node", "systemPid": 10000,
+                              "groups": [context.codec_object_id], "weight": 1.5, "active": True, "parent": None}
+
+
+@when("the document is encoded and decoded by each installed codec")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.codec_results = {}
+    for _curr_name in [codec.CODEC_JSON, codec.CODEC_ORJSON, codec.CODEC_UJSON]:
+        try:
+            codec.use_codec(_curr_name)
+        except ImportError:
+            continue
+        _encoded = codec.encode(context.codec_document)
+        ok_(isinstance(_encoded, bytes), _curr_name + " did not encode into bytes")
+        context.codec_results[_curr_name] = codec.decode(_encoded)
+    codec.use_codec(codec.CODEC_JSON)
+
+
+@then("every codec should give the document with the ObjectId and datetime as strings")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _expected = dict(context.codec_document)
+    _expected.update({"_id": str(context.codec_object_id), "changedWhen": "2016-01-22 12:30:15.123456",
+                      "groups": [str(context.codec_object_id)]})
+    for _curr_name, _curr_result in context.codec_results.items():
+        ok_(_curr_result == _expected, _curr_name + " gave " + str(_curr_result))
+
+
+@then("the standard library codec should be in use again")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    ok_(codec.name == codec.CODEC_JSON)
+
+
+@then("choosing the \"auto\" codec should choose an installed codec")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    try:
+        _chosen = codec.use_codec(codec.CODEC_AUTO)
+        ok_(_chosen in [codec.CODEC_JSON, codec.CODEC_ORJSON, codec.CODEC_UJSON] and codec.name == _chosen)
+        ok_(codec.decode(codec.encode({"a": [1, "b"]})) == {"a": [1, "b"]})
+    finally:
+        codec.use_codec(codec.CODEC_JSON)
+
+
+@then("choosing the \"nonexistent\" codec should raise an error")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    try:
+        codec.use_codec("nonexistent")
+    except Exception as e:
+        ok_(str(e) == "use_codec: Unknown codec: nonexistent")
+        ok_(codec.name == codec.CODEC_JSON)
+    else:
+        ok_(False, "No error was raised")
@@ -1,5 +1,9 @@
+import io
 import os
+import threading
+import time
 
+import contextlib
 import datetime
 from behave import *
 
@@ -8,7 +12,9 @@ from behave import *
 use_step_matcher("re")
 
 from nose.tools.trivial import ok_
-from of.common.logging import make_textual_log_message, SEV_DEBUG, SEV_ERROR, write_to_log, EC_RESOURCE, EC_NOTIFICATION
+from of.common.logging import make_textual_log_message, SEV_DEBUG, SEV_ERROR, write_to_log, EC_RESOURCE, \
+    EC_NOTIFICATION, SEV_WARNING, is_enabled, QueuedCallback, make_sparse_log_message, EC_INTERNAL, SEV_FATAL, \
+    SEV_INFO, get_uid, get_pid, severity_identifiers
 import of.common.logging
 
 _global_params = None
@@ -64,4 +70,204 @@ def step_impl(context):
         of.common.logging.callback = None
         raise Exception(e)
 
-# TODO: Add test for sparse message
\ No newline at end of file
+
+@then("a lazy debug message should not be built when only warnings are logged")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    _calls = []
+
+    def _build_message():
+        _calls.append(True)
+        return "Expensive message"
+
+    _old_severity = of.common.logging.severity
+    of.common.logging.severity = SEV_WARNING
+    try:
+        ok_(not is_enabled(SEV_DEBUG) and is_enabled(SEV_ERROR), "is_enabled did not respect the severity")
+        write_to_log(_build_message, EC_NOTIFICATION, SEV_DEBUG)
+        ok_(len(_calls) == 0, "The message was built even though debug messages are not logged")
+    finally:
+        of.common.logging.severity = _old_severity
+
+
+@then("a lazy warning message should be built and formatted when warnings are logged")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    global _global_params
+    _old_severity = of.common.logging.severity
+    of.common.logging.severity = SEV_WARNING
+    of.common.logging.callback = local_test_log_writer
+    try:
+        _result = write_to_log("Test %s number %d", EC_NOTIFICATION, SEV_WARNING, _uid="test", _pid=0,
+                               _args=("warning", 1))
+        ok_(_result == "Test warning number 1" and _global_params[0] == "Test warning number 1",
+            "The message was not formatted: " + str(_global_params))
+        write_to_log(lambda: "Built " + "warning", EC_NOTIFICATION, SEV_WARNING, _uid="test", _pid=0)
+        ok_(_global_params[0] == "Built warning", "The message was not built: " + str(_global_params))
+    finally:
+        _global_params = None
+        of.common.logging.callback = None
+        of.common.logging.severity = _old_severity
+
+
+@then("a queued callback should get all messages on another thread, in order, once stopped")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    _received = []
+
+    def _target(*args):
+        _received.append((args[0], threading.current_thread().name))
+
+    _queued_callback = QueuedCallback(_target)
+    of.common.logging.callback = _queued_callback
+    try:
+        for _curr_idx in range(1000):
+            write_to_log("Message %d", EC_NOTIFICATION, SEV_ERROR, _uid="test", _pid=0, _args=(_curr_idx,))
+        ok_(_queued_callback.stop(_timeout=10), "The queued callback did not stop")
+    finally:
+        of.common.logging.callback = None
+
+    ok_([_curr_message for _curr_message, _curr_thread in _received] ==
+        ["Message " + str(_curr_idx) for _curr_idx in range(1000)], "Messages were lost or reordered")
+    ok_(all([_curr_thread != threading.current_thread().name for _curr_message, _curr_thread in _received]),
+        "The callback was called on the logging thread")
+
+
+@then("stopping a queued callback that is stuck with a full queue should time out")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    context.stuck_received = []
+    context.stuck_release = threading.Event()
+    _picked_up = threading.Event()
+
+    def _target(*args):
+        _picked_up.set()
+        context.stuck_release.wait(30)
+        context.stuck_received.append(args[0])
+
+    context.stuck_callback = QueuedCallback(_target, _max_queue_size=1)
+    context.stuck_callback("First", EC_NOTIFICATION, SEV_ERROR)
+    ok_(_picked_up.wait(10), "The first message was not picked up")
+    # Fills the queue, the worker is stuck handling the first message
+    context.stuck_callback("Second", EC_NOTIFICATION, SEV_ERROR)
+    _started = time.perf_counter()
+    ok_(not context.stuck_callback.stop(_timeout=0.2), "Stopping did not time out")
+    ok_(time.perf_counter() - _started < 5, "Stopping waited too long")
+
+
+@then("once unstuck, it should stop, also when stopped again, and have got all messages")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    context.stuck_release.set()
+    ok_(context.stuck_callback.stop(_timeout=10), "The queued callback did not stop")
+    # Leaves a None on the queue, that must not be handled as a message
+    ok_(context.stuck_callback.stop(_timeout=10), "The queued callback did not stop a second time")
+    ok_(context.stuck_received == ["First", "Second"], "Wrong messages: " + str(context.stuck_received))
+
+
+@then("a queued callback that fails should report the message to stderr and count the error")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+
+    def _target(*args):
+        raise Exception("Test failure")
+
+    _stderr = io.StringIO()
+    _queued_callback = QueuedCallback(_target)
+    with contextlib.redirect_stderr(_stderr):
+        _queued_callback(*_global_err_param)
+        ok_(_queued_callback.stop(_timeout=10), "The queued callback did not stop")
+
+    ok_(_queued_callback.errors == 1, "Expected one error, got " + str(_queued_callback.errors))
+    ok_("Test failure" in _stderr.getvalue() and _global_err_cmp in _stderr.getvalue(),
+        "The failure was not reported to stderr: " + _stderr.getvalue())
+
+
+@then("sparse log messages are built for single and multirow data")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    _cases = [
+        (_global_err_param,
+         "*a: peer, pid: 0, uid: test, data: Test error, ec: resource, sev: error, p_id: 1, u_id: TestUser, "
+         "t: 1999-01-01 01:01:01.000001, node_id: 1"),
+        (_global_debug_param,
+         " a: None, pid: 0, uid: test, data: Test message, ec: notification, sev: debug, p_id: N/A"),
+        (("Multi\nrow", EC_INTERNAL, SEV_WARNING, "p1", None, "t", "peer", None, "test", 12),
+         "-a: peer, pid: 12, uid: test, data: (multirow, see below), ec: internal, sev: warning, p_id: p1, t: t"
+         "\n===\nMulti\nrow\n=== "),
+        (("Multi\nrow", None, SEV_FATAL, None, None, None, None, None, "test", 0),
+         "*a: None, pid: 0, uid: test, data: (multirow, see below)N/A, sev: fatal, p_id: N/A\n===\nMulti\nrow\n=== ")
+    ]
+    for _curr_param, _curr_cmp in _cases:
+        _msg = make_sparse_log_message(*_curr_param)
+        ok_(_msg == _curr_cmp, "Sparse message did not match: \nResult:" + str(_msg.encode()) + "\nComparison:\n" +
+            str(_curr_cmp.encode()))
+
+
+@then("the system uid and pid should be cached, and forgotten in a forked child process")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    ok_(get_pid() == os.getpid() and get_uid() is of.common.logging.uid, "The identity was not cached")
+    if not hasattr(os, "fork"):
+        return
+    _read_fd, _write_fd = os.pipe()
+    _child_pid = os.fork()
+    if _child_pid == 0:
+        os.write(_write_fd, str(get_pid() == os.getpid()).encode())
+        os._exit(0)
+    os.waitpid(_child_pid, 0)
+    ok_(os.read(_read_fd, 10) == b"True", "The child process used the pid of its parent")
+    os.close(_read_fd)
+    os.close(_write_fd)
+
+
+@then("log records are written (?P<count>[0-9]+) times at each severity, with only warnings logged")
+def step_impl(context, count):
+    """
+    :type context: behave.runner.Context
+    """
+    _old_severity = of.common.logging.severity
+    of.common.logging.severity = SEV_WARNING
+    of.common.logging.callback = lambda *args: make_sparse_log_message(*args)
+    context.records_per_second = {}
+    try:
+        for _curr_severity in range(len(severity_identifiers)):
+            _started = time.perf_counter()
+            for _curr_idx in range(int(count)):
+                write_to_log("Record %d at severity %d", EC_NOTIFICATION, _curr_severity,
+                             _args=(_curr_idx, _curr_severity))
+            context.records_per_second[_curr_severity] = int(count) / (time.perf_counter() - _started)
+    finally:
+        of.common.logging.callback = None
+        of.common.logging.severity = _old_severity
+
+    print("Log records per second: " + ", ".join(
+        [severity_identifiers[_curr_severity] + ": " + str(int(_curr_rate))
+         for _curr_severity, _curr_rate in context.records_per_second.items()]))
+
+
+@then("the severities that are not logged should have been the fastest")
+def step_impl(context):
+    """
+    :type context: behave.runner.Context
+    """
+    _slowest_disabled = min([context.records_per_second[_curr_severity] for _curr_severity in [SEV_DEBUG, SEV_INFO]])
+    _fastest_enabled = max([_curr_rate for _curr_severity, _curr_rate in context.records_per_second.items()
+                            if _curr_severity >= SEV_WARNING])
+    ok_(_slowest_disabled > _fastest_enabled, "Disabled severities were not faster: " + str(context.records_per_second))
@@ -7,6 +7,11 @@ Created on Jan 22, 2016
 
 """
 import datetime
+import getpass
+import sys
+import threading
+import time
+from queue import Queue, Full
 
 __author__ = 'Nicklas Borjesson'
 import os
@@ -108,6 +113,9 @@ category_descriptions = [
 """The logging callback"""
 callback = None
 severity = SEV_WARNING
+#: The system user name and process id, looked up once per process, see get_uid and get_pid
+uid = None
+pid = None
 
 if os.name == "nt":
     import win32api
@@ -177,11 +185,54 @@ def category_to_description(_category, _error = ""):
         return _error + str(_category)
 
 
+def is_enabled(_severity):
+    """
+    Returns True if messages of the given severity are logged, use to avoid building expensive debug messages.
+    """
+    return _severity >= severity
+
+
+def get_uid():
+    """
+    Returns the system user name. It is only looked up once per process, as os.getlogin() is a system call that fails
+    for processes without a controlling terminal, like daemons. In that case, the user name of the environment is used.
+    """
+    global uid
+    if uid is None:
+        try:
+            uid = os.getlogin()
+        except OSError:
+            uid = getpass.getuser()
+    return uid
+
+
+def get_pid():
+    """Returns the system process id, it is only looked up once per process."""
+    global pid
+    if pid is None:
+        pid = os.getpid()
+    return pid
+
+
+def forget_identity():
+    """Make get_uid and get_pid look up the identity again, called in the child process after a fork."""
+    global uid, pid
+    uid = None
+    pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=forget_identity)
+
+
 def write_to_log(_data, _category=EC_NOTIFICATION, _severity=SEV_INFO, _process_id=None, _user_id=None,
-                 _occurred_when=None, _address=None, _node_id=None, _uid=None, _pid=None):
+                 _occurred_when=None, _address=None, _node_id=None, _uid=None, _pid=None, _args=None):
     """
-    Writes a message to the log using the current facility
-    :param _data: The error message
+    Writes a message to the log using the current facility.
+    Messages are only built if the severity is logged, so for expensive messages, either pass a %-style format string
+    and its arguments in _args, or a callable returning the message, rather than a concatenated string.
+
+    :param _data: The error message, or a callable without parameters returning it
     :param _category: The event category (defaults to CN_NOTIFICATION)
     :param _severity: The severity of the error (defaults to SEV_INFO)
     :param _process_id: The current process id (defaults to the current pid)
@@ -191,14 +242,21 @@ def write_to_log(_data, _category=EC_NOTIFICATION, _severity=SEV_INFO, _process_
     :param _node_id: An Id for reference (like a node id)
     :param _uid: The system uid
     :param _pid: The system pid
+    :param _args: If set, the message is a %-style format string and these are its arguments
+    :return: The message. If the severity is not logged, _data is returned as is, without building the message.
     """
     global callback, severity
     if _severity < severity:
         return _data
 
+    if callable(_data):
+        _data = _data()
+    if _args is not None:
+        _data = _data % _args
+
     _occurred_when = _occurred_when if _occurred_when is not None else str(datetime.datetime.utcnow())
-    _pid = _pid if _pid is not None else os.getpid()
-    _uid = _uid if _uid is not None else os.getlogin()
+    _pid = _pid if _pid is not None else get_pid()
+    _uid = _uid if _uid is not None else get_uid()
 
     if callback is not None:
         callback(_data, _category, _severity, _process_id, _user_id, _occurred_when, _address, _node_id, _uid, _pid)
@@ -210,6 +268,112 @@ def write_to_log(_data, _category=EC_NOTIFICATION, _severity=SEV_INFO, _process_
 
     return _data
 
+class QueuedCallbackThread(threading.Thread):
+    #: If true, the thread is terminated
+    terminated = None
+
+    def __init__(self, _queued_callback):
+        self.terminated = False
+        super(QueuedCallbackThread, self).__init__(target=_queued_callback.run, name="Queued logging callback thread",
+                                                   daemon=True)
+
+
+class QueuedCallback(object):
+    """
+    Wraps a logging callback, like one writing to a database, so that it is called on a worker thread instead of on
+    the thread logging the message. Set an instance as the logging callback:
+        of.common.logging.callback = QueuedCallback(log_to_database)
+    If the queue is full, or the severity is at least synchronous_severity, the callback is called directly.
+    """
+
+    #: The wrapped callback
+    target = None
+    #: The queue of calls waiting to be made, each a tuple of callback arguments
+    queue = None
+    #: Messages of this severity or higher are not queued
+    synchronous_severity = None
+    #: The thread that calls the wrapped callback
+    worker_thread = None
+    #: The number of messages that were not queued because the queue was full
+    full = None
+    #: The number of queued messages that the wrapped callback failed to handle
+    errors = None
+
+    def __init__(self, _target, _max_queue_size=10000, _synchronous_severity=SEV_FATAL):
+        """
+        Initialize and start the worker
+
+        :param _target: The callback to wrap
+        :param _max_queue_size: The maximum number of queued messages
+        :param _synchronous_severity: Messages of this severity or higher are not queued
+
+        """
+        self.target = _target
+        self.queue = Queue(maxsize=_max_queue_size)
+        self.synchronous_severity = _synchronous_severity
+        self.full = 0
+        self.errors = 0
+        self.worker_thread = QueuedCallbackThread(_queued_callback=self)
+        self.worker_thread.start()
+
+    def __call__(self, *args):
+        if args[2] >= self.synchronous_severity or self.worker_thread.terminated:
+            self.target(*args)
+            return
+        try:
+            self.queue.put_nowait(args)
+        except Full:
+            # Rather than waiting, do the work on the logging thread, which slows it down accordingly
+            self.full += 1
+            self.target(*args)
+
+    def _call_target(self, _args):
+        try:
+            self.target(*_args)
+        except Exception as e:
+            # There is nowhere else to report this, as the failure is in the logging itself
+            self.errors += 1
+            sys.stderr.write("QueuedCallback: Error calling the logging callback: " + str(e) + "\nMessage:\n" +
+                             make_textual_log_message(*_args) + "\n")
+
+    def run(self):
+        """
+        Calls the wrapped callback for each queued message until woken up by the None that stop() puts on the queue.
+        """
+        while True:
+            _args = self.queue.get()
+            if _args is None:
+                # Woken up to stop by stop()
+                break
+            self._call_target(_args)
+
+    def stop(self, _timeout=None):
+        """
+        Stop the worker after all queued messages have been handled, later messages are handled directly.
+
+        :param _timeout: The longest time, in seconds, to wait for the queued messages to be handled, including
+            waiting for room on a full queue to wake the worker up
+        :return: True if all queued messages were handled
+
+        """
+        _deadline = None if _timeout is None else time.monotonic() + _timeout
+        self.worker_thread.terminated = True
+        # Wake the worker up, it blocks while waiting for messages. Wait for room, so that this is never lost.
+        try:
+            self.queue.put(None, True, _timeout)
+        except Full:
+            return False
+        self.worker_thread.join(None if _deadline is None else max(_deadline - time.monotonic(), 0))
+        if self.worker_thread.is_alive():
+            return False
+        # Messages queued while the worker was stopping, a None is left by an earlier call to stop
+        while not self.queue.empty():
+            _args = self.queue.get_nowait()
+            if _args is not None:
+                self._call_target(_args)
+        return True
+
+
 def make_event(_data, _category=None, _severity=None, _process_id=None, _user_id=None,
                              _occurred_when=None, _address=None,_node_id=None, _uid=None, _pid=None):
 
@@ -256,20 +420,23 @@ def make_textual_log_message(_data, _category=None, _severity=None, _process_id=
 
     """
 
-    _result = "Process Id: " + (str(_process_id) if _process_id is not None else "Not available")
-    _result += ", Adress: " + (str(_address) if _address is not None else str("None"))
-    _result += (" - An error occurred:\n" if _severity > 2 else " - Message:\n") + str(_data)
-    _result += "\nEvent category: " + category_to_identifier(_category,
-                                                             "invalid event category:") if _category is not None else ""
-    _result += "\nSeverity: " + severity_to_identifier(_severity,
-                                                       "invalid severity level:") if _severity is not None else ""
-    _result += "\nUser Id: " + str(_user_id) if _user_id is not None else ""
-    _result += "\nOccurred when: " + str(_occurred_when) if _occurred_when is not None else ""
-    _result += "\nEntity Id: " + str(_node_id) if _node_id is not None else ""
-    _result += "\nSystem uid: " + (str(_uid) if _uid is not None else str(os.getlogin()))
-    _result += "\nSystem pid: " + (str(_pid) if _pid is not None else str(os.getpid()))
+    _parts = ["Process Id: ", str(_process_id) if _process_id is not None else "Not available",
+              ", Adress: ", str(_address),
+              " - An error occurred:\n" if _severity > 2 else " - Message:\n", str(_data)]
+    if _category is not None:
+        _parts += ["\nEvent category: ", category_to_identifier(_category, "invalid event category:")]
+    if _severity is not None:
+        _parts += ["\nSeverity: ", severity_to_identifier(_severity, "invalid severity level:")]
+    if _user_id is not None:
+        _parts += ["\nUser Id: ", str(_user_id)]
+    if _occurred_when is not None:
+        _parts += ["\nOccurred when: ", str(_occurred_when)]
+    if _node_id is not None:
+        _parts += ["\nEntity Id: ", str(_node_id)]
+    _parts += ["\nSystem uid: ", str(_uid) if _uid is not None else get_uid(),
+               "\nSystem pid: ", str(_pid if _pid is not None else get_pid())]
 
-    return _result
+    return "".join(_parts)
 
 
 def make_sparse_log_message(_data, _category=None, _severity=None, _process_id=None, _user_id=None,
@@ -299,26 +466,35 @@ def make_sparse_log_message(_data, _category=None, _severity=None, _process_id=N
     else:
         _prefix = "*"
 
-    _result = _prefix + "a: " + (str(_address) if _address is not None else str("None"))
-    _result += ", pid: " + (str(_pid) if _pid is not None else str(os.getpid()))
-    _result += ", uid: " + (str(_uid) if _uid is not None else str(os.getlogin()))
-
-    if "\n" in _data:
-        _result += ", data: (multirow, see below)"
-        _result += ", ec: " + category_to_identifier(_category,"INV") if _category is not None else "N/A"
-        _result += ", sev: " + severity_to_identifier(_severity,"INV") if _severity is not None else "N/A"
-        _result += ", p_id: " + (str(_process_id) if _process_id is not None else "N/A")
-        _result += ", u_id: " + str(_user_id) if _user_id is not None else ""
-        _result += ", t: " + str(_occurred_when) if _occurred_when is not None else ""
-        _result += ", node_id: " + str(_node_id) if _node_id is not None else ""
-        _result += "\n===\n" + str(_data) +"\n=== "
+    _parts = [_prefix, "a: ", str(_address),
+              ", pid: ", str(_pid if _pid is not None else get_pid()),
+              ", uid: ", str(_uid) if _uid is not None else get_uid()]
+
+    _multirow = "\n" in _data
+    if _multirow:
+        _parts.append(", data: (multirow, see below)")
+        _category_prefix = ", ec: "
+    else:
+        _parts += [", data: ", str(_data), ", "]
+        _category_prefix = "ec: "
+
+    if _category is not None:
+        _parts += [_category_prefix, category_to_identifier(_category, "INV")]
+    else:
+        _parts.append("N/A")
+    if _severity is not None:
+        _parts += [", sev: ", severity_to_identifier(_severity, "INV")]
     else:
-        _result += ", data: " + str(_data) + ", "
-        _result += "ec: " + category_to_identifier(_category,"INV") if _category is not None else "N/A"
-        _result += ", sev: " + severity_to_identifier(_severity,"INV") if _severity is not None else "N/A"
-        _result += ", p_id: " + (str(_process_id) if _process_id is not None else "N/A")
-        _result += ", u_id: " + str(_user_id) if _user_id is not None else ""
-        _result += ", t: " + str(_occurred_when) if _occurred_when is not None else ""
-        _result += ", node_id: " + str(_node_id) if _node_id is not None else ""
-
-    return _result
+        _parts.append("N/A")
+    _parts += [", p_id: ", str(_process_id) if _process_id is not None else "N/A"]
+    if _user_id is not None:
+        _parts += [", u_id: ", str(_user_id)]
+    if _occurred_when is not None:
+        _parts += [", t: ", str(_occurred_when)]
+    if _node_id is not None:
+        _parts += [", node_id: ", str(_node_id)]
+
+    if _multirow:
+        _parts += ["\n===\n", str(_data), "\n=== "]
+
+    return "".join(_parts)
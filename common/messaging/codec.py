@@ -0,0 +1,120 @@
+"""
+The codec module encodes and decodes the JSON that is sent over web sockets and the web service API.
+The standard library json module is used by default, orjson or ujson can be used instead when installed, see use_codec.
+All codecs encode ObjectId instances as strings, and datetime instances like str() does, so documents can be
+encoded as they are read from the database.
+
+Created on Oct 18, 2026
+
+@author: Nicklas Boerjesson
+"""
+
+import datetime
+import json
+
+from bson.objectid import ObjectId
+
+__author__ = 'Nicklas Borjesson'
+
+#: The standard library json module
+CODEC_JSON = "json"
+#: orjson, https://github.com/ijl/orjson
+CODEC_ORJSON = "orjson"
+#: ujson, version 5.1 or later, https://github.com/ultrajson/ultrajson
+CODEC_UJSON = "ujson"
+#: The fastest installed codec
+CODEC_AUTO = "auto"
+
+#: The name of the codec in use
+name = None
+
+# The encoding and decoding functions of the codec in use
+_encode = None
+_decode = None
+
+
+def encode_default(_value):
+    """
+    Encodes the values JSON has no type for, called by the codecs.
+
+    :param _value: The value
+    :return: The value as a string
+    """
+    if isinstance(_value, (ObjectId, datetime.datetime, datetime.date)):
+        return str(_value)
+    raise TypeError("encode_default: Cannot encode values of the type " + type(_value).__name__ + " as JSON")
+
+
+def _make_json():
+    _encoder = json.JSONEncoder(default=encode_default)
+    return lambda _data: _encoder.encode(_data).encode(), json.loads
+
+
+def _make_orjson():
+    import orjson
+    # Datetime instances are passed to encode_default to encode them like the other codecs
+    _options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    return lambda _data: orjson.dumps(_data, default=encode_default, option=_options), orjson.loads
+
+
+def _make_ujson():
+    import ujson
+    return lambda _data: ujson.dumps(_data, default=encode_default, escape_forward_slashes=False).encode(), \
+        ujson.loads
+
+
+_codec_factories = {
+    CODEC_JSON: _make_json,
+    CODEC_ORJSON: _make_orjson,
+    CODEC_UJSON: _make_ujson
+}
+
+
+def use_codec(_name=CODEC_JSON):
+    """
+    Set the codec that is used for all encoding and decoding.
+
+    :param _name: The name of the codec, one of the CODEC_* constants
+    :return: The name of the codec in use, with CODEC_AUTO, the one that was chosen
+    """
+    global name, _encode, _decode
+
+    if _name == CODEC_AUTO:
+        for _curr_name in [CODEC_ORJSON, CODEC_UJSON]:
+            try:
+                return use_codec(_curr_name)
+            except ImportError:
+                pass
+        _name = CODEC_JSON
+
+    if _name not in _codec_factories:
+        raise Exception("use_codec: Unknown codec: " + str(_name))
+    try:
+        _encode, _decode = _codec_factories[_name]()
+    except ImportError:
+        raise ImportError("use_codec: The " + _name + " codec is not installed")
+    name = _name
+    return name
+
+
+def encode(_data):
+    """
+    Encode data as JSON
+
+    :param _data: The data
+    :return: The JSON, as UTF-8 encoded bytes
+    """
+    return _encode(_data)
+
+
+def decode(_json):
+    """
+    Decode JSON
+
+    :param _json: The JSON, as a string or as UTF-8 encoded bytes
+    :return: The decoded data
+    """
+    return _decode(_json)
+
+
+use_codec(CODEC_JSON)
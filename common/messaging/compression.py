@@ -0,0 +1,150 @@
+"""
+The compression module implements the Compressor class, that compresses the web socket messages to peers that have
+negotiated compression when registering.
+Compressed messages are sent as binary frames with zlib-compressed JSON, messages below a size threshold are sent as
+text frames, as before.
+
+Created on Oct 18, 2026
+
+@author: Nicklas Boerjesson
+"""
+
+import threading
+import time
+import zlib
+
+__author__ = 'Nicklas Borjesson'
+
+#: zlib compression, the only compression method
+COMPRESSION_ZLIB = "zlib"
+#: The default maximum size, in bytes, of a decompressed message
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+
+def decompress_frame(_data, _max_size=MAX_DECOMPRESSED_SIZE):
+    """
+    Decompress the payload of a binary frame. Binary frames that are not compressed, that are JSON, are returned as
+    they are.
+
+    :param _data: The payload
+    :param _max_size: The maximum size, in bytes, of the decompressed payload, larger payloads are not decompressed
+    :return: The JSON, as bytes
+    """
+    if _data[:1] in (b"{", b"["):
+        return _data
+    _decompressor = zlib.decompressobj()
+    _result = _decompressor.decompress(_data, _max_size)
+    if _decompressor.unconsumed_tail:
+        raise Exception("decompress_frame: The payload decompresses to more than the maximum of " + str(_max_size) +
+                        " bytes")
+    if not _decompressor.eof:
+        raise Exception("decompress_frame: The compressed payload is incomplete")
+    return _result
+
+
+def sum_metrics(_compressors):
+    """
+    Sums the metrics of several compressors
+
+    :param _compressors: An iterable of compressors
+    :return: The summed metrics, see Compressor.metrics, and the number of compressors under "peers"
+    """
+    _result = {"peers": 0, "compressed": 0, "uncompressed": 0, "bytesIn": 0, "bytesOut": 0, "bytesSaved": 0,
+               "cpuTime": 0}
+    for _curr_compressor in _compressors:
+        _result["peers"] += 1
+        for _curr_key, _curr_value in _curr_compressor.metrics().items():
+            _result[_curr_key] += _curr_value
+    return _result
+
+
+class Compressor(object):
+    """
+    Compresses the messages to a peer, and decompresses those from it. It belongs to the session of the peer, like its
+    send queue, and keeps metrics on the bytes saved and the CPU time spent compressing.
+    """
+
+    #: Messages smaller than this, in bytes, are not compressed
+    threshold = None
+    #: The zlib compression level, 1-9, -1 is the zlib default
+    level = None
+    #: The maximum size, in bytes, of a decompressed message from the peer
+    max_decompressed_size = None
+    #: Metrics; the number of compressed and uncompressed messages, the bytes before and after compression, and the
+    #: CPU time spent compressing, in seconds
+    compressed = None
+    uncompressed = None
+    bytes_in = None
+    bytes_out = None
+    cpu_time = None
+    lock = None
+
+    def __init__(self, _threshold=1024, _level=-1, _max_decompressed_size=MAX_DECOMPRESSED_SIZE):
+        """
+        Initialize the compressor
+
+        :param _threshold: Messages smaller than this, in bytes, are not compressed
+        :param _level: The zlib compression level, 1-9, -1 is the zlib default
+        :param _max_decompressed_size: The maximum size, in bytes, of a decompressed message from the peer
+        """
+        self.threshold = _threshold
+        self.level = _level
+        self.max_decompressed_size = _max_decompressed_size
+        self.compressed = 0
+        self.uncompressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0
+        self.lock = threading.Lock()
+
+    def compress(self, _frame):
+        """
+        Compress the payload of a frame, if it is large enough and compression makes it smaller.
+
+        :param _frame: The JSON, as bytes
+        :return: A tuple of the payload and whether it is compressed and should be sent as a binary frame
+        """
+        if len(_frame) < self.threshold:
+            with self.lock:
+                self.uncompressed += 1
+            return _frame, False
+
+        _started = time.thread_time()
+        _compressed = zlib.compress(_frame, self.level)
+        _cpu_time = time.thread_time() - _started
+        # Incompressible data is sent as it is
+        _use_compressed = len(_compressed) < len(_frame)
+        with self.lock:
+            self.cpu_time += _cpu_time
+            if _use_compressed:
+                self.compressed += 1
+                self.bytes_in += len(_frame)
+                self.bytes_out += len(_compressed)
+            else:
+                self.uncompressed += 1
+
+        if _use_compressed:
+            return _compressed, True
+        else:
+            return _frame, False
+
+    def decompress(self, _data):
+        """
+        Decompress the payload of a binary frame from the peer, see decompress_frame.
+
+        :param _data: The payload
+        :return: The JSON, as bytes
+        """
+        return decompress_frame(_data, self.max_decompressed_size)
+
+    def metrics(self):
+        """
+        Returns the metrics of the compressor
+
+        :return: A dict with the number of compressed and uncompressed messages, the bytes of the compressed messages
+            before and after compression, the bytes saved and the CPU time spent compressing, in seconds
+        """
+        with self.lock:
+            return {"compressed": self.compressed, "uncompressed": self.uncompressed, "bytesIn": self.bytes_in,
+                    "bytesOut": self.bytes_out, "bytesSaved": self.bytes_in - self.bytes_out,
+                    "cpuTime": self.cpu_time}
@@ -38,6 +38,8 @@ TLS_FAILURE = 1015
 BROKER_RESTARTING = 4011
 #: 4012 is a private value that indicates that a socket is closed because the broker is shutting down, this to tell agents to wait a longer and periodically reconnect
 BROKER_SHUTTING_DOWN = 4012
+#: 4013 is a private value that indicates that a socket is closed because the peer did not keep up with the messages sent to it, the agent may reconnect
+SLOW_CONSUMER = 4013
 
 
 #: 1004 is Reserved.  The specific meaning might be defined in the future.
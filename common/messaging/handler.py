@@ -32,6 +32,8 @@ class WebSocketHandler(Handler):
     schema_tools = None
     # Short cut between message categories and handlers
     category_shortcut = None
+    # Short cut between message categories and handlers that also take the frame the message was received in
+    frame_shortcut = None
 
     def __init__(self, _process_id, _peers, _schema_tools, _address):
         """
@@ -47,6 +49,7 @@ class WebSocketHandler(Handler):
         self.schema_tools = _schema_tools
         self.address__session = {}
         self.category_shortcut = {}
+        self.frame_shortcut = {}
         self._last_message_id = 0
         self.web_socket_lock = Lock()
 
@@ -77,12 +80,14 @@ class WebSocketHandler(Handler):
             if _close_socket:
                 _web_socket.close(code=PROTOCOL_ERROR, reason=_error)
 
-    def get_handler(self, _web_socket, _schema_id):
+    def get_handler(self, _web_socket, _schema_id, _frame=None):
         """
         Find the appropriate handler for the schema
 
         :param _web_socket: If applicable, a web socket
         :param _schema_id: The message schema id
+        :param _frame: If applicable, the frame the message was received in, as bytes
+        :return: A handler function that takes the web socket and the message
         """
 
         try:
@@ -92,25 +97,47 @@ class WebSocketHandler(Handler):
             self.handle_error("No category found for schema Id " + str(_schema_id),
                 _web_socket=_web_socket, _category=EC_PROBE, _severity=SEV_ERROR)
             return None
+        if _frame is not None and _category in self.frame_shortcut:
+            _frame_handler = self.frame_shortcut[_category]
+            return lambda _web_socket, _message_data: _frame_handler(_web_socket, _message_data, _frame)
         try:
             return self.category_shortcut[_category]
         except KeyError:
             raise Exception(self.log_prefix + "No handler for category: " + str(_category))
 
-    def handle(self, _item):
+    def shard_key(self, _item):
         """
-        The handle function is called when a monitor finds an unhandled item on its queue.
-        The WebSocketHandler uses the schemaRef and schema categories to find the correct handler for the item.
-        :param _item: The message
+        Messages from the same peer are handled in order, as are outgoing messages to the same destination.
+
+        :param _item: The queue item, a list of the web socket (if the message is incoming) and the message
+        :return: The peer address
+        """
+        _web_socket = _item[0]
+        if _web_socket:
+            return _web_socket.address
+        elif isinstance(_item[1], dict):
+            return _item[1].get("destination")
+        else:
+            return None
+
+    def resolve(self, _item):
+        """
+        Resolve the handler of an item. The WebSocketHandler uses the schemaRef and schema categories to find the
+        correct handler for the item.
+
+        :param _item: The queue item, a list of the web socket (if the message is incoming) and the message,
+            incoming messages are followed by the frame they were received in
+        :return: A tuple of a function without parameters that handles the item, and whether it blocks, see
+            Handler.resolve. None if there is no handler for the item, the error is then already handled.
         """
 
         _web_socket = _item[0]
         _message_data = _item[1]
 
         if _web_socket:
-            self.write_dbg_info("Handling " + _web_socket.address + " - message : " + str(_message_data))
+            self.write_dbg_info("Handling %s - message : %s", _web_socket.address, _message_data)
         else:
-            self.write_dbg_info("Handling outgoing message : " + str(_message_data))
+            self.write_dbg_info("Handling outgoing message : %s", _message_data)
 
         try:
             _schema_id = _message_data["schemaRef"]
@@ -118,16 +145,40 @@ class WebSocketHandler(Handler):
             # A proper running system should never encounter this error, so this is considered a concious probe
             self.handle_error("No schema id found in message",
                 _category=EC_PROBE, _severity=SEV_ERROR, _web_socket = _web_socket)
-            return
+            return None
 
-        _handler = self.get_handler(_web_socket, _schema_id)
+        _handler = self.get_handler(_web_socket, _schema_id, _item[2] if len(_item) > 2 else None)
+        if _handler is None:
+            return None
 
-        try:
-            _handler(_web_socket, _message_data)
-        except Exception as e:
-            self.handle_error("Error running handler " + str(_schema_id) + " Error: " + str(e),
-                _category=EC_INTERNAL, _severity=SEV_ERROR, _web_socket = _web_socket)
+        def _handle():
+            try:
+                _handler(_web_socket, _message_data)
+            except Exception as e:
+                self.handle_error("Error running handler " + str(_schema_id) + " Error: " + str(e),
+                    _category=EC_INTERNAL, _severity=SEV_ERROR, _web_socket = _web_socket)
+
+        return _handle, self.is_blocking(_schema_id, _message_data)
+
+    def is_blocking(self, _schema_id, _message_data):
+        """
+        Override this to tell an asynchronous monitor which messages are handled using blocking I/O, like database
+        writes, and have to be handled outside of its event loop.
+
+        :param _schema_id: The schemaRef of the message
+        :param _message_data: The message
+        :return: True if handling the message blocks
+        """
+        return False
 
+    def handle(self, _item):
+        """
+        The handle function is called when a monitor finds an unhandled item on its queue.
+        :param _item: The message
+        """
+        _resolved = self.resolve(_item)
+        if _resolved:
+            _resolved[0]()
 
     def shut_down(self, _user_id, _code=GOING_AWAY):
         """
@@ -163,6 +214,7 @@ class WebSocketHandler(Handler):
             # Set the address of the socket
             _web_socket.address = _session["address"]  # Perhaps the web socket should set this itself, dunno..
             _web_socket.message_queue = _session["queue"]
+            _web_socket.compressor = _session.get("compressor")
             _web_socket.process_id = self.process_id
             _web_socket.address_own = self.address
             # Add the peer to the address session dict
@@ -0,0 +1,322 @@
+"""
+The send_loop module implements the SendLoop and SendQueue classes, that send the queued messages of all web sockets
+using a small pool of threads, instead of one thread per web socket.
+Peers that have negotiated batching when registering, are sent their queued messages in batches, a JSON list of
+messages per frame, instead of one frame per message.
+
+Created on Oct 18, 2026
+
+@author: Nicklas Boerjesson
+"""
+
+import threading
+import time
+import traceback
+from collections import deque
+
+from of.common.logging import write_to_log, EC_COMMUNICATION, EC_RESOURCE, SEV_ERROR, SEV_WARNING
+from of.common.messaging.constants import SLOW_CONSUMER
+
+__author__ = 'Nicklas Borjesson'
+
+#: When a send queue is full, drop the oldest queued message
+POLICY_DROP_OLDEST = "dropOldest"
+#: When a send queue is full, drop the new message
+POLICY_DROP_NEWEST = "dropNewest"
+#: When a send queue is full, close the web socket as a slow consumer and drop the queued messages
+POLICY_CLOSE = "close"
+
+
+class SendQueue(object):
+    """
+    A bounded queue of messages to send to a peer. It belongs to the session of the peer, and outlives its web sockets;
+    messages queued while no web socket is attached are sent when one is.
+    """
+
+    #: The send loop that sends the messages
+    send_loop = None
+    #: The queued messages
+    messages = None
+    #: The maximum number of queued messages
+    max_size = None
+    #: What to do when the queue is full, one of the POLICY_* constants
+    policy = None
+    #: The web socket the messages are sent to, None if not connected
+    web_socket = None
+    #: True if the queue is waiting for, or being serviced by, the send loop
+    scheduled = None
+    #: If true, the messages are sent in batches
+    batching = None
+    #: Metrics; the number of sent and dropped messages, and of sent batches
+    sent = None
+    dropped = None
+    batches = None
+    lock = None
+
+    def __init__(self, _send_loop, _max_size=None, _policy=None, _batching=False):
+        """
+        Initialize the queue
+
+        :param _send_loop: The send loop that sends the messages
+        :param _max_size: The maximum number of queued messages, defaults to that of the send loop
+        :param _policy: What to do when the queue is full, one of the POLICY_* constants, defaults to that of the send
+            loop
+        :param _batching: If true, the messages are sent in batches, the peer must have negotiated this
+        """
+        self.send_loop = _send_loop
+        self.messages = deque()
+        self.max_size = _max_size if _max_size is not None else _send_loop.max_queue_size
+        self.policy = _policy if _policy is not None else _send_loop.policy
+        self.scheduled = False
+        self.batching = _batching
+        self.sent = 0
+        self.dropped = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+        _send_loop.add_queue(self)
+
+    def put(self, _message):
+        """
+        Queue a message for sending, if the queue is full, the policy decides what happens.
+
+        :param _message: The message
+        """
+        _slow_web_socket = None
+        with self.lock:
+            if len(self.messages) >= self.max_size:
+                if self.policy == POLICY_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.policy == POLICY_DROP_OLDEST or self.web_socket is None:
+                    # Without a web socket, there is nothing to close
+                    self.messages.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += len(self.messages) + 1
+                    self.messages.clear()
+                    _slow_web_socket = self.web_socket
+
+            if _slow_web_socket is None:
+                self.messages.append(_message)
+                self._schedule()
+
+        if _slow_web_socket:
+            write_to_log("SendQueue: The peer at " + str(_slow_web_socket.address) +
+                         " did not keep up with its messages, closing its web socket.",
+                         _category=EC_RESOURCE, _severity=SEV_WARNING)
+            _slow_web_socket.close(code=SLOW_CONSUMER, reason="Slow consumer, the send queue was full")
+
+    def _schedule(self):
+        """
+        Schedule the queue for sending, if there is anything to send and it isn't already. Call while locked.
+        """
+        if not self.scheduled and self.web_socket is not None and self.messages:
+            self.scheduled = True
+            # Unless there already is a full batch, wait a little for more messages to batch
+            self.send_loop.schedule(self, _delay=self.batching and len(self.messages) < self.send_loop.max_batch_size)
+
+    def attach(self, _web_socket):
+        """
+        Start sending the messages to a web socket
+
+        :param _web_socket: The web socket
+        """
+        with self.lock:
+            self.web_socket = _web_socket
+            self._schedule()
+
+    def detach(self, _web_socket):
+        """
+        Stop sending messages to a web socket, queued messages are kept for any later web socket of the session.
+
+        :param _web_socket: The web socket
+        """
+        with self.lock:
+            if self.web_socket is _web_socket:
+                self.web_socket = None
+
+    def take(self, _max_count):
+        """
+        Take messages to send, called by the send loop.
+
+        :param _max_count: The maximum number of messages to take
+        :return: A tuple of the web socket and a list of messages
+        """
+        with self.lock:
+            if self.web_socket is None:
+                return None, []
+            _messages = [self.messages.popleft() for _curr_index in range(min(_max_count, len(self.messages)))]
+            return self.web_socket, _messages
+
+    def done(self):
+        """
+        Called by the send loop after sending, reschedules the queue if more messages have been queued.
+        """
+        with self.lock:
+            self.scheduled = False
+            self._schedule()
+
+
+class SendLoop(object):
+    """
+    The send loop sends the queued messages of all web sockets using a small pool of threads. A thread takes a
+    scheduled queue, sends at most max_batch_size of its messages and reschedules it if there are more, so that busy
+    peers do not starve others. A queue is only serviced by one thread at a time, so messages to each peer are sent
+    in order.
+    The messages taken from a batching queue are sent in a single frame. If there is a batch delay, a batching queue
+    is serviced that long after it is scheduled, so that the messages queued in the meantime are sent in the same batch.
+    """
+
+    #: Queues with messages to send
+    ready = None
+    #: Batching queues waiting for the batch delay to pass, and when it has, in scheduling order
+    delayed = None
+    #: The time, in seconds, batching queues wait for more messages before being serviced
+    batch_delay = None
+    #: Signals the sender threads that queues are ready, or that they should stop
+    condition = None
+    #: The sender threads
+    threads = None
+    #: The maximum number of messages sent from one queue before servicing others
+    max_batch_size = None
+    #: If true, the sender threads are terminated
+    terminated = None
+    #: All send queues, for the metrics
+    queues = None
+    #: The default maximum number of queued messages per peer
+    max_queue_size = None
+    #: The default policy for full queues, one of the POLICY_* constants
+    policy = None
+
+    def __init__(self, _threads=1, _max_batch_size=100, _max_queue_size=1000, _policy=POLICY_CLOSE, _batch_delay=0):
+        """
+        Initialize and start the send loop
+
+        :param _threads: The number of sender threads
+        :param _max_batch_size: The maximum number of messages sent from one queue before servicing others, and so the
+            maximum number of messages in a batch
+        :param _max_queue_size: The default maximum number of queued messages per peer
+        :param _policy: The default policy for full queues, one of the POLICY_* constants
+        :param _batch_delay: The time, in seconds, batching queues wait for more messages before being serviced
+        """
+        self.ready = deque()
+        self.delayed = deque()
+        self.batch_delay = _batch_delay
+        self.condition = threading.Condition()
+        self.max_batch_size = _max_batch_size
+        self.max_queue_size = _max_queue_size
+        self.policy = _policy
+        self.terminated = False
+        self.queues = []
+        self.threads = [threading.Thread(target=self.run, name="Send loop thread " + str(_curr_index), daemon=True)
+                        for _curr_index in range(_threads)]
+        for _curr_thread in self.threads:
+            _curr_thread.start()
+
+    def add_queue(self, _send_queue):
+        """
+        Keep track of a queue, for the metrics
+        """
+        with self.condition:
+            self.queues.append(_send_queue)
+
+    def remove_queue(self, _send_queue):
+        """
+        Stop keeping track of a queue, when its session has ended
+        """
+        with self.condition:
+            if _send_queue in self.queues:
+                self.queues.remove(_send_queue)
+
+    def schedule(self, _send_queue, _delay=False):
+        """
+        Schedule a queue for sending, wakes up a sender thread.
+
+        :param _send_queue: The queue
+        :param _delay: If true, the queue is serviced after the batch delay
+        """
+        with self.condition:
+            if _delay and self.batch_delay:
+                # All queues are delayed equally long, so they become due in the order they are delayed
+                self.delayed.append((time.perf_counter() + self.batch_delay, _send_queue))
+            else:
+                self.ready.append(_send_queue)
+            self.condition.notify()
+
+    def _next_queue(self):
+        """
+        Wait for a queue to service, call while holding the condition.
+
+        :return: The queue, or None if terminated
+        """
+        while not self.terminated:
+            if self.ready:
+                return self.ready.popleft()
+            if self.delayed:
+                _wait = self.delayed[0][0] - time.perf_counter()
+                if _wait <= 0:
+                    return self.delayed.popleft()[1]
+                self.condition.wait(_wait)
+            else:
+                self.condition.wait()
+        return None
+
+    def run(self):
+        """
+        Sends the messages of scheduled queues until terminated.
+        """
+        while True:
+            with self.condition:
+                _send_queue = self._next_queue()
+            if _send_queue is None:
+                break
+
+            _web_socket, _messages = _send_queue.take(self.max_batch_size)
+            if _send_queue.batching and len(_messages) > 1:
+                try:
+                    _web_socket.send_batch(_messages)
+                    _send_queue.sent += len(_messages)
+                    _send_queue.batches += 1
+                except Exception as e:
+                    write_to_log("SendLoop: Error sending a batch of " + str(len(_messages)) + " messages to " +
+                                 str(_web_socket.address) + ":" + str(e) + "\nTraceback:" + traceback.format_exc(),
+                                 _category=EC_COMMUNICATION, _severity=SEV_ERROR)
+            else:
+                for _curr_message in _messages:
+                    try:
+                        _web_socket.send_message(_curr_message)
+                        _send_queue.sent += 1
+                    except Exception as e:
+                        write_to_log("SendLoop: Error sending message to " + str(_web_socket.address) + ":" + str(e) +
+                                     "\nTraceback:" + traceback.format_exc(),
+                                     _category=EC_COMMUNICATION, _severity=SEV_ERROR)
+            _send_queue.done()
+
+    def stop(self, _timeout=None):
+        """
+        Stop the sender threads, messages that have not been sent are left in their queues.
+
+        :param _timeout: The longest time, in seconds, to wait for each thread
+        """
+        with self.condition:
+            self.terminated = True
+            self.condition.notify_all()
+        for _curr_thread in self.threads:
+            _curr_thread.join(_timeout)
+
+    def metrics(self):
+        """
+        Returns the metrics of the send loop
+
+        :return: A dict with the number of threads, queues, connected peers, queued, sent and dropped messages and sent
+            batches
+        """
+        with self.condition:
+            _queues = list(self.queues)
+        return {"threads": len(self.threads),
+                "queues": len(_queues),
+                "connected": len([_curr_queue for _curr_queue in _queues if _curr_queue.web_socket is not None]),
+                "queued": sum([len(_curr_queue.messages) for _curr_queue in _queues]),
+                "sent": sum([_curr_queue.sent for _curr_queue in _queues]),
+                "dropped": sum([_curr_queue.dropped for _curr_queue in _queues]),
+                "batches": sum([_curr_queue.batches for _curr_queue in _queues])}
@@ -10,7 +10,6 @@ import os
 import socket
 import platform
 import datetime
-import json
 import logging
 
 from of import __release__, __copyright__
@@ -24,6 +23,7 @@ from requests.cookies import RequestsCookieJar
 from of.common.logging import write_to_log, EC_NOTIFICATION, SEV_DEBUG, SEV_FATAL, EC_SERVICE, SEV_ERROR, \
     EC_COMMUNICATION
 from of.common.messaging.factory import get_current_login
+from of.common.messaging import codec
 import requests
 import urllib3
 from urllib3.exceptions import InsecureRequestWarning
@@ -71,7 +71,27 @@ def get_environment_data():
 def write_dbg_info(_data):
     write_to_log(_data, _category=EC_NOTIFICATION, _severity=SEV_DEBUG)
 
-def register_at_broker(_address, _type, _server, _username, _password, _log_prefix="", _verify_SSL=True):
+def register_at_broker(_address, _type, _server, _username, _password, _log_prefix="", _verify_SSL=True,
+                       _batching=False, _compression=None):
+    """
+    Register a peer at the broker
+
+    :param _address: The peer address
+    :param _type: The peer type
+    :param _server: The URL of the broker
+    :param _username: The user name
+    :param _password: The password
+    :param _log_prefix: A prefix for log messages
+    :param _verify_SSL: If true, verify the SSL certificate of the broker
+    :param _batching: If true, ask the broker to send messages in batches, a JSON list of messages per frame. If it
+        agrees, the "batching" key of the result is true.
+    :param _compression: If set, ask the broker to send messages compressed using this method, only "zlib" is
+        supported, see of.common.messaging.compression. If it agrees, it is the "compression" key of the result,
+        and the web socket of the peer needs a Compressor, see OptimalWebSocket.compressor, to accept the compressed
+        messages.
+    :return: The session id, settings, whether messages are sent in batches and their compression, False if
+        registering failed
+    """
     _log_prefix = make_log_prefix(_log_prefix)
 
     _data = {
@@ -83,12 +103,14 @@ def register_at_broker(_address, _type, _server, _username, _password, _log_pref
         },
         "environment": get_environment_data(),
         "peerType": _type,
-        "address": _address
+        "address": _address,
+        "batching": _batching,
+        "compression": _compression
     }
     write_dbg_info(_log_prefix + "[" + str(datetime.datetime.utcnow()) + "] Registering at broker API.")
 
     _headers = {'content-type': 'application/json'}
-    _response = requests.post(_server + "/register", data=json.dumps(_data), auth=('user', 'pass'), headers=_headers,
+    _response = requests.post(_server + "/register", data=codec.encode(_data), auth=('user', 'pass'), headers=_headers,
                               verify=_verify_SSL)
     if _response.status_code == 500:
         write_dbg_info(_log_prefix + "Broker login failed with internal server error! Exiting.")
@@ -97,7 +119,7 @@ def register_at_broker(_address, _type, _server, _username, _password, _log_pref
         write_dbg_info(_log_prefix + "Broker login failed with error + "+ str(_response.status_code) + "! Exiting.")
         return False
 
-    _response_dict = _response.json()
+    _response_dict = codec.decode(_response.content)
     if _response_dict is not None:
         _data = _response_dict
 
@@ -136,7 +158,7 @@ def call_api(_url, _session_id, _data, _timeout=None, _print_log=None, _verify_S
 
     _headers = {'content-type': 'application/json'}
 
-    _response = requests.post(_url, data=json.dumps(_data), headers=_headers, timeout=_timeout,
+    _response = requests.post(_url, data=codec.encode(_data), headers=_headers, timeout=_timeout,
                               verify=_verify_SSL, cookies=_cookie_jar)
 
     _response_dict = None
@@ -150,7 +172,7 @@ def call_api(_url, _session_id, _data, _timeout=None, _print_log=None, _verify_S
     else:
         if _response.content:
             try:
-                _response_dict = _response.json()
+                _response_dict = codec.decode(_response.content)
             except Exception as e:
                 do_log("response.content didn't contain JSON data", _category=EC_COMMUNICATION, _severity=SEV_ERROR)
                 _response_dict = None
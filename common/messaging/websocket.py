@@ -6,18 +6,17 @@ Created on Jan 22, 2016
 """
 import os
 import threading
-from queue import Empty
-import json
 import traceback
 
 
 from of.common.logging import write_to_log, EC_COMMUNICATION, SEV_DEBUG, SEV_ERROR, EC_INTERNAL, SEV_INFO, \
-    make_sparse_log_message
-import of.common.logging
+    make_sparse_log_message, is_enabled
 from of.common.messaging.factory import reply_with_error_message
-from of.common.messaging.constants import ABNORMAL_CLOSE
+from of.common.messaging.constants import ABNORMAL_CLOSE, UNACCEPTABLE_DATA
+from of.common.messaging.send_loop import SendQueue
+from of.common.messaging import codec
 
-from ws4py.messaging import TextMessage
+from ws4py.messaging import Message
 
 __author__ = 'Nicklas Borjesson'
 
@@ -26,6 +25,24 @@ The monitor global variable is used to be able to register the web socket with t
 This is not optimal, but the ws4py offer no other way to reach outside its contexts, as it has no parameters.
 """
 monitor = None
+"""
+The send_loop global variable holds the SendLoop that sends the queued messages of the web sockets.
+"""
+send_loop = None
+
+
+def requeue_first(_queue, _message):
+    """
+    Put a message that was taken from a queue.Queue back first in it, so that it is not sent after the messages
+    queued after it.
+
+    :param _queue: The queue.Queue
+    :param _message: The message
+    """
+    with _queue.not_empty:
+        _queue.queue.appendleft(_message)
+        _queue.unfinished_tasks += 1
+        _queue.not_empty.notify()
 
 
 class OptimalWebSocket(object):
@@ -52,6 +69,10 @@ class OptimalWebSocket(object):
     #: The message queue of the socket
     message_queue = None
 
+    #: Compresses the messages sent to the peer, and decompresses those from it, None if the peer has not negotiated
+    #: compression
+    compressor = None
+
     # The socket is connected
     connected = None
 
@@ -77,16 +98,24 @@ class OptimalWebSocket(object):
 
         self.start_monitoring_message_queue()
 
-    def write_dbg_info(self, _data):
-        write_to_log(self.log_prefix + str(_data),
-                     _category=EC_COMMUNICATION, _severity=SEV_DEBUG, _process_id=self.process_id)
+    def write_dbg_info(self, _data, *_args):
+        if is_enabled(SEV_DEBUG):
+            write_to_log(self.log_prefix + (_data % _args if _args else str(_data)),
+                         _category=EC_COMMUNICATION, _severity=SEV_DEBUG, _process_id=self.process_id)
 
     def start_monitoring_message_queue(self):
         """
-        Start monitoring the message queue
+        Start sending the messages in the message queue. A SendQueue is serviced by its send loop, other queues by a
+        thread of its own.
         """
+        if isinstance(self.message_queue, SendQueue):
+            self.message_queue.attach(self)
+            return
+
         self.monitor_message_queue_thread = threading.Thread(target=self.monitor_message_queue,
-                                                             name=self.address + " message queue monitor thread")
+                                                             name=self.address + " message queue monitor thread",
+                                                             daemon=True)
+        self.monitor_message_queue_thread.terminated = False
         self.monitor_message_queue_thread.start()
         self.write_dbg_info("Message queue thread started: " + str(self.monitor_message_queue_thread.name))
 
@@ -105,12 +134,38 @@ class OptimalWebSocket(object):
         """
 
 
-        if str(message) != "":
-            self.write_dbg_info("Got this message(putting on queue):" + str(message))
-            if isinstance(message, TextMessage):
-                monitor.queue.put([self, json.loads(str(message))])
+        # Keep the frame as it was received, so that a message that is only passed on does not have to be encoded again
+        if isinstance(message, Message):
+            if message.is_binary:
+                # Binary frames are compressed, see send_frame, and only accepted if compression has been negotiated
+                if self.compressor is None:
+                    write_to_log(self.log_prefix + "Closing, got a binary frame without having negotiated compression.",
+                                 _category=EC_COMMUNICATION, _severity=SEV_ERROR)
+                    self.close(code=UNACCEPTABLE_DATA, reason="Compression has not been negotiated")
+                    return
+                try:
+                    _frame = self.compressor.decompress(message.data)
+                except Exception as e:
+                    write_to_log(self.log_prefix + "Closing, failed to decompress a frame:" + str(e),
+                                 _category=EC_COMMUNICATION, _severity=SEV_ERROR)
+                    self.close(code=UNACCEPTABLE_DATA, reason="The frame could not be decompressed")
+                    return
             else:
-                monitor.queue.put([self, json.loads(message)])
+                _frame = message.data
+        elif isinstance(message, str):
+            _frame = message.encode()
+        else:
+            _frame = bytes(message)
+
+        if _frame:
+            self.write_dbg_info("Got this message(putting on queue):%s", message)
+            _message = codec.decode(_frame)
+            if isinstance(_message, list):
+                # A batch, see send_batch, its messages are handled one at a time
+                for _curr_message in _message:
+                    monitor.queue.put([self, _curr_message])
+            else:
+                monitor.queue.put([self, _message, _frame])
         else:
             self.send_message(reply_with_error_message(_runtime_instance=os.getpid(),
                                                        _error_message="Cannot send empty messages to agent",
@@ -127,39 +182,83 @@ class OptimalWebSocket(object):
 
     def monitor_message_queue(self):
         """
-        Monitors the messages queue. Stops when the queue-threads' terminated attribute is set to True
+        Monitors the messages queue. Stops when the queue-threads' terminated attribute is set to True, and it is
+        woken up by the None put on the queue by stop_monitoring_message_queue. Messages are never None.
         """
-        self.monitor_message_queue_thread.terminated = False
-        while not self.monitor_message_queue_thread.terminated:
+        _thread = self.monitor_message_queue_thread
+        while not _thread.terminated:
             try:
-                _message = self.message_queue.get(True, .1)
-                try:
-                    self.send_message(_message)
-                except Exception as e:
-                    write_to_log(self.log_prefix + "Error sending message:" + str(e) + "\nTraceback:" + traceback.format_exc(),
-                                 _category=EC_COMMUNICATION, _severity=SEV_ERROR)
-            except Empty:
-                pass
+                _message = self.message_queue.get()
             except Exception as e:
                 write_to_log(self.log_prefix + "Error accessing send queue:" + str(e) + "\nTraceback:" + traceback.format_exc(),
                              _category=EC_INTERNAL, _severity=SEV_ERROR)
+                continue
+
+            if _message is None:
+                # Woken up to stop, or, as the queue belongs to the session, left by an earlier socket of it
+                continue
+            if _thread.terminated:
+                # The socket has been closed, leave the message to any new socket of the session, first, as it was
+                requeue_first(self.message_queue, _message)
+                break
+            try:
+                self.send_message(_message)
+            except Exception as e:
+                write_to_log(self.log_prefix + "Error sending message:" + str(e) + "\nTraceback:" + traceback.format_exc(),
+                             _category=EC_COMMUNICATION, _severity=SEV_ERROR)
 
         self.write_dbg_info(" stopped message queue monitoring. Exiting thread \"" +
-              str(self.monitor_message_queue_thread.name) + "\"")
-
+              str(_thread.name) + "\"")
 
+    def stop_monitoring_message_queue(self):
+        """
+        Stop monitoring the message queue, wakes the monitoring thread up.
+        """
+        if isinstance(self.message_queue, SendQueue):
+            self.message_queue.detach(self)
+        elif self.monitor_message_queue_thread and not self.monitor_message_queue_thread.terminated:
+            self.monitor_message_queue_thread.terminated = True
+            self.message_queue.put(None)
 
     def send_message(self, message):
         """
         Sends a message to the connected counterpart web socket
-        :param message: A string containing the message
+        :param message: The message, or, if it is forwarded as it was received, its frame as bytes
         """
-        if of.common.logging.severity < SEV_INFO:
+        if isinstance(message, bytes):
+            self.write_dbg_info("Forwarding frame of %s bytes", len(message))
+            self.send_frame(message)
+            return
+        if is_enabled(SEV_DEBUG):
             # We cannot use the normal facility here as that would cause recursion
             print(make_sparse_log_message("Sending message:" + str(message), _category=EC_COMMUNICATION,
                                           _severity = SEV_DEBUG, _address=self.address_own, _process_id=self.process_id))
         # send() below is implemented by multiple inheritance in the subclass. Ignore "unresolved attribute"-warning.
-        self.send(bytes(json.dumps(message).encode()))
+        self.send_frame(codec.encode(message))
+
+    def send_batch(self, messages):
+        """
+        Sends several messages to the connected counterpart web socket in a single frame, a JSON list of the messages.
+        Only send batches to peers that have negotiated batching when registering.
+
+        :param messages: A list of messages, or, if they are forwarded as they were received, their frames as bytes
+        """
+        self.write_dbg_info("Sending a batch of %s messages", len(messages))
+        self.send_frame(b"[" + b",".join([_curr_message if isinstance(_curr_message, bytes) else codec.encode(_curr_message)
+                                    for _curr_message in messages]) + b"]")
+
+    def send_frame(self, _frame):
+        """
+        Sends the payload of a frame, if the peer has negotiated compression, compressed in a binary frame.
+
+        :param _frame: The JSON, as bytes
+        """
+        if self.compressor is not None:
+            _frame, _binary = self.compressor.compress(_frame)
+            # send() below is implemented by multiple inheritance in the subclass.
+            self.send(_frame, binary=_binary)
+        else:
+            self.send(_frame)
 
     def closed(self, code, reason=None):
         """
@@ -174,7 +273,7 @@ class OptimalWebSocket(object):
                          _category=EC_COMMUNICATION, _severity=SEV_ERROR)
             self.close(code=code, reason=reason)
         else:
-            self.monitor_message_queue_thread.terminated = True
+            self.stop_monitoring_message_queue()
             self.write_dbg_info(self.log_prefix + "Closed, code: " + str(code) + ", reason: " + str(reason))
 
 
@@ -130,7 +130,8 @@ class CherryPyPlugins(object):
 
                 _refs = self.schema_tools.load_schemas_from_directory(_schema_dir, self._unresolved_schemas)
                 for _curr_schema_key in _refs:
-                    _resolved_schema = self.schema_tools.resolveSchema(self._unresolved_schemas[_curr_schema_key])
+                    _resolved_schema = self.schema_tools.resolveSchema(self._unresolved_schemas[_curr_schema_key],
+                                                                       _curr_schema_key)
                     self.namespaces[urlparse(_curr_schema_key).netloc.split(".")[0]]["schemas"].append(_curr_schema_key)
                     self.schema_tools.json_schema_objects[_curr_schema_key] = _resolved_schema
 
@@ -192,6 +193,8 @@ class CherryPyPlugins(object):
 
         # Reset unresolved schemas
         self._unresolved_schemas = {}
+        # Schemas may be replaced by the plugins, do not keep validators for the old ones
+        self.schema_tools.clear_validator_cache()
 
         # Find plugins directory
 
@@ -0,0 +1,248 @@
+"""
+The async_monitor module implements the AsyncMonitor class, an asyncio-based alternative to the Monitor class.
+
+Created on Oct 18, 2026
+
+@author: Nicklas Boerjesson
+"""
+
+import asyncio
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from of.common.logging import write_to_log, EC_UNCATEGORIZED, SEV_DEBUG, SEV_ERROR, EC_INTERNAL
+from of.schemas.constants import zero_object_id
+
+__author__ = 'Nicklas Boerjesson'
+
+
+class AsyncQueue(object):
+    """
+    The queue of an AsyncMonitor. Items put on it, from any thread, are scheduled for handling on the event loop.
+    """
+
+    #: The monitor
+    monitor = None
+
+    def __init__(self, _monitor):
+        self.monitor = _monitor
+
+    def put(self, _item, block=True, timeout=None):
+        """
+        Schedule an item for handling, never blocks. Items put after the monitor has been stopped are dropped.
+
+        :param _item: The item
+        """
+        with self.monitor.put_lock:
+            if not self.monitor.stopped:
+                try:
+                    self.monitor.loop.call_soon_threadsafe(self.monitor.dispatch, _item)
+                    self.monitor.put_count += 1
+                    return
+                except RuntimeError:
+                    # The event loop is closed
+                    pass
+            self.monitor.dropped += 1
+
+    def qsize(self):
+        """
+        Returns the number of items waiting to be handled
+        """
+        return self.monitor.put_count - self.monitor.handled
+
+
+class AsyncMonitor(object):
+    """
+    The asynchronous monitor has the same interface and handler contract as the Monitor class, but handles the items
+    on an asyncio event loop, running in a thread of its own.
+    The handler resolves each item to a function, see Handler.resolve. Functions that do not block, like forwarding
+    a message to a peer, are called on the event loop. Functions that block, like database writes, are run in a
+    thread pool, so the event loop is never held up by them.
+    Items with the same shard key, see Handler.shard_key, are handled in the order they were queued.
+    """
+
+    #: The queue, items put on it are handled by the monitor
+    queue = None
+    #: The handler that reacts on each queue item
+    handler = None
+    #: The Optimal Framework process id the monitor is running within
+    process_id = None
+    #: A prefix that is applied to all log items
+    log_prefix = None
+    #: The event loop
+    loop = None
+    #: The thread running the event loop
+    monitor_thread = None
+    #: The thread pool that runs blocking handler functions
+    executor = None
+    #: The number of threads in the thread pool
+    worker_count = None
+    #: A lock and the number of items being handled per shard key, to keep their order
+    shard_locks = None
+    #: If true, the monitor has been stopped and items put on the queue are dropped
+    stopped = None
+    #: Metrics; the number of queued, handled and dropped items, of errors and the total and longest handling times in
+    #: seconds
+    put_count = None
+    put_lock = None
+    handled = None
+    dropped = None
+    errors = None
+    handle_time = None
+    handle_time_max = None
+
+    def __init__(self, _handler, _workers=4):
+        """
+        Initialize the monitor and start monitoring
+
+        :param _handler: The handler that handles the queued items
+        :param _workers: The number of threads running blocking handler functions
+        """
+
+        self.log_prefix = self.__class__.__name__ + "(" + str(_handler.__class__.__name__) + "): "
+        self.queue = AsyncQueue(self)
+        self.handler = _handler
+        self.worker_count = _workers
+        self.shard_locks = {}
+        self.put_count = 0
+        self.put_lock = threading.Lock()
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.handle_time = 0
+        self.handle_time_max = 0
+        self.handler.on_monitor_init(self)
+        self.start()
+
+    def write_dbg_info(self, _data):
+        write_to_log(self.log_prefix + _data, _category=EC_UNCATEGORIZED, _severity=SEV_DEBUG,
+                     _process_id=self.process_id)
+
+    def dispatch(self, _item):
+        """
+        Called on the event loop for each queued item, starts handling it.
+
+        :param _item: The item
+        """
+        self.loop.create_task(self.handle_item(_item))
+
+    async def handle_item(self, _item):
+        """
+        Handle an item, after any earlier items with the same shard key.
+
+        :param _item: The item
+        """
+        _started = time.perf_counter()
+        try:
+            _shard_key = self.handler.shard_key(_item)
+            if _shard_key is None:
+                await self._handle_resolved(_item)
+            else:
+                # asyncio locks are fair, so items are handled in the order they were dispatched
+                _shard = self.shard_locks.get(_shard_key)
+                if _shard is None:
+                    _shard = self.shard_locks[_shard_key] = [asyncio.Lock(), 0]
+                _shard[1] += 1
+                try:
+                    async with _shard[0]:
+                        await self._handle_resolved(_item)
+                finally:
+                    _shard[1] -= 1
+                    if _shard[1] == 0:
+                        del self.shard_locks[_shard_key]
+        except Exception as e:
+            self.errors += 1
+            write_to_log(self.log_prefix + "Error handling item:" + str(e) + "\nData:\n" + str(_item) +
+                         "\nTraceback:" + traceback.format_exc(), _category=EC_INTERNAL, _severity=SEV_ERROR)
+
+        _handle_time = time.perf_counter() - _started
+        self.handled += 1
+        self.handle_time += _handle_time
+        self.handle_time_max = max(self.handle_time_max, _handle_time)
+
+    async def _handle_resolved(self, _item):
+        _resolved = self.handler.resolve(_item)
+        if _resolved is None:
+            return
+        _function, _blocking = _resolved
+        if _blocking:
+            await self.loop.run_in_executor(self.executor, _function)
+        else:
+            _function()
+
+    def metrics(self):
+        """
+        Returns the queue depth and handling metrics of the monitor, like Monitor.metrics.
+        Handling times include waiting for earlier items with the same shard key.
+        Dropped are the items put on the queue after the monitor was stopped.
+        """
+        return {"queued": self.queue.qsize(), "handled": self.handled, "dropped": self.dropped, "errors": self.errors,
+                "handleTimeAverage": self.handle_time / self.handled if self.handled else 0,
+                "handleTimeMax": self.handle_time_max, "executorThreads": self.worker_count, "engine": "asyncio"}
+
+    def stop(self, _user_id=zero_object_id, _reverse_order=None):
+        """
+        Stops the monitor and tells the handler to shut down, like Monitor.stop.
+
+        :param _user_id: The Optimal BPM user Id that is stopping the monitor
+        :param _reverse_order: If true, the monitor is kept running while the handler is shut down.
+        """
+        if not _reverse_order:
+            self.write_dbg_info("Told to stop, ceasing monitoring.")
+            self.stop_loop()
+
+        self.write_dbg_info("Shutting down handler(" + str(self.handler.__class__.__name__) + ").")
+        self.handler.shut_down(_user_id)
+        self.write_dbg_info("Handler shut down.")
+        if _reverse_order:
+            self.write_dbg_info("Told to stop, ceasing monitoring.")
+            self.stop_loop()
+
+    async def _finish_items(self):
+        """
+        Wait for the items being handled.
+        """
+        _tasks = [_curr_task for _curr_task in asyncio.all_tasks() if _curr_task is not asyncio.current_task()]
+        if _tasks:
+            await asyncio.wait(_tasks)
+
+    def stop_loop(self, _timeout=10):
+        """
+        Stop the event loop and the thread pool, items being handled are finished first.
+
+        :param _timeout: The longest time, in seconds, to wait for the items being handled
+        """
+        with self.put_lock:
+            self.stopped = True
+        try:
+            asyncio.run_coroutine_threadsafe(self._finish_items(), self.loop).result(_timeout)
+        except Exception as e:
+            write_to_log(self.log_prefix + "Failed to finish the items being handled:" + str(e),
+                         _category=EC_INTERNAL, _severity=SEV_ERROR)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.monitor_thread.join()
+        self.executor.shutdown(wait=True)
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.write_dbg_info("In monitor thread running the event loop.")
+        self.loop.run_forever()
+        self.loop.close()
+        self.write_dbg_info("Monitor thread stopped.")
+
+    def start(self):
+        """
+        Start the event loop and the thread pool
+        """
+        if self.monitor_thread and self.monitor_thread.is_alive():
+            raise Exception(write_to_log(self.log_prefix + "The queue monitor is already running.",
+                                         _category=EC_INTERNAL, _severity=SEV_ERROR))
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count)
+        self.loop = asyncio.new_event_loop()
+        self.stopped = False
+        self.monitor_thread = threading.Thread(target=self.run_loop,
+                                               name=self.__class__.__name__ + "_event loop thread", daemon=True)
+        self.monitor_thread.start()
+        self.write_dbg_info("Running, monitoring thread: " + str(self.monitor_thread.name))
@@ -8,7 +8,7 @@ Created on Jan 22, 2016
 
 import os
 
-from of.common.logging import write_to_log, EC_COMMUNICATION, SEV_DEBUG, EC_NOTIFICATION
+from of.common.logging import write_to_log, EC_COMMUNICATION, SEV_DEBUG, EC_NOTIFICATION, is_enabled
 
 __author__ = 'Nicklas Borjesson'
 
@@ -39,13 +39,15 @@ class Handler(object):
         """
         pass
 
-    def write_dbg_info(self, _data):
+    def write_dbg_info(self, _data, *_args):
         """
-        Shortcut to writing debug information
-        :param _message: The message
-        :param _severity: The severity of the log information, a constant defined in the built-in logging module
+        Shortcut to writing debug information, the message is only built if debug information is logged.
+        :param _data: The message, a %-style format string if _args are given
+        :param _args: The arguments of the format string
         """
-        write_to_log(self.log_prefix + _data, _category=EC_NOTIFICATION, _severity=SEV_DEBUG, _process_id=self.process_id)
+        if is_enabled(SEV_DEBUG):
+            write_to_log(self.log_prefix + (_data % _args if _args else _data), _category=EC_NOTIFICATION,
+                         _severity=SEV_DEBUG, _process_id=self.process_id)
 
 
     def handle(self, _item):
@@ -58,6 +60,29 @@ class Handler(object):
         """
         raise Exception(self.log_prefix + "The required call handler method is not implemented.")
 
+    def resolve(self, _item):
+        """
+        Used by asynchronous monitors; resolve how an item is to be handled, without handling it.
+        Override this to let items be handled within the event loop of the monitor.
+
+        :param _item: The item from the queue
+        :return: A tuple of a function without parameters that handles the item, and whether it blocks.
+            Functions that block, for example doing database I/O, are run in a thread pool, the others within the
+            event loop. None if the item is not to be handled.
+        """
+        return lambda: self.handle(_item), True
+
+    def shard_key(self, _item):
+        """
+        Override this to let a monitor with several workers handle items concurrently.
+        Items with the same shard key are handled in order, by the same worker. Items without a shard key, None, are
+        all handled by the first worker.
+
+        :param _item: The item from the queue
+        :return: A hashable shard key, or None
+        """
+        return None
+
     def shut_down(self, _user_id):
         """
         Called by the monitor when shutting down. Override to provide own actions
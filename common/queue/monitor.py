@@ -7,9 +7,10 @@ Created on Jan 22, 2016
 """
 
 import os
+import time
 import traceback
 import threading
-from queue import Empty, Queue
+from queue import Queue
 
 from of.common.logging import write_to_log, EC_UNCATEGORIZED, SEV_DEBUG, SEV_ERROR, EC_INTERNAL
 from of.schemas.constants import zero_object_id
@@ -27,6 +28,36 @@ class MonitorThread(threading.Thread):
                                             name=_monitor.__class__.__name__ + "_queue monitor thread")
 
 
+class MonitorWorker(threading.Thread):
+    """
+    A worker thread of a monitor with several workers, handles the items dispatched to its own queue.
+    """
+    #: If true, the thread is terminated
+    terminated = None
+    #: The items dispatched to this worker, each a tuple of the item and when it was dispatched
+    queue = None
+    #: Metrics; the number of handled items, of errors and the total and longest handling times in seconds
+    handled = None
+    errors = None
+    handle_time = None
+    handle_time_max = None
+    #: Metrics; the total and longest time in seconds items waited in the worker queue
+    wait_time = None
+    wait_time_max = None
+
+    def __init__(self, _monitor, _index):
+        self.terminated = False
+        self.queue = Queue()
+        self.handled = 0
+        self.errors = 0
+        self.handle_time = 0
+        self.handle_time_max = 0
+        self.wait_time = 0
+        self.wait_time_max = 0
+        super(MonitorWorker, self).__init__(target=_monitor.work, args=(self,),
+                                            name=_monitor.__class__.__name__ + "_queue worker thread " + str(_index))
+
+
 class Monitor(object):
     """
     The monitor class monitors a given queue for new items and calls a handler when new items appear on the queue.
@@ -44,8 +75,27 @@ class Monitor(object):
     log_prefix = None
     #: The thread that monitors the queue
     monitor_thread = None
+    #: If there are several workers, the worker threads that the monitor thread dispatches the items to
+    workers = None
+    #: The number of workers
+    worker_count = None
+    #: Metrics; the number of handled items, of errors and the total and longest handling times in seconds
+    #: (single worker)
+    handled = None
+    errors = None
+    handle_time = None
+    handle_time_max = None
 
-    def __init__(self, _handler, _queue=None):
+    def __init__(self, _handler, _queue=None, _workers=1):
+        """
+        Initialize the monitor and start monitoring
+
+        :param _handler: The handler that handles the queued items
+        :param _queue: The queue to monitor, if not set, a new queue is created
+        :param _workers: The number of threads handling items. If more than one, the monitor thread dispatches the
+            items to the workers, using the shard key the handler returns for each item. Items with the same shard key
+            are handled by the same worker, in the order they were queued.
+        """
 
         self.log_prefix = self.__class__.__name__ + "(" + str(
             _handler.__class__.__name__) + "): "
@@ -56,6 +106,11 @@ class Monitor(object):
             self.queue = Queue()
 
         self.handler = _handler
+        self.worker_count = max(_workers, 1)
+        self.handled = 0
+        self.errors = 0
+        self.handle_time = 0
+        self.handle_time_max = 0
         self.handler.on_monitor_init(self)
         if self.queue:
             self.start()
@@ -66,35 +121,131 @@ class Monitor(object):
 
     def after_get_queue(self):
         """
-        Implement this for something to happen immidiately after a each queue check has happened.
+        Implement this for something to happen immidiately after each item has been taken from the queue.
         """
         pass
 
+    def handle_item(self, _item):
+        """
+        Let the handler handle an item, log any errors
+
+        :param _item: The item
+        :return: True if the item was handled without errors
+        """
+        try:
+            self.handler.handle(_item)
+            return True
+        except Exception as e:
+            write_to_log(self.log_prefix + "Error handling item:" + str(e) + "\nData:\n" + str(_item) +
+                         "\nTraceback:" + traceback.format_exc(), _category=EC_INTERNAL,
+                         _severity=SEV_ERROR)
+            return False
+
+    def dispatch(self, _item):
+        """
+        Dispatch an item to a worker, using the shard key from the handler
+
+        :param _item: The item
+        """
+        try:
+            _shard_key = self.handler.shard_key(_item)
+        except Exception as e:
+            write_to_log(self.log_prefix + "Error getting the shard key of an item, using the first worker:" + str(e),
+                         _category=EC_INTERNAL, _severity=SEV_ERROR)
+            _shard_key = None
+        _worker = self.workers[hash(_shard_key) % self.worker_count if _shard_key is not None else 0]
+        _worker.queue.put((_item, time.perf_counter()))
+
     def monitor(self):
         """
-        Monitors the queue. Stops when the queue-threads' terminated attribute is set to True
+        Monitors the queue. Stops when the queue-threads' terminated attribute is set to True, and it is woken up by
+        the None put on the queue by terminate_threads. Items are never None.
         """
         self.write_dbg_info("In monitor thread monitoring queue.")
-        while not self.monitor_thread.terminated:
+        _thread = self.monitor_thread
+        while not _thread.terminated:
             try:
-                _item = self.queue.get(True, .1)
-                try:
-                    self.handler.handle(_item)
-                except Exception as e:
-                    write_to_log(self.log_prefix + "Error handling item:" + str(e) + "\nData:\n" + str(_item) +
-                                 "\nTraceback:" + traceback.format_exc(), _category=EC_INTERNAL,
-                                 _severity=SEV_ERROR)
-            except Empty:
-                pass
+                _item = self.queue.get()
             except Exception as e:
-                self.monitor_thread.terminated = True
+                _thread.terminated = True
                 raise Exception(write_to_log(self.log_prefix + "Terminating, error accessing own queue:" + str(e),
                                              _category=EC_INTERNAL, _severity=SEV_ERROR))
+            if _item is None:
+                # Woken up to stop, or left on the queue when stopping an earlier monitor thread
+                continue
+
+            if self.workers:
+                self.dispatch(_item)
+            else:
+                _started = time.perf_counter()
+                if not self.handle_item(_item):
+                    self.errors += 1
+                _handle_time = time.perf_counter() - _started
+                self.handled += 1
+                self.handle_time += _handle_time
+                self.handle_time_max = max(self.handle_time_max, _handle_time)
 
             self.after_get_queue()
 
         self.write_dbg_info("Monitor thread stopped.")
 
+    def work(self, _worker):
+        """
+        Handles the items dispatched to a worker. Stops when the workers' terminated attribute is set to True, and it
+        is woken up by the None put on its queue by terminate_threads.
+
+        :param _worker: The MonitorWorker
+        """
+        while not _worker.terminated:
+            _dispatched = _worker.queue.get()
+            if _dispatched is None:
+                continue
+            _item, _dispatched_at = _dispatched
+            _started = time.perf_counter()
+            if not self.handle_item(_item):
+                _worker.errors += 1
+            _finished = time.perf_counter()
+            _worker.handled += 1
+            _worker.handle_time += _finished - _started
+            _worker.handle_time_max = max(_worker.handle_time_max, _finished - _started)
+            _worker.wait_time += _started - _dispatched_at
+            _worker.wait_time_max = max(_worker.wait_time_max, _started - _dispatched_at)
+
+    def metrics(self):
+        """
+        Returns the queue depths and handling metrics of the monitor.
+        Times are in seconds, waiting is the time from being dispatched until handled by a worker.
+
+        :return: A dict with the metrics, with several workers, also a list of per-worker metrics under "workers"
+        """
+        _result = {"queued": self.queue.qsize()}
+        if not self.workers:
+            _result.update({"handled": self.handled, "errors": self.errors,
+                            "handleTimeAverage": self.handle_time / self.handled if self.handled else 0,
+                            "handleTimeMax": self.handle_time_max})
+            return _result
+
+        _workers = [{"queued": _curr_worker.queue.qsize(),
+                     "handled": _curr_worker.handled,
+                     "errors": _curr_worker.errors,
+                     "handleTimeAverage": _curr_worker.handle_time / _curr_worker.handled if _curr_worker.handled else 0,
+                     "handleTimeMax": _curr_worker.handle_time_max,
+                     "waitTimeAverage": _curr_worker.wait_time / _curr_worker.handled if _curr_worker.handled else 0,
+                     "waitTimeMax": _curr_worker.wait_time_max} for _curr_worker in self.workers]
+        _handled = sum([_curr_worker.handled for _curr_worker in self.workers])
+        _result.update({
+            "handled": _handled,
+            "errors": sum([_curr_worker.errors for _curr_worker in self.workers]),
+            "handleTimeAverage": sum([_curr_worker.handle_time for _curr_worker in self.workers]) / _handled
+            if _handled else 0,
+            "handleTimeMax": max([_curr_worker.handle_time_max for _curr_worker in self.workers]),
+            "waitTimeAverage": sum([_curr_worker.wait_time for _curr_worker in self.workers]) / _handled
+            if _handled else 0,
+            "waitTimeMax": max([_curr_worker.wait_time_max for _curr_worker in self.workers]),
+            "workers": _workers
+        })
+        return _result
+
     def stop(self, _user_id=zero_object_id, _reverse_order=None):
         """
         Stops the monitor and tells the handler to shut down
@@ -104,7 +255,7 @@ class Monitor(object):
         """
         if not _reverse_order:
             self.write_dbg_info("Told to stop, ceasing monitoring.")
-            self.monitor_thread.terminated = True
+            self.terminate_threads()
 
         # TODO: Handle any residual items on the queue.(PROD-28)
         # There should be a general framework for unhandled queue items
@@ -114,7 +265,19 @@ class Monitor(object):
         self.write_dbg_info("Handler shut down.")
         if _reverse_order:
             self.write_dbg_info("Told to stop, ceasing monitoring.")
-            self.monitor_thread.terminated = True
+            self.terminate_threads()
+
+    def terminate_threads(self):
+        """
+        Tell the monitor thread and any workers to terminate
+        """
+        self.monitor_thread.terminated = True
+        # Wake the threads up, they block while waiting for items
+        self.queue.put(None)
+        if self.workers:
+            for _curr_worker in self.workers:
+                _curr_worker.terminated = True
+                _curr_worker.queue.put(None)
 
     def start(self):
         """
@@ -124,6 +287,10 @@ class Monitor(object):
         if self.monitor_thread and not self.monitor_thread.terminated:
             raise Exception(write_to_log(self.log_prefix + "The queue monitor is already running.",
                                          _category=EC_INTERNAL, _severity=SEV_ERROR))
+        if self.worker_count > 1:
+            self.workers = [MonitorWorker(_monitor=self, _index=_curr_index) for _curr_index in range(self.worker_count)]
+            for _curr_worker in self.workers:
+                _curr_worker.start()
         self.monitor_thread = MonitorThread(_monitor=self)
         self.monitor_thread.terminated = False
         self.monitor_thread.start()
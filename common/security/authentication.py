@@ -7,7 +7,10 @@ Created on Mar 18, 2016
 
 @author: Nicklas Boerjesson
 """
+import time
 from abc import ABCMeta
+from collections import OrderedDict
+from threading import Lock
 
 __author__ = "Nicklas Boerjesson"
 
@@ -18,15 +21,17 @@ from inspect import getfullargspec
 _authentication = None
 
 
-def init_authentication(_authentication_backend):
+def init_authentication(_authentication_backend, _cache_ttl=None, _cache_max_size=None):
     """
     Initializes the global authentication object
 
     :param _authentication_backend: An instance of an AuthenticationBackend subclass
+    :param _cache_ttl: If set, the number of seconds a session is cached, see Authentication
+    :param _cache_max_size: If set, the maximum number of cached sessions, see Authentication
     :return: an instance of the global authentication object
     """
     global _authentication
-    _authentication = Authentication(_authentication_backend)
+    _authentication = Authentication(_authentication_backend, _cache_ttl=_cache_ttl, _cache_max_size=_cache_max_size)
     return _authentication
 
 
@@ -79,6 +84,43 @@ def logout(_session_id):
 
 
 
+def invalidate_user_sessions(_user_id):
+    """
+       Global convenience function, see Authentication.invalidate_user_sessions.
+       Does nothing if there is no authentication object.
+
+       :param _user_id: The _id of the user
+
+    """
+    global _authentication
+    if _authentication is not None:
+        _authentication.invalidate_user_sessions(_user_id)
+
+
+def clear_session_cache():
+    """
+       Global convenience function, see Authentication.clear_session_cache.
+       Does nothing if there is no authentication object.
+
+    """
+    global _authentication
+    if _authentication is not None:
+        _authentication.clear_session_cache()
+
+
+def session_cache_metrics():
+    """
+       Global convenience function, see Authentication.session_cache_metrics
+
+    """
+    global _authentication
+    if _authentication is None:
+        raise AuthenticationError('session_cache_metrics: No authentication object initialized. '
+                                  'Call init_authentication.')
+
+    return _authentication.session_cache_metrics()
+
+
 def check_session_aspect(func, *args, **kwargs):
     """
     The authentication aspect code, provides an aspect for the aop_check_session decorator
@@ -134,32 +176,149 @@ class Authentication():
     """
     The authentication class is the central entity for authentication in IF.
     It handles login, logout and session validation.
+    Validated sessions are cached with their users, so that checking a session normally doesn't need the backend.
+    The cache is least recently used-ordered, and entries expire after a time to live, which limits how long
+    changes made by others, for example another broker, can go unnoticed.
     """
 
     authentication_backend = None
 
-    def __init__(self, _authentication_backend):
+    #: The number of seconds a session is cached
+    cache_ttl = 60
+    #: The maximum number of cached sessions, the least recently used are dropped when it is exceeded
+    cache_max_size = 10000
+    #: The session cache, session_id-keyed (expiry time, user) tuples, least recently used first
+    session_cache = None
+    #: Session cache hits
+    cache_hits = None
+    #: Session cache misses
+    cache_misses = None
+    #: Protects the session cache, check_session is called by many threads
+    cache_lock = None
+    #: Incremented when sessions are invalidated, so that users loaded before that are not cached
+    cache_generation = None
+
+    def __init__(self, _authentication_backend, _cache_ttl=None, _cache_max_size=None):
         """
         The Authentication class need access to the database for user information.
         :param _authentication_backend: An instance of an AuthenticationBackend subclass
+        :param _cache_ttl: If set, the number of seconds a session is cached, 0 disables the cache
+        :param _cache_max_size: If set, the maximum number of cached sessions
         """
         self.authentication_backend = _authentication_backend
+        if _cache_ttl is not None:
+            self.cache_ttl = _cache_ttl
+        if _cache_max_size is not None:
+            self.cache_max_size = _cache_max_size
+        self.session_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_lock = Lock()
+        self.cache_generation = 0
+
+    def _get_cached_user(self, _session_id):
+        """
+        Returns the cached user for the session, or None if not cached or expired
+        """
+        with self.cache_lock:
+            _cached = self.session_cache.get(_session_id)
+            if _cached is not None:
+                if _cached[0] > time.monotonic():
+                    self.session_cache.move_to_end(_session_id)
+                    self.cache_hits += 1
+                    return _cached[1]
+                else:
+                    del self.session_cache[_session_id]
+            self.cache_misses += 1
+            return None
+
+    def _cache_user(self, _session_id, _user, _generation):
+        """
+        Caches the user for the session, unless sessions have been invalidated since it was loaded
+        """
+        if self.cache_ttl <= 0:
+            return
+        with self.cache_lock:
+            if _generation != self.cache_generation:
+                return
+            self.session_cache[_session_id] = (time.monotonic() + self.cache_ttl, _user)
+            self.session_cache.move_to_end(_session_id)
+            while len(self.session_cache) > self.cache_max_size:
+                self.session_cache.popitem(last=False)
+
+    def invalidate_session(self, _session_id):
+        """
+        Removes a session from the cache
+
+        :param _session_id: The session Id
+
+        """
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.session_cache.pop(_session_id, None)
+
+    def invalidate_user_sessions(self, _user_id):
+        """
+        Removes all sessions of a user from the cache, for example when the user has been changed.
+
+        :param _user_id: The _id of the user
+
+        """
+        _user_id = str(_user_id)
+        with self.cache_lock:
+            self.cache_generation += 1
+            for _curr_session_id, _curr_cached in list(self.session_cache.items()):
+                if str(_curr_cached[1].get("_id")) == _user_id:
+                    del self.session_cache[_curr_session_id]
+
+    def clear_session_cache(self):
+        """
+        Removes all sessions from the cache, for example when groups have been changed.
+
+        """
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.session_cache.clear()
+
+    def session_cache_metrics(self):
+        """
+        Returns the session cache metrics
+
+        :return: A dict with the number of hits, misses, the hit rate and the number of cached sessions
+
+        """
+        with self.cache_lock:
+            _lookups = self.cache_hits + self.cache_misses
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hitRate": self.cache_hits / _lookups if _lookups > 0 else None,
+                "size": len(self.session_cache)
+            }
 
     def check_session(self, _session_id):
         """
         Checks if a session_id is valid and returns the user object
         Otherwise raises an AuthenticationError,
+        Note: The user object may be cached and shared between calls, it must not be changed.
 
         :param _session_id: A session_id, format is a MongoDB objectId.
         :return: A user object
 
         """
 
+        _user = self._get_cached_user(_session_id)
+        if _user is not None:
+            return _user
+
+        # If the session is invalidated while it is loaded, for example logged out, it must not be cached
+        _generation = self.cache_generation
         _session = self.authentication_backend.get_session(_session_id)
         if _session is not None:
             _user = self.authentication_backend.get_user(_session["user_id"])
 
             if _user is not None:
+                self._cache_user(_session_id, _user, _generation)
                 return _user
             else:
                 raise AuthenticationError("Authentication failed. The user associated with the session"
@@ -202,4 +361,6 @@ class Authentication():
         :return:
 
         """
-        self.authentication_backend.logout(_session_id)
\ No newline at end of file
+        self.authentication_backend.logout(_session_id)
+        # After the backend, so that the session is not cached again by a concurrent check_session
+        self.invalidate_session(_session_id)
\ No newline at end of file
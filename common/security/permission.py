@@ -13,9 +13,49 @@ __author__ = 'nibo'
 
 # TODO: As this is group-level operations, they should be in the group-module, not here.
 
+def permission_condition(_permission, _user):
+    """
+    Make a MongoDB condition that only matches the documents any of the users' groups have the permission for.
+    This is the database side equivalent of filter_by_group.
+
+    :param _permission: The permission to check. For example "canRead" or "canWrite".
+    :param _user: The user to check
+    :return: A MongoDB condition
+    """
+    return {_permission: {"$in": [of_object_id(_curr_group) for _curr_group in _user["groups"]]}}
+
+
+def add_permission_condition(_conditions, _permission, _user):
+    """
+    Restrict a MongoDB condition to the documents any of the users' groups have the permission for.
+
+    :param _conditions: A MongoDB condition
+    :param _permission: The permission to check. For example "canRead" or "canWrite".
+    :param _user: The user to check
+    :return: The restricted condition
+    """
+    _permission_condition = permission_condition(_permission, _user)
+    if _conditions:
+        return {"$and": [_conditions, _permission_condition]}
+    else:
+        return _permission_condition
+
+
 def filter_by_group(_nodes, _permission, _user, _database_access, _error_prefix_if_not_allowed=None,
                     _use_object_id=False):
-    """This function filters a list of nodes based on what groups a user belong to and its right
+    """This function filters a list of nodes based on what groups a user belong to and its right.
+    See iter_filter_by_group for the parameters.
+
+    :return: A list of nodes any of the users' groups have the permission defined in _permission for
+
+    """
+    return list(iter_filter_by_group(_nodes, _permission, _user, _database_access, _error_prefix_if_not_allowed,
+                                     _use_object_id))
+
+
+def iter_filter_by_group(_nodes, _permission, _user, _database_access, _error_prefix_if_not_allowed=None,
+                         _use_object_id=False):
+    """This generator filters an iterable of nodes based on what groups a user belong to and its right, one at a time
 
     :param _nodes: A list of node
     :param _permission: The permission to check. For example "canRead" or "canWrite".
@@ -24,10 +64,9 @@ def filter_by_group(_nodes, _permission, _user, _database_access, _error_prefix_
     :param _error_prefix_if_not_allowed: If set, the supplied error message is raised. Normally used when testing for\
         write access.
     :param _use_object_id: If true, the node has ObjectId instances and not strings.
-    :return: A list of nodes any of the users' groups have the permission defined in _permission for
+    :return: The nodes any of the users' groups have the permission defined in _permission for
 
     """
-    _result = []
     _groups = _user["groups"]
     # Loop nodes
     for _curr_row in _nodes:
@@ -43,7 +82,7 @@ def filter_by_group(_nodes, _permission, _user, _database_access, _error_prefix_
                 _has_permission = True
                 break
         if _has_permission:
-            _result.append(_curr_row)
+            yield _curr_row
         elif _error_prefix_if_not_allowed:
             # Raise an error if a user lacks the _permission for.
             _error = _error_prefix_if_not_allowed + ":" + _user["name"] + " doesn't have the " + _permission + \
@@ -53,5 +92,3 @@ def filter_by_group(_nodes, _permission, _user, _database_access, _error_prefix_
                                                   _error,
                                                   _user["_id"], str(_curr_row["_id"]))
             raise PermissionError(_error)
-
-    return _result
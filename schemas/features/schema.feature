@@ -30,3 +30,22 @@ Feature: Perform schema handling
     Given  a schema with references
     Then it should return a resolved schema
 
+
+  Scenario: Reuse validators between documents
+    Given it loads all available schemas
+    Then applying the same schema twice should reuse the validator
+    And replacing the schema should rebuild the validator
+    And clearing the validator cache should release the cached object setters
+
+  Scenario: Translate string objectIds using a precomputed conversion plan
+    Given it loads all available schemas
+    Then applying with the conversion plan should give the same result as the validator
+
+  Scenario: Translate string objectIds into a copy without changing the original
+    Given it loads all available schemas
+    Then applying with copying should give the same result and leave the original unchanged
+
+  Scenario: Translate string objectIds under additionalProperties, that cannot be planned
+    Given it loads all available schemas
+    Then a schema with objectIds under additionalProperties should have no conversion plan
+    And applying it with the conversion plan, in place and copying, should translate the objectId strings
@@ -191,3 +191,114 @@ def step_impl(context):
 
     ok_(context.resolvedGroupSchema == manually_resolved_group)
 
+
+@then("applying the same schema twice should reuse the validator")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.schema_tools.clear_validator_cache()
+    context.schema_tools.apply(json_load_file(os.path.join(script_location, "../data/objectid_json.json")))
+    context.schema_tools.apply(json_load_file(os.path.join(script_location, "../data/objectid_json.json")))
+    ok_(context.schema_tools.validator_cache_misses == 1 and context.schema_tools.validator_cache_hits == 1,
+        "Expected one miss and one hit, got " + str(context.schema_tools.validator_cache_misses) + " misses and " +
+        str(context.schema_tools.validator_cache_hits) + " hits.")
+
+
+@then("replacing the schema should rebuild the validator")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.schema_tools.json_schema_objects["ref://of.node.node"] = \
+        deepcopy(context.schema_tools.json_schema_objects["ref://of.node.node"])
+    context.schema_tools.apply(json_load_file(os.path.join(script_location, "../data/objectid_json.json")))
+    ok_(context.schema_tools.validator_cache_misses == 2,
+        "Expected the validator to be rebuilt, misses: " + str(context.schema_tools.validator_cache_misses))
+
+
+@then("clearing the validator cache should release the cached object setters")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _validator = context.schema_tools.mongodb_validator
+    # Apply using the validator, not the conversion plan, to make object setters
+    _validator.apply(json_load_file(os.path.join(script_location, "../data/objectid_json.json")),
+                     context.schema_tools.json_schema_objects["ref://of.node.node"],
+                     context.schema_tools.get_validators("ref://of.node.node",
+                                                         context.schema_tools.json_schema_objects[
+                                                             "ref://of.node.node"])[0])
+    ok_(len(_validator.object_setters) > 0, "No object setters were cached")
+    context.schema_tools.clear_validator_cache()
+    ok_(len(_validator.object_setters) == 0, "Object setters were kept: " + str(len(_validator.object_setters)))
+
+
+@then("applying with the conversion plan should give the same result as the validator")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _validator_data = json_load_file(os.path.join(script_location, "../data/objectid_json.json"))
+    _planned_data = json_load_file(os.path.join(script_location, "../data/objectid_json.json"))
+    context.schema_tools.apply(_validator_data)
+    context.schema_tools.apply(_planned_data, _use_plan=True)
+    ok_(_validator_data == _planned_data and isinstance(_planned_data["canRead"][0], ObjectId),
+        "Planned conversion differed, validator:" + str(_validator_data) + "\nPlanned:" + str(_planned_data))
+
+
+@then("applying with copying should give the same result and leave the original unchanged")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _original_data = json_load_file(os.path.join(script_location, "../data/objectid_json.json"))
+    _untouched_data = json_load_file(os.path.join(script_location, "../data/objectid_json.json"))
+    _converted_data = json_load_file(os.path.join(script_location, "../data/objectid_json.json"))
+    context.schema_tools.apply(_converted_data, _use_plan=True)
+    _copied_data, _schema_obj = context.schema_tools.apply(_original_data, _use_plan=True, _copy=True)
+    ok_(_copied_data == _converted_data and _original_data == _untouched_data,
+        "Copying conversion differed, in place:" + str(_converted_data) + "\nCopied:" + str(_copied_data) +
+        "\nOriginal:" + str(_original_data))
+
+
+additional_schema = {
+    "type": "object",
+    "properties": {
+        "schemaRef": {"type": "string"}
+    },
+    "additionalProperties": {
+        "type": "object",
+        "properties": {
+            "ref_id": {"type": "string", "objectId": True}
+        }
+    }
+}
+
+
+@then("a schema with objectIds under additionalProperties should have no conversion plan")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    context.schema_tools.json_schema_objects["ref://of.test.additional"] = additional_schema
+    ok_(context.schema_tools.get_object_id_plan("ref://of.test.additional", additional_schema) is None,
+        "The schema should not have been planned")
+
+
+@then("applying it with the conversion plan, in place and copying, should translate the objectId strings")
+def step_impl(context):
+    """
+    :type context behave.runner.Context
+    """
+    _data = {"schemaRef": "ref://of.test.additional", "extra": {"ref_id": "000000010000010001e64c28"}}
+    try:
+        _converted_data, _schema_obj = context.schema_tools.apply(deepcopy(_data), _use_plan=True)
+        ok_(_converted_data["extra"]["ref_id"] == ObjectId("000000010000010001e64c28"),
+            "Not converted in place: " + str(_converted_data))
+        _original_data = deepcopy(_data)
+        _copied_data, _schema_obj = context.schema_tools.apply(_original_data, _use_plan=True, _copy=True)
+        ok_(_copied_data == _converted_data and _original_data == _data,
+            "Copying conversion differed, copied: " + str(_copied_data) + "\nOriginal:" + str(_original_data))
+    finally:
+        del context.schema_tools.json_schema_objects["ref://of.test.additional"]
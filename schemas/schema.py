@@ -16,7 +16,7 @@ from jsonschema.validators import RefResolver
 # strict-rfc3339
 
 
-from of.broker.lib.schema_mongodb import MongodbValidator
+from of.broker.lib.schema_mongodb import MongodbValidator, make_object_id_plan, make_object_id_plan_tree
 from of.common.logging import EC_NOTIFICATION, SEV_DEBUG, write_to_log
 
 
@@ -37,6 +37,17 @@ class SchemaTools():
     # An instance of the mongodb JSON validator.
     mongodb_validator = None
 
+    # Prebuilt validators per schemaRef, a tuple of (schema object, applying, plain and planned validator)
+    validator_cache = None
+    # Number of times a cached validator was reused
+    validator_cache_hits = None
+    # Number of times a validator had to be built
+    validator_cache_misses = None
+
+    # ObjectId conversion plans per schemaRef, a tuple of (schema object, plan). Made when schemas are resolved.
+    object_id_plans = None
+    # ObjectId conversion plan trees per schemaRef, a tuple of (plan, plan tree)
+    object_id_plan_trees = None
 
     # Default handler, will only look at the cache
     def cache_handler(self, _uri):
@@ -76,6 +87,9 @@ class SchemaTools():
         self.mongodb_validator = MongodbValidator(resolver= self.resolver)
 
         self.json_schema_objects = {}
+        self.object_id_plans = {}
+        self.object_id_plan_trees = {}
+        self.clear_validator_cache()
 
         # Load application specific schemas
         for _curr_folder in _json_schema_folders:
@@ -83,7 +97,8 @@ class SchemaTools():
 
             # Resolve all the schemas
             for _curr_uri in _loaded_uris:
-                self.json_schema_objects[_curr_uri] = self.resolveSchema(self.json_schema_objects[_curr_uri])
+                self.json_schema_objects[_curr_uri] = self.resolveSchema(self.json_schema_objects[_curr_uri],
+                                                                         _curr_uri)
 
         write_to_log("Schemas loaded and resolved: " +
                      str.join(", ",  ["\"" +_curr_schema["title"] + "\""  for _curr_schema in self.json_schema_objects.values()])
@@ -166,27 +181,127 @@ class SchemaTools():
         return  _loaded_uris
 
 
-    def apply(self, _data, _schema_ref=None):
+    def clear_validator_cache(self):
+        """
+        Drop all prebuilt validators and reset the cache counters.
+        Called when the schemas are reloaded, for example when plugins are refreshed.
+        """
+        self.validator_cache = {}
+        self.validator_cache_hits = 0
+        self.validator_cache_misses = 0
+        # The object setters reference the subschemas of the old schemas
+        self.mongodb_validator.clear_object_setters()
+
+    def get_validators(self, _schema_ref, _json_schema_obj):
+        """
+        Returns prebuilt validators for a schema, builds and caches them if needed.
+        If the schema object of a schemaRef has been replaced in json_schema_objects, the cached validators are rebuilt.
+
+        :param _schema_ref: The schemaRef of the schema
+        :param _json_schema_obj: The current schema object of the schemaRef
+        :return: A tuple with the applying, the plain and the planned validator
+
+        """
+        _cached = self.validator_cache.get(_schema_ref)
+        if _cached is not None and _cached[0] is _json_schema_obj:
+            self.validator_cache_hits += 1
+            return _cached[1:]
+
+        self.validator_cache_misses += 1
+        _validators = self.mongodb_validator.make_validators(_json_schema_obj)
+        self.validator_cache[_schema_ref] = (_json_schema_obj,) + _validators
+        return _validators
+
+    def get_object_id_plan(self, _schema_ref, _json_schema_obj):
+        """
+        Returns the ObjectId conversion plan of a schema. Plans are made when schemas are resolved, but if the schema
+        wasn't resolved through resolveSchema, or has been replaced since, a new plan is made.
+
+        :param _schema_ref: The schemaRef of the schema
+        :param _json_schema_obj: The current schema object of the schemaRef
+        :return: A list of paths, see of.broker.lib.schema_mongodb.make_object_id_plan, None if the schema cannot be
+            planned
+
+        """
+        _cached = self.object_id_plans.get(_schema_ref)
+        if _cached is not None and _cached[0] is _json_schema_obj:
+            return _cached[1]
+        _plan = make_object_id_plan(_json_schema_obj)
+        self.object_id_plans[_schema_ref] = (_json_schema_obj, _plan)
+        return _plan
+
+    def get_object_id_plan_tree(self, _schema_ref, _json_schema_obj):
+        """
+        Returns the ObjectId conversion plan tree of a schema, made from its plan, see get_object_id_plan.
+
+        :param _schema_ref: The schemaRef of the schema
+        :param _json_schema_obj: The current schema object of the schemaRef
+        :return: A plan tree, see of.broker.lib.schema_mongodb.make_object_id_plan_tree, None if the schema cannot be
+            planned
+
+        """
+        _plan = self.get_object_id_plan(_schema_ref, _json_schema_obj)
+        if _plan is None:
+            return None
+        _cached = self.object_id_plan_trees.get(_schema_ref)
+        if _cached is not None and _cached[0] is _plan:
+            return _cached[1]
+        _tree = make_object_id_plan_tree(_plan)
+        self.object_id_plan_trees[_schema_ref] = (_plan, _tree)
+        return _tree
+
+    def _get_schema_ref(self, _data, _schema_ref, _caller_name):
+        """
+        Decide which schemaRef to validate against.
+
+        :param _data: The JSON data
+        :param _schema_ref: If set, this is used instead of the one in the data.
+        :param _caller_name: The name of the calling function for error messages
+        :return: The schemaRef and its schema object
+
+        """
+        if _schema_ref is not None:
+            return _schema_ref, self.json_schema_objects[_schema_ref]
+        if "schemaRef" in _data:
+            try:
+                return _data["schemaRef"], self.json_schema_objects[_data["schemaRef"]]
+            except KeyError as e:
+                raise Exception(_caller_name + ", invalid schemaRef: " + _data["schemaRef"])
+        else:
+            raise Exception(_caller_name + ", data must have a schemaRef attribute")
+
+    def apply(self, _data, _schema_ref=None, _use_plan=False, _copy=False):
         """
         Validate the JSON in _data against a JSON schema.
 
         :param _data: The JSON data to validate
         :param _schema_ref: If set, validate against the specified schema, and not the one in the data.
-        :return: the schema object that was validated against.
+        :param _use_plan: If set, validate once and then convert objectIds using the precomputed conversion plan.
+        :param _copy: If set, _data is left unchanged and a converted, shallow, copy is returned instead, see
+            of.broker.lib.schema_mongodb.copy_object_id_plan. Implies _use_plan.
+        :return: A tuple with the converted data and the schema object that was validated against.
+        Note: Schemas that cannot be planned, see of.broker.lib.schema_mongodb.make_object_id_plan, are applied by
+        the validator, with _copy, to a deep copy.
 
         """
-        if _schema_ref is not None:
-            _json_schema_obj = self.json_schema_objects[_schema_ref]
+        _schema_ref, _json_schema_obj = self._get_schema_ref(_data, _schema_ref, "SchemaTools.apply")
+        _apply_validator, _validate_validator, _planned_validator = self.get_validators(_schema_ref,
+                                                                                        _json_schema_obj)
+        if (_copy or _use_plan) and self.get_object_id_plan(_schema_ref, _json_schema_obj) is None:
+            if _copy:
+                _data = deepcopy(_data)
+            self.mongodb_validator.apply(_data, _json_schema_obj, _apply_validator)
+        elif _copy:
+            return self.mongodb_validator.apply_planned_copy(_data, _json_schema_obj,
+                                                             self.get_object_id_plan_tree(_schema_ref,
+                                                                                          _json_schema_obj),
+                                                             _planned_validator), _json_schema_obj
+        elif _use_plan:
+            self.mongodb_validator.apply_planned(_data, _json_schema_obj,
+                                                 self.get_object_id_plan(_schema_ref, _json_schema_obj),
+                                                 _planned_validator)
         else:
-            if "schemaRef" in _data:
-                try:
-                    _json_schema_obj = self.json_schema_objects[_data["schemaRef"]]
-                except KeyError as e:
-                    raise Exception("SchemaTools.apply, invalid schemaRef: " + _data["schemaRef"])
-            else:
-                raise Exception("SchemaTools.apply, data must have a schemaRef attribute")
-
-        self.mongodb_validator.apply(_data, _json_schema_obj)
+            self.mongodb_validator.apply(_data, _json_schema_obj, _apply_validator)
         return _data, _json_schema_obj
 
     def validate(self, _data, _schema_ref=None):
@@ -198,12 +313,11 @@ class SchemaTools():
         :return: the schema object that was validated against.
 
         """
-        if _schema_ref is not None:
-            _json_schema_obj = self.json_schema_objects[_schema_ref]
-        else:
-            _json_schema_obj = self.json_schema_objects[_data["schemaRef"]]
+        _schema_ref, _json_schema_obj = self._get_schema_ref(_data, _schema_ref, "SchemaTools.validate")
+        _apply_validator, _validate_validator, _planned_validator = self.get_validators(_schema_ref,
+                                                                                        _json_schema_obj)
 
-        self.mongodb_validator.validate(_data, _json_schema_obj)
+        self.mongodb_validator.validate(_data, _json_schema_obj, _validate_validator)
         return _data, _json_schema_obj
 
 
@@ -213,10 +327,11 @@ class SchemaTools():
         else:
             return []
 
-    def resolveSchema(self, _schema):
+    def resolveSchema(self, _schema, _schema_ref=None):
         """
         Recursively resolve all I{$ref} JSON references in a JSON Schema.
         :param _schema: A L{dict} with a JSON Schema.
+        :param _schema_ref: If set, also make an ObjectId conversion plan for the resolved schema under this schemaRef.
         :return: The resolved JSON Schema, a L{dict}.
         """
         _result = deepcopy(_schema)
@@ -287,4 +402,7 @@ class SchemaTools():
         except Exception as e:
             raise Exception("schemaTools.resolveSchema: error validating resolved schema:" + str(e) + "Schema " + json.dumps(_result, indent=4))
 
+        if _schema_ref is not None:
+            self.object_id_plans[_schema_ref] = (_result, make_object_id_plan(_result))
+
         return _result
\ No newline at end of file